@@ -1,18 +1,42 @@
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import firebase_admin
 from firebase_admin import credentials, firestore
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import base64
 from concurrent.futures import ThreadPoolExecutor
 import threading
+import queue
+import sqlite3
+import socket
+import uuid
+import time
+import io
+import hashlib
+import tempfile
+import random
+import atexit
+import itertools
+import heapq
+import bisect
+import math
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+from contextlib import contextmanager
 app = Flask(__name__)
 CORS(app)
 
+# خلف proxy (مثل Render) كل الطلبات تصل من عنوان الـ proxy: عنوان العميل من X-Forwarded-For
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))  # 0 = بدون proxy
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
 # ============================================
 # Firebase Initialization
 # ============================================
@@ -45,521 +69,3801 @@ except json.JSONDecodeError as je:
 except Exception as e:
     print(f"❌ Firebase initialization error: {e}")
 # ============================================
-# Colab URL (يتم تحديثه من Colab عبر /api/register-colab)
+# Metrics (عدادات و histograms بصيغة Prometheus على /metrics)
 # ============================================
-COLAB_URL = None
-COLAB_REGISTERED_AT = None
+METRICS_SHARDS = int(os.environ.get('METRICS_SHARDS', 16))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1KB → 256MB
 
-# ============================================
-# Main Routes
-# ============================================
+_metrics_local = threading.local()
+_metrics_shard_ids = itertools.count()
 
-@app.route('/')
-def home():
-    """الصفحة الرئيسية - معلومات عن السيرفر"""
-    return jsonify({
-        "message": "RVC API Server is running (Python/Flask)",
-        "status": "active",
-        "colab_connected": COLAB_URL is not None,
-        "colab_url": COLAB_URL if COLAB_URL else None,
-        "colab_registered_at": COLAB_REGISTERED_AT,
-        "firebase_connected": db is not None,
-        "timestamp": datetime.now().isoformat(),
-        "endpoints": {
-            "health": "/health",
-            "register_colab": "/api/register-colab (POST)",
-            "colab_status": "/api/colab-status (GET)",
-            "test_colab": "/api/test-colab-connection (GET)",
-            "preprocess": "/api/preprocess (POST)",
-            "train": "/api/train (POST)",
-            "convert": "/api/convert (POST)"
-        }
-    })
 
+def _metrics_shard_index():
+    """كل thread يكتب في shard ثابت، فلا يتنافس على نفس الـ lock مع باقي الـ threads"""
+    index = getattr(_metrics_local, "shard", None)
+    if index is None:
+        index = _metrics_local.shard = next(_metrics_shard_ids) % METRICS_SHARDS
+    return index
 
-@app.route('/health')
-def health():
-    """فحص صحة السيرفر"""
-    return jsonify({
-        "status": "ok",
-        "timestamp": datetime.now().isoformat()
-    })
 
+class Metric:
+    """counter / gauge / histogram مقسّم إلى shards؛ الجمع يتم فقط عند القراءة"""
 
-# ============================================
-# Colab Management Routes
-# ============================================
+    def __init__(self, kind, name, help_text, labelnames=(), buckets=None):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._shards = [(threading.Lock(), {}) for _ in range(METRICS_SHARDS)]
 
-@app.route('/api/register-colab', methods=['POST'])
-def register_colab():
-    """
-    Colab يرسل رابطه هنا عند بدء التشغيل
-    
-    Expected payload:
-    {
-        "colab_url": "https://xxxx.ngrok-free.app"
-    }
-    """
-    global COLAB_URL, COLAB_REGISTERED_AT
-    
-    try:
-        data = request.get_json()
-        colab_url = data.get('colab_url')
-        
-        if not colab_url:
-            return jsonify({
-                "success": False,
-                "error": "colab_url is required"
-            }), 400
-        
-        # تنظيف الرابط
-        COLAB_URL = colab_url.rstrip('/')
-        COLAB_REGISTERED_AT = datetime.now().isoformat()
-        
-        print(f"✅ Colab registered: {COLAB_URL}")
-        print(f"   Registered at: {COLAB_REGISTERED_AT}")
-        
-        # محاولة التحقق من الاتصال
+    def inc(self, *labels, amount=1):
+        lock, values = self._shards[_metrics_shard_index()]
+        with lock:
+            values[labels] = values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def observe(self, value, *labels):
+        lock, values = self._shards[_metrics_shard_index()]
+        with lock:
+            state = values.get(labels)
+            if state is None:
+                state = values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        t0 = time.perf_counter()
         try:
-            test_response = requests.get(f"{COLAB_URL}/health", timeout=5)
-            colab_health = test_response.json()
-            print(f"   Colab health check: {colab_health}")
-        except Exception as e:
-            print(f"   ⚠️ Could not verify Colab health: {e}")
-        
-        return jsonify({
-            "success": True,
-            "message": "Colab URL registered successfully",
-            "colab_url": COLAB_URL,
-            "registered_at": COLAB_REGISTERED_AT
-        })
-        
-    except Exception as e:
-        print(f"❌ Error registering Colab: {e}")
-        return jsonify({
-            "success": False,
-            "error": str(e)
-        }), 500
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
 
+    def _merged(self):
+        merged = {}
+        for lock, values in self._shards:
+            with lock:
+                items = [(k, [list(v[0]), v[1], v[2]] if self.kind == "histogram" else v) for k, v in values.items()]
+            for labels, value in items:
+                if self.kind != "histogram":
+                    merged[labels] = merged.get(labels, 0) + value
+                elif labels not in merged:
+                    merged[labels] = value
+                else:
+                    current = merged[labels]
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                    current[2] += value[2]
+        return merged
 
-@app.route('/api/colab-status', methods=['GET'])
-def colab_status():
-    """
-    الحصول على حالة Colab الحالية
-    """
-    return jsonify({
-        "colab_connected": COLAB_URL is not None,
-        "colab_url": COLAB_URL,
-        "registered_at": COLAB_REGISTERED_AT,
-        "timestamp": datetime.now().isoformat()
-    })
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self._merged().items()):
+            pairs = [f'{n}="{_metrics_escape(v)}"' for n, v in zip(self.labelnames, labels)]
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{_metrics_labels(pairs)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_metrics_labels(pairs + [le])} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_metrics_labels(pairs + [le])} {count}")
+            lines.append(f"{self.name}_sum{_metrics_labels(pairs)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{_metrics_labels(pairs)} {count}")
+        return lines
 
 
-@app.route('/api/test-colab-connection', methods=['GET'])
-def test_colab():
-    """
-    اختبار الاتصال مع Colab
-    """
-    global COLAB_URL
-    
-    if not COLAB_URL:
-        return jsonify({
-            "success": False,
-            "error": "Colab is not registered. Please run the Colab notebook first.",
-            "colab_url": None,
-            "registered_at": None
-        }), 503
-    
-    try:
-        # محاولة الوصول لـ /health في Colab
-        print(f"🔍 Testing connection to: {COLAB_URL}/health")
-        response = requests.get(f"{COLAB_URL}/health", timeout=10)
-        colab_health = response.json()
-        
-        print(f"✅ Colab responded: {colab_health}")
-        
-        return jsonify({
-            "success": True,
-            "message": "Colab is connected and responding",
-            "colab_url": COLAB_URL,
-            "colab_health": colab_health,
-            "registered_at": COLAB_REGISTERED_AT,
-            "response_time_ms": response.elapsed.total_seconds() * 1000,
-            "timestamp": datetime.now().isoformat()
-        })
-        
-    except requests.exceptions.Timeout:
-        print(f"⏱️ Colab connection timeout")
-        return jsonify({
-            "success": False,
-            "error": "Connection to Colab timed out",
-            "colab_url": COLAB_URL
-        }), 504
-        
-    except requests.exceptions.ConnectionError as e:
-        print(f"❌ Cannot connect to Colab: {e}")
-        return jsonify({
-            "success": False,
-            "error": "Cannot reach Colab. The ngrok tunnel may have expired.",
-            "colab_url": COLAB_URL,
-            "details": str(e)
-        }), 503
-        
-    except Exception as e:
-        print(f"❌ Error testing Colab: {e}")
-        return jsonify({
-            "success": False,
-            "error": f"Error: {str(e)}",
-            "colab_url": COLAB_URL
-        }), 500
+def _metrics_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
 
-@app.route('/api/disconnect-colab', methods=['POST'])
-def disconnect_colab():
-    """
-    فصل Colab (للاستخدام اليدوي أو عند إعادة التشغيل)
-    """
-    global COLAB_URL, COLAB_REGISTERED_AT
-    
-    old_url = COLAB_URL
-    COLAB_URL = None
-    COLAB_REGISTERED_AT = None
-    
-    print(f"🔌 Colab disconnected: {old_url}")
-    
-    return jsonify({
-        "success": True,
-        "message": "Colab disconnected",
-        "previous_url": old_url
-    })
+def _metrics_labels(pairs):
+    return "{" + ",".join(pairs) + "}" if pairs else ""
 
 
-# ============================================
-# RVC Processing Routes
-# ============================================
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
 
-@app.route('/api/preprocess' , methods = ['POST'])
-def preprocess():
-    try:
-        if not COLAB_URL:
-            return jsonify({"error": "Colab is not connected. Please run Colab first."}), 503
-        data = request.get_json()
-        user_id = data.get('user_id')
-        audio_base64 = data.get('trainset_dir')
-        exp_dir = data.get('exp_dir1')
-        audio_bytes = base64.b64decode(audio_base64)
-        
+    def _add(self, *args, **kwargs):
+        metric = Metric(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
 
-        doc_data = {
-            "audio_base64" : audio_base64,
-            "exp_dir" : data.get('exp_dir1'),
-            "sr" : data.get('sr'),
-            "n_p" : data.get('n_p'),
-            "user_id" : data.get('user_id'),
-            "is_favorite" : data.get('is_favorite'),
-            'gpus' : data.get("gpus16"),
-            'f0method' : data.get("f0method8"),
-            'if_f0' : data.get("if_f0_3"),
-            'version19' : data.get("version19"),
-            'gpus_rmvpe' : data.get("gpus_rmvpe"),
-            'spk_id5':data.get("spk_id5"),
-            'save_epoch10':data.get("save_epoch10"),
-            'total_epoch11':data.get("total_epoch11"),
-            'batch_size12':data.get("batch_size12"),
-            'if_save_latest13':data.get("if_save_latest13"),
-            'pretrained_G14':data.get("pretrained_G14"),
-            'pretrained_D15':data.get("pretrained_D15"),
-            'if_cache_gpu17':data.get("if_cache_gpu17"),
-            'if_save_every_weights18':data.get("if_save_every_weights18")
-        }
-        required_field = ["audio_base64" , "exp_dir" , "sr" , "n_p" , "user_id" , "is_favorite" , "gpus" ,"f0method" , "if_f0" , "version19" , "gpus_rmvpe"]
-        missing_field = [field for field in required_field if doc_data.get(field) is None]
-        if missing_field:
-            return jsonify(f"doc_data is not found is {missing_field}")
+    def counter(self, name, help_text, labelnames=()):
+        return self._add("counter", name, help_text, labelnames)
 
-        
-        
-        response = requests.post(
-            f"{COLAB_URL}/preprocess",
-            json = doc_data,
-            timeout = 800
-        )
+    def gauge(self, name, help_text, labelnames=()):
+        return self._add("gauge", name, help_text, labelnames)
 
-        preprocess_data = response.json()
-        print(f"colab_response : {preprocess_data}")
-        
-        def save_to_firebase():
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add("histogram", name, help_text, labelnames, buckets)
+
+    def collector(self, fn):
+        """دالة تُستدعى عند القراءة فقط وترجع أسطر جاهزة (لقيم موجودة أصلاً مثل worker pool)"""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for fn in self._collectors:
             try:
-                if db:
-                    db.collection('training_voices').document(user_id).collection(exp_dir).document('data').set(doc_data , merge = True)
-                    print('training_voices is created sucessfull')
-            except Exception as f:
-                return jsonify(f'error : {f}')
-                print('training_voices is not created in firebase')
+                lines.extend(fn())
+            except Exception as e:
+                print(f"⚠️ Metrics collector {fn.__name__} failed: {e}")
+        return "\n".join(lines) + "\n"
 
-        threading.Thread(target=save_to_firebase, daemon=True).start()
-        return jsonify({**preprocess_data , "every_thing": "ok"}),200
 
-    except Exception as d:
-        print(f"Error is {d}")
-        return jsonify({"error_farouk": str(d)}), 500
+metrics = MetricsRegistry()
 
+http_requests_total = metrics.counter(
+    "gateway_http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+http_errors_total = metrics.counter(
+    "gateway_http_errors_total", "HTTP responses with status >= 500", ("route", "method"))
+http_request_seconds = metrics.histogram(
+    "gateway_http_request_seconds", "Time until the response headers are ready", ("route", "method"))
+http_in_flight = metrics.gauge(
+    "gateway_http_in_flight", "Requests currently being handled", ("route",))
+http_request_bytes = metrics.histogram(
+    "gateway_http_request_bytes", "Request body size", ("route",), buckets=SIZE_BUCKETS)
+http_response_bytes = metrics.histogram(
+    "gateway_http_response_bytes", "Response body size (non-streaming responses)", ("route",), buckets=SIZE_BUCKETS)
+worker_request_seconds = metrics.histogram(
+    "gateway_worker_request_seconds", "Gateway to Colab round-trip time per attempt", ("endpoint", "status"))
+worker_timeouts_total = metrics.counter(
+    "gateway_worker_timeouts_total", "Gateway to Colab requests that timed out", ("endpoint", "kind"))
+firestore_seconds = metrics.histogram(
+    "gateway_firestore_seconds", "Firestore call latency", ("op",))
+firestore_errors_total = metrics.counter(
+    "gateway_firestore_errors_total", "Failed Firestore calls", ("op",))
+singleflight_total = metrics.counter(
+    "gateway_singleflight_total", "Requests that ran upstream (leader) or reused an identical in-flight call (follower)",
+    ("route", "role"))
+admission_wait_seconds = metrics.histogram(
+    "gateway_admission_wait_seconds", "Time spent in the admission queue before reaching a worker", ("kind",))
+worker_bytes_total = metrics.counter(
+    "gateway_worker_bytes_total", "Audio bytes sent to / received from Colab over the binary transport",
+    ("direction", "encoding"))
+admission_rejected_total = metrics.counter(
+    "gateway_admission_rejected_total", "Requests rejected with 429 by admission control", ("kind", "reason"))
 
 
+def _worker_endpoint(path):
+    """/progress/<exp_dir> → label ثابت حتى لا يكبر عدد الـ series"""
+    path = path.split('?', 1)[0]
+    if path.startswith('/progress/'):
+        return '/progress/<exp_dir>/stream' if path.endswith('/stream') else '/progress/<exp_dir>'
+    return path
 
-@app.route('/api/add_to_favorite' , methods = ['POST'])
-def add_to_favorite():
-    try:
-        if not COLAB_URL:
-            return jsonify({"error": "Colab is not connected. Please run Colab first."}), 503
-        data = request.get_json()
-        user_id = data.get("user_id")
-        is_favorite = data.get("is_favorite" , False)
-        exp_dir = data.get('exp_dir1')
 
-        if db:
-            try:
-                db.collection('training_voices')\
-                .document(user_id)\
-                .collection(exp_dir)\
-                .document('data')\
-                .update({"is_favorite": is_favorite})
-                return jsonify({"messege" : "add to favorite is sucessfull" , "status" : "True"})
-            except Exception as f:
-                return jsonify(f"messege : add to favorite is Error : {f}")
+@app.before_request
+def _metrics_before_request():
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_t0 = time.perf_counter()
+    http_in_flight.inc(g.metrics_route)
+    if request.content_length:
+        http_request_bytes.observe(request.content_length, g.metrics_route)
 
-    except Exception as d:
-        print(f'error:{d}')
-    
 
+@app.after_request
+def _metrics_after_request(response):
+    route = g.get("metrics_route")
+    if route is None:
+        return response
+    http_requests_total.inc(route, request.method, str(response.status_code))
+    if response.status_code >= 500:
+        http_errors_total.inc(route, request.method)
+    http_request_seconds.observe(time.perf_counter() - g.metrics_t0, route, request.method)
+    if not response.is_streamed and response.content_length is not None:
+        http_response_bytes.observe(response.content_length, route)
+    return response
 
-@app.route('/api/train', methods=['POST'])
-def train():
-    """
-    تدريب نموذج RVC
-    يرسل الطلب إلى Colab
-    
-    Expected payload:
-    {
-        "exp_dir1": "model_name",
-        "trainset_dir4": "/path/to/audio",
-        "user_id": "user_123"
-    }
-    """
-    global COLAB_URL
-    
-    try:
-        data = request.get_json()
-        print(f"\n📥 Training request received:")
-        print(f"   {json.dumps(data, indent=2, ensure_ascii=False)}")
 
-        exp_dir1      = data.get('exp_dir1')
-        trainset_dir4 = data.get('trainset_dir4')
-        user_id       = data.get('user_id')
+@app.teardown_request
+def _metrics_teardown_request(exc):
+    route = g.pop("metrics_route", None)
+    if route is not None:
+        http_in_flight.dec(route)
 
-        if not all([exp_dir1, trainset_dir4, user_id]):
-            return jsonify({
-                "success": False,
-                "error": "Missing required fields: exp_dir1, trainset_dir4, user_id"
-            }), 400
 
-        if not COLAB_URL:
-            return jsonify({
-                "success": False,
-                "error": "Colab is not connected. Please run the Colab notebook first."
-            }), 503
+@metrics.collector
+def _gateway_state_metrics():
+    """قيم موجودة أصلاً في worker pool / طوابير المهام، تُقرأ فقط عند طلب /metrics"""
+    lines = [
+        "# HELP gateway_worker_in_flight Requests leased to each Colab worker",
+        "# TYPE gateway_worker_in_flight gauge",
+    ]
+    workers = worker_pool.snapshot()
+    for w in workers:
+        lines.append(f'gateway_worker_in_flight{{worker_id="{_metrics_escape(w["worker_id"])}"}} {w["in_flight"]}')
+    lines += [
+        "# HELP gateway_worker_circuit_open 1 when the worker circuit breaker is open",
+        "# TYPE gateway_worker_circuit_open gauge",
+    ]
+    for w in workers:
+        lines.append(f'gateway_worker_circuit_open{{worker_id="{_metrics_escape(w["worker_id"])}"}} '
+                     f'{int(w["circuit"]["state"] == "open")}')
+    lines += [
+        "# HELP gateway_worker_healthy 1 when the last background health checks passed",
+        "# TYPE gateway_worker_healthy gauge",
+    ]
+    for w in workers:
+        lines.append(f'gateway_worker_healthy{{worker_id="{_metrics_escape(w["worker_id"])}"}} '
+                     f'{int(w["health"] == "healthy")}')
+    lines += [
+        "# HELP gateway_worker_ready 1 when the worker finished its startup prewarm",
+        "# TYPE gateway_worker_ready gauge",
+    ]
+    for w in workers:
+        lines.append(f'gateway_worker_ready{{worker_id="{_metrics_escape(w["worker_id"])}"}} {int(w["ready"])}')
+    lines += [
+        "# HELP gateway_worker_availability Share of successful health checks in the rolling window",
+        "# TYPE gateway_worker_availability gauge",
+    ]
+    for w in workers:
+        check = w["health_check"] or {}
+        if check.get("availability") is not None:
+            lines.append(f'gateway_worker_availability{{worker_id="{_metrics_escape(w["worker_id"])}"}} '
+                         f'{check["availability"]}')
 
-        colab_payload = data
+    state = admission.stats()
+    lines += [
+        "# HELP gateway_admission_running Requests admitted and not finished yet",
+        "# TYPE gateway_admission_running gauge",
+        f"gateway_admission_running {state['running']}",
+        "# HELP gateway_admission_waiting Requests waiting in the admission queue",
+        "# TYPE gateway_admission_waiting gauge",
+    ]
+    for kind, n in state['waiting_by_kind'].items():
+        lines.append(f'gateway_admission_waiting{{kind="{kind}"}} {n}')
 
-        print(f"📤 Sending to Colab: {COLAB_URL}/train")
-        
-        colab_response = requests.post(
-            f"{COLAB_URL}/train",
-            json=colab_payload,
-            timeout=600  # 10 دقائق للتدريب
-        )
-        
-        colab_data = colab_response.json()
-        print(f"📨 Colab response: {json.dumps(colab_data, indent=2, ensure_ascii=False)}")
+    persist = persist_queue.stats()
+    lines += [
+        "# HELP gateway_persist_queue_depth Firestore writes waiting to be committed",
+        "# TYPE gateway_persist_queue_depth gauge",
+        f"gateway_persist_queue_depth {persist['depth']}",
+        "# HELP gateway_jobs Jobs in the local queue by state",
+        "# TYPE gateway_jobs gauge",
+    ]
+    with _jobs_db() as conn:
+        for row in conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"):
+            lines.append(f'gateway_jobs{{state="{row["state"]}"}} {row["n"]}')
+    return lines
 
-        # حفظ في Firestore
-        if db:
-            try:
-                doc_data = {
-                    "userId":       user_id,
-                    "exp_dir":      exp_dir1,
-                    "audioUrl":     trainset_dir4,
-                    "status":       "trained" if colab_data.get("success") else "failed",
-                    "colab_result": colab_data,
-                    "updatedAt":    firestore.SERVER_TIMESTAMP,
-                    "trainedAt":    datetime.now().isoformat()
-                }
-                
-                db.collection('exp_dir').document(user_id)\
-                  .collection('voices').document(exp_dir1)\
-                  .set(doc_data, merge=True)
-                  
-                print("✅ Saved to Firestore")
-                
-                # ✅ حفظ في القائمة العامة بعد نجاح التدريب
-                if colab_data.get("success"):
-                    try:
-                        db.collection('training_voices').add({
-                            'voiceName': exp_dir1,
-                            'modelPath': f'/content/RVC/RVC1006AMD_Intel1/assets/weights/{exp_dir1}.pth',
-                            'indexPath': f'/content/RVC/RVC1006AMD_Intel1/logs/{exp_dir1}',
-                            'createdBy': user_id,
-                            'createdAt': firestore.SERVER_TIMESTAMP,
-                            'isPublic': True,
-                            'downloads': 0,
-                        })
-                        print(f"✅ Added {exp_dir1} to training_voices collection")
-                    except Exception as e:
-                        print(f"⚠️ Could not add to training_voices: {e}")
-                        
-            except Exception as db_error:
-                print(f"❌ Firestore error: {db_error}")
 
-        return jsonify({
-            "success": colab_data.get("success", False),
-            "message": "Training request sent to Colab",
-            "data": colab_data,
-            "timestamp": datetime.now().isoformat()
-        }), colab_response.status_code
+# ============================================
+# Tracing (trace id لكل طلب + مدة كل مرحلة + سجل JSONL لأبطأ الطلبات)
+# ============================================
+TRACE_HEADER = 'X-Trace-Id'
+TRACE_LOG_PATH = os.environ.get('TRACE_LOG_PATH', 'traces.jsonl')
+TRACE_LOG_MAX_MB = float(os.environ.get('TRACE_LOG_MAX_MB', 50))
+TRACE_SKIP_ROUTES = {'/metrics', '/health', '/api/traces/slowest', '/api/traces/<trace_id>'}
 
-    except requests.exceptions.Timeout:
-        return jsonify({
-            "success": False,
-            "error": "Training request timed out (>10 minutes)"
-        }), 504
-        
-    except requests.exceptions.ConnectionError:
-        return jsonify({
-            "success": False,
-            "error": "Cannot connect to Colab"
-        }), 503
-        
-    except Exception as e:
-        print(f"❌ Error in train: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({
-            "success": False,
-            "error": str(e)
-        }), 500
+_trace_local = threading.local()
 
 
-@app.route('/api/convert', methods=['POST'])
-def convert():
-    global COLAB_URL
+class Trace:
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.spans = []
+        self.worker = None  # timings التي يرجعها Colab
 
-    try:
-        data = request.get_json()
-        print(f"\n📥 Convert request received:")
-        print(f"   {json.dumps(data, indent=2, ensure_ascii=False)}")
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append({
+                "name": name,
+                "start_ms": round((start - self._t0) * 1000, 2),
+                "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+            })
 
-        # ✅ استخراج voice_name من الطلب
-        voice_name = data.get('file_index2')  # Flutter يرسل اسم الصوت هنا
-        user_id = data.get('user_id')
-        
-        if not voice_name:
-            return jsonify({
-                "success": False,
-                "error": "voice_name (file_index2) is required"
-            }), 400
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self._t0) * 1000, 2)
 
-        # ✅ البحث في Firestore عن معلومات الصوت
-        model_path = None
-        index_path = ""
-        
-        if db:
-            try:
-                # البحث في training_voices (الأصوات المشتركة)
-                voice_docs = db.collection('training_voices')\
-                              .where('voiceName', '==', voice_name)\
-                              .limit(1)\
-                              .get()
-                
-                if voice_docs:
-                    voice_data = voice_docs[0].to_dict()
-                    model_path = voice_data.get('modelPath')
-                    index_path = voice_data.get('indexPath', '')
-                    print(f"✅ Found in training_voices: {voice_name}")
-                else:
-                    # إذا لم يوجد في training_voices، ابحث في الأصوات المخصصة للمستخدم
-                    custom_voice = db.collection('exp_dir')\
-                                    .document(user_id)\
-                                    .collection('voices')\
-                                    .document(voice_name)\
-                                    .get()
-                    
-                    if custom_voice.exists:
-                        custom_data = custom_voice.to_dict()
-                        exp_dir = custom_data.get('exp_dir', voice_name)
-                        model_path = f'/content/RVC/RVC1006AMD_Intel1/assets/weights/{exp_dir}.pth'
-                        index_path = f'/content/RVC/RVC1006AMD_Intel1/logs/{exp_dir}'
-                        print(f"✅ Found in user voices: {voice_name}")
-                    else:
-                        # صوت افتراضي
-                        model_path = f'/content/RVC/RVC1006AMD_Intel1/assets/weights/{voice_name}.pth'
-                        index_path = f'/content/RVC/RVC1006AMD_Intel1/logs/{voice_name}'
-                        print(f"ℹ️ Using default path: {voice_name}")
-                        
-            except Exception as db_error:
-                print(f"⚠️ Firestore error: {db_error}")
-                # استخدام المسار الافتراضي
-                model_path = f'/content/RVC/RVC1006AMD_Intel1/assets/weights/{voice_name}.pth'
-                index_path = f'/content/RVC/RVC1006AMD_Intel1/logs/{voice_name}'
-        else:
-            # إذا لم يكن Firebase متصل
-            model_path = f'/content/RVC/RVC1006AMD_Intel1/assets/weights/{voice_name}.pth'
-            index_path = f'/content/RVC/RVC1006AMD_Intel1/logs/{voice_name}'
+    def timings(self):
+        """{stage: ms} مجمعة حسب الاسم + مراحل Colab + الوقت الضائع في الشبكة (ngrok)"""
+        timings = {}
+        for span in self.spans:
+            timings[span["name"]] = round(timings.get(span["name"], 0) + span["duration_ms"], 2)
+        if self.worker:
+            timings["worker"] = self.worker
+            worker_total = self.worker.get("total_ms")
+            call_ms = sum(v for k, v in timings.items() if k.startswith("colab "))
+            if worker_total is not None and call_ms:
+                timings["network_ms"] = round(max(0.0, call_ms - worker_total), 2)
+        timings["total_ms"] = self.elapsed_ms()
+        return timings
 
-        if not COLAB_URL:
-            return jsonify({
-                "success": False,
-                "error": "Colab is not connected."
-            }), 503
 
-        # ✅ إعداد البيانات للإرسال إلى Colab
-        colab_payload = {
-            'spk_item': data.get('spk_item', 0),
-            'input_audio0': data.get('input_audio0'),
-            'vc_transform0': data.get('vc_transform0', 0),
-            'f0_file': data.get('f0_file'),
-            'f0method0': data.get('f0method0', 'rmvpe'),
-            'file_index1': '',  # فارغ
-            'file_index2': model_path,  # ✅ المسار الكامل للنموذج
-            'index_path': index_path,   # ✅ مسار index
-            'index_rate1': data.get('index_rate1', 0.75),
-            'filter_radius0': data.get('filter_radius0', 3),
-            'resample_sr0': data.get('resample_sr0', 0),
-            'rms_mix_rate0': data.get('rms_mix_rate0', 0.25),
-            'protect0': data.get('protect0', 0.33),
-            'user_id': user_id,
-            'input_type': data.get('input_type', 'file'),
-        }
-        
-        print(f"📤 Sending to Colab:")
-        print(f"   Model: {model_path}")
-        print(f"   Index: {index_path}")
+def current_trace():
+    return getattr(_trace_local, "trace", None)
 
-        colab_response = requests.post(
-            f"{COLAB_URL}/convert",
-            json=colab_payload,
-            timeout=300
-        )
 
-        colab_data = colab_response.json()
-        print(f"📨 Colab response: {json.dumps(colab_data, indent=2)}")
+@contextmanager
+def trace_span(name):
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
 
-        return jsonify({
-            "success": colab_data.get("success", False),
-            "message": "Convert request processed",
+
+def _valid_trace_id(value):
+    return bool(value) and len(value) <= 64 and all(c.isalnum() or c in "-_" for c in value)
+
+
+class TraceSink:
+    """ملف JSONL (سطر لكل طلب)، يُستبدل بـ .1 عند تجاوز TRACE_LOG_MAX_MB"""
+
+    def __init__(self, path=TRACE_LOG_PATH, max_bytes=int(TRACE_LOG_MAX_MB * 1024 * 1024)):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            try:
+                if os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+            except FileNotFoundError:
+                pass
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def _records(self):
+        for path in (self.path + ".1", self.path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            continue
+            except FileNotFoundError:
+                continue
+
+    def slowest(self, limit=20, route=None, since=None):
+        records = (r for r in self._records()
+                   if (not route or r.get("route") == route)
+                   and (not since or r.get("started_at", "") >= since))
+        return heapq.nlargest(limit, records, key=lambda r: r.get("total_ms", 0))
+
+    def find(self, trace_id):
+        return [r for r in self._records() if r.get("trace_id") == trace_id]
+
+
+trace_sink = TraceSink()
+
+
+def _write_trace(trace, method, status):
+    try:
+        trace_sink.write({
+            "trace_id": trace.trace_id,
+            "route": trace.name,
+            "method": method,
+            "status": status,
+            "started_at": datetime.fromtimestamp(trace.started_at).isoformat(),
+            "total_ms": trace.elapsed_ms(),
+            "spans": trace.spans,
+            "worker": trace.worker,
+        })
+    except OSError as e:
+        print(f"⚠️ Could not write trace: {e}")
+
+
+@app.before_request
+def _trace_before_request():
+    trace_id = request.headers.get(TRACE_HEADER)
+    if not _valid_trace_id(trace_id):
+        trace_id = uuid.uuid4().hex
+    _trace_local.trace = Trace(trace_id, request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@app.after_request
+def _trace_after_request(response):
+    trace = current_trace()
+    if trace is not None:
+        response.headers[TRACE_HEADER] = trace.trace_id
+        if request.url_rule and request.url_rule.rule not in TRACE_SKIP_ROUTES:
+            _write_trace(trace, request.method, response.status_code)
+    return response
+
+
+@app.teardown_request
+def _trace_teardown_request(exc):
+    _trace_local.trace = None
+
+
+# ============================================
+# Persistence Queue (كتابات Firestore في الخلفية: دمج + batch commits + journal على القرص)
+# ============================================
+PERSIST_JOURNAL_PATH = os.environ.get('PERSIST_JOURNAL_PATH', 'firestore_journal.db')
+PERSIST_MAX_PENDING = int(os.environ.get('PERSIST_MAX_PENDING', 10000))
+PERSIST_BATCH_SIZE = min(int(os.environ.get('PERSIST_BATCH_SIZE', 200)), 500)  # حد Firestore للـ batch هو 500
+PERSIST_FLUSH_INTERVAL = float(os.environ.get('PERSIST_FLUSH_INTERVAL', 1.0))
+PERSIST_MAX_ATTEMPTS = int(os.environ.get('PERSIST_MAX_ATTEMPTS', 8))
+PERSIST_RETRY_BACKOFF = float(os.environ.get('PERSIST_RETRY_BACKOFF', 1.0))
+PERSIST_ENQUEUE_TIMEOUT = float(os.environ.get('PERSIST_ENQUEUE_TIMEOUT', 5))
+
+
+class PersistQueueFull(Exception):
+    pass
+
+
+def _persist_encode(value):
+    """firestore.SERVER_TIMESTAMP لا يتحول إلى JSON مباشرة"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return {"__sentinel__": "server_timestamp"}
+    raise TypeError(f"Cannot persist {type(value).__name__}")
+
+
+def _persist_decode(obj):
+    if obj.get("__sentinel__") == "server_timestamp":
+        return firestore.SERVER_TIMESTAMP
+    return obj
+
+
+class PersistQueue:
+    """
+    طابور كتابات Firestore (write-behind):
+    - set / update / add ترجع فوراً، والكتابة تتم من thread واحد في الخلفية
+    - الكتابات المتتالية لنفس المستند تُدمج في كتابة واحدة
+    - الإرسال كـ batch عند PERSIST_BATCH_SIZE أو بعد PERSIST_FLUSH_INTERVAL
+    - كل كتابة تُحفظ في SQLite قبل الرجوع، وتُعاد بعد إعادة التشغيل حتى يتم commit.
+      كل كتابة سطر جديد في الـ journal (لا تعديل لسطر مشترك)، فالكتابة على القرص تتم خارج القفل
+      ولا تنتظر باقي الكتابات أو الـ flusher. الاسترجاع يدمج السطور بنفس ترتيبها
+    - المستندات التي تم commit لها تُسجل في الـ journal (known) حتى نعرف وجودها بدون قراءة Firestore.
+      update لمستند غير موجود لا يُعاد: يُسقط ويظهر في missing / recent_missing على /api/persistence
+    - on_commit: دوال تُستدعى بعد commit الكتابة (مثلاً إبطال cache يقرأ نفس المستند).
+      لا تُحفظ في الـ journal: بعد إعادة التشغيل تكون الـ caches فارغة أصلاً
+    """
+
+    def __init__(self, journal_path=PERSIST_JOURNAL_PATH):
+        self.journal_path = journal_path
+        self._pending = OrderedDict()   # doc path → op (بترتيب أول كتابة)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._in_flight = 0
+        self._in_flight_paths = set()
+        self._flush_ms = []
+        self._recent_missing = deque(maxlen=20)
+        self.counters = {
+            "enqueued": 0, "coalesced": 0, "committed": 0, "batches": 0,
+            "failures": 0, "retries": 0, "dropped": 0, "missing": 0,
+        }
+
+    @contextmanager
+    def _journal(self):
+        conn = sqlite3.connect(self.journal_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def init(self):
+        with self._journal() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS writes (
+                    id    INTEGER PRIMARY KEY AUTOINCREMENT,
+                    path  TEXT NOT NULL,
+                    kind  TEXT NOT NULL,
+                    merge INTEGER NOT NULL,
+                    data  TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY)")
+
+    # ── الواجهة ──
+
+    def set(self, path, data, merge=False, on_commit=None):
+        self._enqueue(path, "set", data, merge, on_commit)
+
+    def update(self, path, data, on_commit=None):
+        self._enqueue(path, "update", data, True, on_commit)
+
+    def add(self, collection_path, data):
+        """مثل collection.add لكن بـ id محلي حتى تكون إعادة المحاولة آمنة"""
+        doc_id = uuid.uuid4().hex[:20]
+        self._enqueue(f"{collection_path}/{doc_id}", "set", data, False)
+        return doc_id
+
+    def pending(self, path):
+        """كتابة لهذا المستند لم يتم commit لها بعد (في الطابور أو في batch جارٍ)"""
+        with self._cond:
+            return path in self._pending or path in self._in_flight_paths
+
+    def known(self, path):
+        """المستند موجود حسب ما يعرفه هذا الـ gateway: كتابة لم يتم commit لها بعد، أو commit سابق"""
+        if self.pending(path):
+            return True
+        with self._journal() as conn:
+            return conn.execute("SELECT 1 FROM documents WHERE path = ?", (path,)).fetchone() is not None
+
+    @staticmethod
+    def _new_op(path, kind, data, merge, enqueued_at):
+        return {"rows": [], "path": path, "kind": kind, "merge": merge, "data": dict(data),
+                "attempts": 0, "not_before": 0, "enqueued_at": enqueued_at, "on_commit": []}
+
+    @staticmethod
+    def _merge(op, kind, data, merge):
+        if kind == "set" and not merge:
+            op.update(kind="set", merge=False, data=dict(data))
+        else:
+            # set(merge) أو update فوق كتابة سابقة: الحقول الجديدة تغطي القديمة
+            op["data"].update(data)
+            if kind == "set":
+                op["kind"] = "set"
+
+    def _enqueue(self, path, kind, data, merge, on_commit=None):
+        if not db:
+            return
+        with self._cond:
+            deadline = time.time() + PERSIST_ENQUEUE_TIMEOUT
+            while path not in self._pending and len(self._pending) >= PERSIST_MAX_PENDING:
+                self._cond.notify_all()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PersistQueueFull(f"Persistence queue is full ({len(self._pending)} pending)")
+                self._cond.wait(remaining)
+
+        row_id = self._save(path, kind, data, merge)
+        with self._cond:
+            op = self._pending.get(path)
+            if op is None:
+                op = self._pending[path] = self._new_op(path, kind, data, merge, time.time())
+            else:
+                self._merge(op, kind, data, merge)
+                self.counters["coalesced"] += 1
+            op["rows"].append(row_id)
+            if on_commit:
+                op["on_commit"].append(on_commit)
+            self.counters["enqueued"] += 1
+            if len(self._pending) >= PERSIST_BATCH_SIZE:
+                self._cond.notify_all()
+        self._ensure_thread()
+
+    def _save(self, path, kind, data, merge):
+        row = (path, kind, int(merge), json.dumps(data, default=_persist_encode))
+        with self._journal() as conn:
+            return conn.execute("INSERT INTO writes (path, kind, merge, data) VALUES (?, ?, ?, ?)", row).lastrowid
+
+    def _forget(self, ops, committed=False):
+        with self._journal() as conn:
+            conn.executemany("DELETE FROM writes WHERE id = ?", [(row,) for op in ops for row in op["rows"]])
+            if committed:
+                conn.executemany("INSERT OR IGNORE INTO documents (path) VALUES (?)", [(op["path"],) for op in ops])
+            missing = [(op["path"],) for op in ops if op.get("missing")]
+            if missing:
+                conn.executemany("DELETE FROM documents WHERE path = ?", missing)
+
+    @staticmethod
+    def _is_missing(op, error):
+        """update لمستند غير موجود (NotFound): إعادة المحاولة لن تغير شيئاً"""
+        return op["kind"] == "update" and getattr(error, "code", None) == 404
+
+    # ── الإرسال ──
+
+    def _ensure_thread(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='persist-flush', daemon=True)
+            self._thread.start()
+
+    def _take_batch(self):
+        """ينتظر حتى يمتلئ batch أو يمر PERSIST_FLUSH_INTERVAL على أقدم كتابة جاهزة"""
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = [op for op in self._pending.values() if op["not_before"] <= now]
+                oldest = min((op["enqueued_at"] for op in ready), default=now)
+                if ready and (len(ready) >= PERSIST_BATCH_SIZE or now - oldest >= PERSIST_FLUSH_INTERVAL):
+                    batch = ready[:PERSIST_BATCH_SIZE]
+                    for op in batch:
+                        del self._pending[op["path"]]
+                    self._in_flight = len(batch)
+                    self._in_flight_paths = {op["path"] for op in batch}
+                    self._cond.notify_all()
+                    return batch
+                if ready:
+                    timeout = PERSIST_FLUSH_INTERVAL - (now - oldest)
+                elif self._pending:
+                    timeout = min(op["not_before"] for op in self._pending.values()) - now
+                else:
+                    timeout = None
+                self._cond.wait(timeout)
+
+    def _commit(self, ops):
+        batch = db.batch()
+        for op in ops:
+            ref = db.document(op["path"])
+            if op["kind"] == "update":
+                batch.update(ref, op["data"])
+            else:
+                batch.set(ref, op["data"], merge=op["merge"])
+        try:
+            with firestore_seconds.time("batch_commit"):
+                batch.commit()
+        except Exception:
+            firestore_errors_total.inc("batch_commit")
+            raise
+
+    def _run(self):
+        while True:
+            ops = self._take_batch()
+            t0 = time.time()
+            try:
+                self._commit(ops)
+                done, failed = ops, []
+            except Exception as e:
+                print(f"⚠️ Firestore batch of {len(ops)} failed: {e}")
+                self.counters["failures"] += 1
+                if len(ops) == 1:
+                    ops[0]["error"] = str(e)
+                    ops[0]["missing"] = self._is_missing(ops[0], e)
+                    done, failed = [], ops
+                else:
+                    # نعزل الكتابة المسببة للخطأ حتى لا تمنع باقي الـ batch
+                    done, failed = [], []
+                    for op in ops:
+                        try:
+                            self._commit([op])
+                            done.append(op)
+                        except Exception as single_error:
+                            op["error"] = str(single_error)
+                            op["missing"] = self._is_missing(op, single_error)
+                            failed.append(op)
+
+            elapsed_ms = (time.time() - t0) * 1000
+            if done:
+                self._forget(done, committed=True)
+                for op in done:
+                    for callback in op["on_commit"]:
+                        try:
+                            callback()
+                        except Exception as e:
+                            print(f"⚠️ on_commit for {op['path']} failed: {e}")
+            missing = [op for op in failed if op["missing"]]
+            dropped = [op for op in failed if op["missing"] or op["attempts"] + 1 >= PERSIST_MAX_ATTEMPTS]
+            if dropped:
+                self._forget(dropped)
+                for op in dropped:
+                    if op["missing"]:
+                        print(f"❌ Dropping Firestore update to {op['path']}: document does not exist")
+                    else:
+                        print(f"❌ Dropping Firestore write to {op['path']} after {PERSIST_MAX_ATTEMPTS} attempts: {op.get('error')}")
+
+            with self._cond:
+                self._in_flight = 0
+                self._in_flight_paths = set()
+                self.counters["batches"] += 1
+                self.counters["committed"] += len(done)
+                self.counters["dropped"] += len(dropped)
+                self.counters["missing"] += len(missing)
+                self._recent_missing.extend({"path": op["path"], "at": datetime.now().isoformat()} for op in missing)
+                self._flush_ms = (self._flush_ms + [elapsed_ms])[-100:]
+                for op in failed:
+                    if op in dropped:
+                        continue
+                    self._requeue(op)
+                self._cond.notify_all()
+
+    def _requeue(self, op):
+        """يرجع كتابة فاشلة للطابور مع backoff، مع الحفاظ على أي كتابة أحدث لنفس المستند"""
+        op["attempts"] += 1
+        op["not_before"] = time.time() + PERSIST_RETRY_BACKOFF * (2 ** (op["attempts"] - 1))
+        self.counters["retries"] += 1
+        newer = self._pending.get(op["path"])
+        if newer is not None:
+            # سطور الـ journal تبقى كما هي: الأقدم أولاً، ونفس الدمج عند الاسترجاع
+            newer["rows"][:0] = op["rows"]
+            newer["on_commit"][:0] = op["on_commit"]
+            if newer["kind"] == "set" and not newer["merge"]:
+                return
+            self._merge(op, newer["kind"], newer["data"], newer["merge"])
+            op["rows"], op["on_commit"] = newer["rows"], newer["on_commit"]
+        self._pending[op["path"]] = op
+
+    # ── التشغيل / الإيقاف ──
+
+    def recover(self):
+        """يعيد تحميل الكتابات التي لم يتم commit لها قبل إعادة التشغيل"""
+        with self._journal() as conn:
+            rows = conn.execute("SELECT id, path, kind, merge, data FROM writes ORDER BY id").fetchall()
+        if not rows:
+            return
+        if not db:
+            print(f"⚠️ {len(rows)} journaled Firestore write(s) kept until Firebase is configured")
+            return
+        with self._cond:
+            for row_id, path, kind, merge, data in rows:
+                data = json.loads(data, object_hook=_persist_decode)
+                op = self._pending.get(path)
+                if op is None:
+                    op = self._pending[path] = self._new_op(path, kind, data, bool(merge), 0)
+                else:
+                    self._merge(op, kind, data, bool(merge))
+                op["rows"].append(row_id)
+        print(f"♻️ Recovered {len(rows)} journaled Firestore write(s)")
+        self._ensure_thread()
+
+    def flush(self, timeout=10):
+        """ينتظر حتى يفرغ الطابور (عند الإيقاف)"""
+        deadline = time.time() + timeout
+        with self._cond:
+            for op in self._pending.values():
+                op["enqueued_at"] = 0
+            self._cond.notify_all()
+            while (self._pending or self._in_flight) and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            return not (self._pending or self._in_flight)
+
+    def stats(self):
+        with self._cond:
+            flush_ms = sorted(self._flush_ms)
+            oldest = min((op["enqueued_at"] for op in self._pending.values()), default=None)
+            return {
+                "enabled": db is not None,
+                "depth": len(self._pending),
+                "in_flight": self._in_flight,
+                "max_pending": PERSIST_MAX_PENDING,
+                "oldest_pending_s": round(time.time() - oldest, 2) if oldest else None,
+                "flush_ms_avg": round(sum(flush_ms) / len(flush_ms), 1) if flush_ms else None,
+                "flush_ms_max": round(flush_ms[-1], 1) if flush_ms else None,
+                "flush_ms_last": round(self._flush_ms[-1], 1) if flush_ms else None,
+                "recent_missing": list(self._recent_missing),
+                **self.counters,
+            }
+
+
+persist_queue = PersistQueue()
+
+try:
+    persist_queue.init()
+except Exception as e:
+    print(f"❌ Persistence journal initialization error: {e}")
+
+atexit.register(persist_queue.flush)
+
+# ============================================
+# Colab HTTP Client (اتصالات keep-alive + retries + circuit breaker)
+# ============================================
+COLAB_POOL_SIZE = int(os.environ.get('COLAB_POOL_SIZE', 32))
+COLAB_CONNECT_TIMEOUT = float(os.environ.get('COLAB_CONNECT_TIMEOUT', 10))
+COLAB_MAX_RETRIES = int(os.environ.get('COLAB_MAX_RETRIES', 2))
+COLAB_RETRY_BACKOFF = float(os.environ.get('COLAB_RETRY_BACKOFF', 0.5))
+COLAB_BREAKER_THRESHOLD = int(os.environ.get('COLAB_BREAKER_THRESHOLD', 5))
+COLAB_BREAKER_RESET = float(os.environ.get('COLAB_BREAKER_RESET', 30))
+
+# ngrok يرجع هذه الأكواد عندما يكون النفق أو Colab غير متاح
+RETRYABLE_STATUS = (502, 503, 504)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    closed → open بعد عدد من الفشل المتتالي
+    open → half_open بعد reset_timeout (طلب تجريبي واحد)
+    half_open → closed عند النجاح، أو open من جديد عند الفشل
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.short_circuited = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        with self._lock:
+            if self.state == "open":
+                return time.time() - self.opened_at >= self.reset_timeout
+            return not (self.state == "half_open" and self._trial_in_flight)
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    print(f"⚡ Circuit opened after {self.failures} failure(s)")
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def release_trial(self):
+        """
+        الطلب انتهى بدون نتيجة تخص الـ worker (خطأ محلي، رد غير مكتمل، إلغاء):
+        لا نجاح ولا فشل، لكن الطلب التجريبي لا يبقى محجوزاً وإلا يبقى الـ worker مقطوعاً للأبد
+        """
+        with self._lock:
+            if self.state == "half_open":
+                self._trial_in_flight = False
+
+    def snapshot(self):
+        with self._lock:
+            retry_in = None
+            if self.state == "open":
+                retry_in = round(max(0.0, self.reset_timeout - (time.time() - self.opened_at)), 1)
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "short_circuited": self.short_circuited,
+                "retry_in_seconds": retry_in,
+            }
+
+
+class ColabClient:
+    """
+    Session واحدة مشتركة لكل الطلبات إلى Colab workers.
+    - connection pooling بحجم COLAB_POOL_SIZE لكل worker
+    - retries مع backoff للطلبات idempotent فقط (/health, /convert)
+    - circuit breaker لكل worker: عند انقطاع النفق نرجع 503 فوراً
+    """
+
+    def __init__(self, pool_size, max_retries, backoff, breaker_threshold, breaker_reset):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "failures": 0}
+
+    def breaker(self, worker_id):
+        with self._lock:
+            breaker = self._breakers.get(worker_id)
+            if breaker is None:
+                breaker = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+                self._breakers[worker_id] = breaker
+            return breaker
+
+    def forget(self, worker_id):
+        with self._lock:
+            self._breakers.pop(worker_id, None)
+
+    def available(self, worker_id):
+        return self.breaker(worker_id).available()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def request(self, method, worker, path, idempotent=False, retries=None, timeout=30, **kwargs):
+        breaker = self.breaker(worker["worker_id"])
+        if not breaker.allow():
+            raise CircuitOpen(f"Colab worker {worker['worker_id']} is unavailable (circuit open)")
+
+        if not isinstance(timeout, tuple):
+            timeout = (min(COLAB_CONNECT_TIMEOUT, timeout), timeout)
+        attempts = 1 + ((self.max_retries if retries is None else retries) if idempotent else 0)
+        url = f"{worker['url']}{path}"
+        endpoint = _worker_endpoint(path)
+        trace = current_trace()
+        if trace is not None:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), TRACE_HEADER: trace.trace_id}
+
+        settled = False
+        try:
+            for attempt in range(attempts):
+                self._count("requests")
+                t0 = time.perf_counter()
+                try:
+                    with trace_span(f"colab {endpoint}"):
+                        response = self.session.request(method, url, timeout=timeout, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    timed_out = isinstance(e, requests.exceptions.Timeout)
+                    worker_request_seconds.observe(time.perf_counter() - t0, endpoint, "timeout" if timed_out else "error")
+                    if timed_out:
+                        worker_timeouts_total.inc(endpoint, type(e).__name__)
+                    # ReadTimeout لا يُعاد: الـ worker ربما ما زال يعالج الطلب
+                    retryable = not isinstance(e, requests.exceptions.ReadTimeout)
+                    if retryable and attempt + 1 < attempts:
+                        self._retry_sleep(attempt)
+                        continue
+                    self._count("failures")
+                    settled = True
+                    breaker.record_failure()
+                    if retryable:
+                        # النفق ربما انتهى: فحص فوري بدل انتظار الموعد التالي
+                        health_monitor.probe_soon(worker["worker_id"])
+                    raise
+
+                worker_request_seconds.observe(time.perf_counter() - t0, endpoint, str(response.status_code))
+                if response.status_code in RETRYABLE_STATUS:
+                    if attempt + 1 < attempts:
+                        response.close()
+                        self._retry_sleep(attempt)
+                        continue
+                    self._count("failures")
+                    settled = True
+                    breaker.record_failure()
+                    return response
+
+                settled = True
+                breaker.record_success()
+                return response
+        finally:
+            if not settled:
+                breaker.release_trial()
+
+    def _retry_sleep(self, attempt):
+        self._count("retries")
+        delay = min(self.backoff * (2 ** attempt), 10.0)
+        time.sleep(delay + random.uniform(0, delay / 2))
+
+    def get(self, worker, path, **kwargs):
+        return self.request('GET', worker, path, idempotent=True, **kwargs)
+
+    def post(self, worker, path, **kwargs):
+        return self.request('POST', worker, path, **kwargs)
+
+    def pool_stats(self):
+        hosts = []
+        try:
+            pools = self.adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                hosts.append({
+                    "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                    "connections_opened": pool.num_connections,
+                    "idle_connections": sum(1 for conn in list(pool.pool.queue) if conn) if pool.pool else 0,
+                })
+        except Exception as e:
+            print(f"⚠️ Could not read connection pool stats: {e}")
+        return hosts
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            breakers = dict(self._breakers)
+        return {
+            "pool_maxsize": self.pool_size,
+            "max_retries": self.max_retries,
+            "connect_timeout": COLAB_CONNECT_TIMEOUT,
+            "counters": counters,
+            "hosts": self.pool_stats(),
+            "breakers": {worker_id: b.snapshot() for worker_id, b in breakers.items()},
+        }
+
+
+colab_client = ColabClient(
+    COLAB_POOL_SIZE, COLAB_MAX_RETRIES, COLAB_RETRY_BACKOFF,
+    COLAB_BREAKER_THRESHOLD, COLAB_BREAKER_RESET,
+)
+
+# ============================================
+# Worker Pool (عدة Colab notebooks يسجلون عبر /api/register-colab)
+# ============================================
+WORKER_HEARTBEAT_TTL = int(os.environ.get('WORKER_HEARTBEAT_TTL', 180))
+WORKER_CAPABILITIES = ['convert', 'train', 'preprocess']
+
+
+class NoWorkerAvailable(Exception):
+    pass
+
+
+class WorkerPool:
+    """
+    سجل الـ workers: كل worker يسجل id + capacity + capabilities
+    وإعادة التسجيل تعمل كـ heartbeat.
+    الاختيار حسب أقل عدد طلبات جارية نسبةً إلى capacity.
+    """
+
+    def __init__(self, heartbeat_ttl):
+        self.heartbeat_ttl = heartbeat_ttl
+        self._workers = {}
+        self._lock = threading.Lock()
+
+    def register(self, url, worker_id=None, capacity=1, capabilities=None, ready=True):
+        url = url.rstrip('/')
+        worker_id = worker_id or urlparse(url).netloc or url
+        now = time.time()
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            is_new = worker is None
+            if is_new:
+                worker = {
+                    "worker_id": worker_id,
+                    "state": "active",
+                    "registered_at": datetime.now().isoformat(),
+                    "in_flight": 0,
+                    "completed": 0,
+                    "failed": 0,
+                }
+                self._workers[worker_id] = worker
+            # رابط جديد (نفق ngrok جديد): الحالة القديمة لا تنطبق عليه
+            url_changed = worker.get("url") != url
+            if url_changed:
+                worker["health"] = "unknown"
+            worker.update({
+                "url": url,
+                "capacity": max(1, int(capacity)),
+                "capabilities": list(capabilities or WORKER_CAPABILITIES),
+                "last_heartbeat": now,
+            })
+            became_ready = self._set_ready(worker, ready)
+            registered = dict(worker)
+        if url_changed:
+            health_monitor.track(worker_id, reset=True)
+        elif became_ready:
+            health_monitor.probe_soon(worker_id)
+        return registered, is_new
+
+    @staticmethod
+    def _set_ready(worker, ready):
+        """worker يسجل أثناء الـ prewarm بـ ready: false ولا يُرسل له شيء حتى يعلن جاهزيته"""
+        ready = bool(ready)
+        previous = worker.get("ready")
+        worker["ready"] = ready
+        if previous is not None and previous != ready:
+            print(f"🔥 Worker {worker['worker_id']}: " + ("ready" if ready else "warming up"))
+        return ready and previous is False
+
+    def set_ready(self, worker_id, ready):
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker:
+                self._set_ready(worker, ready)
+
+    def remove(self, worker_id):
+        with self._lock:
+            worker = self._workers.pop(worker_id, None)
+        colab_client.forget(worker_id)
+        health_monitor.forget(worker_id)
+        return worker
+
+    def clear(self):
+        with self._lock:
+            removed = list(self._workers.values())
+            self._workers.clear()
+        for worker in removed:
+            colab_client.forget(worker["worker_id"])
+            health_monitor.forget(worker["worker_id"])
+        return removed
+
+    def get(self, worker_id):
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            return dict(worker) if worker else None
+
+    def set_health(self, worker_id, health):
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker:
+                worker["health"] = health
+
+    def set_state(self, worker_id, state):
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker:
+                worker["state"] = state
+                return dict(worker)
+            return None
+
+    def _is_routable(self, worker, capability, now):
+        if worker["state"] != "active":
+            return False
+        if worker["health"] in HEALTH_DOWN_STATES:
+            return False
+        if not worker["ready"]:
+            return False
+        if capability and capability not in worker["capabilities"]:
+            return False
+        if self.heartbeat_ttl and now - worker["last_heartbeat"] > self.heartbeat_ttl:
+            return False
+        return True
+
+    def has_workers(self, capability=None):
+        now = time.time()
+        with self._lock:
+            return any(self._is_routable(w, capability, now) for w in self._workers.values())
+
+    def acquire(self, capability):
+        now = time.time()
+        with self._lock:
+            candidates = [w for w in self._workers.values() if self._is_routable(w, capability, now)]
+            if not candidates:
+                if any(w["health"] in HEALTH_DOWN_STATES for w in self._workers.values()):
+                    raise NoWorkerAvailable(f"All Colab workers for {capability} are down (health check failing)")
+                if any(not w["ready"] for w in self._workers.values()):
+                    raise NoWorkerAvailable(f"Colab workers for {capability} are still warming up")
+                raise NoWorkerAvailable(f"No Colab worker available for {capability}")
+            candidates = [w for w in candidates if colab_client.available(w["worker_id"])]
+            if not candidates:
+                raise CircuitOpen(f"All Colab workers for {capability} are unreachable (circuit open)")
+            worker = min(candidates, key=lambda w: (w["in_flight"] / w["capacity"], w["completed"]))
+            worker["in_flight"] += 1
+            return dict(worker)
+
+    def release(self, worker_id, ok=True):
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if not worker:
+                return
+            worker["in_flight"] = max(0, worker["in_flight"] - 1)
+            worker["completed" if ok else "failed"] += 1
+
+    @contextmanager
+    def lease(self, capability):
+        worker = self.acquire(capability)
+        ok = False
+        try:
+            yield worker
+            ok = True
+        finally:
+            self.release(worker["worker_id"], ok)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            workers = [dict(w) for w in self._workers.values()]
+        for w in workers:
+            w["seconds_since_heartbeat"] = round(now - w["last_heartbeat"], 1)
+            w["routable"] = self._is_routable(w, None, now)
+            w["circuit"] = colab_client.breaker(w["worker_id"]).snapshot()
+            w["health_check"] = health_monitor.snapshot(w["worker_id"])
+            w["last_heartbeat"] = datetime.fromtimestamp(w["last_heartbeat"]).isoformat()
+        return workers
+
+
+worker_pool = WorkerPool(WORKER_HEARTBEAT_TTL)
+
+# ============================================
+# Health Monitor (فحص /health في الخلفية بدل الفحص داخل الطلبات)
+# ============================================
+HEALTH_INTERVAL = float(os.environ.get('HEALTH_INTERVAL', 15))
+HEALTH_JITTER = float(os.environ.get('HEALTH_JITTER', 0.2))           # ± نسبة من الفترة حتى لا تتزامن الفحوصات
+HEALTH_TIMEOUT = float(os.environ.get('HEALTH_TIMEOUT', 5))
+HEALTH_MAX_INTERVAL = float(os.environ.get('HEALTH_MAX_INTERVAL', 60))  # backoff للـ worker المتوقف
+HEALTH_WINDOW = int(os.environ.get('HEALTH_WINDOW', 20))              # عدد الفحوصات في RTT / availability
+HEALTH_UNHEALTHY_AFTER = int(os.environ.get('HEALTH_UNHEALTHY_AFTER', 2))
+HEALTH_EXPIRE_AFTER = float(os.environ.get('HEALTH_EXPIRE_AFTER', 300))  # متوقف كل هذه المدة = النفق انتهى
+HEALTH_PROBE_WORKERS = int(os.environ.get('HEALTH_PROBE_WORKERS', 4))
+
+HEALTH_DOWN_STATES = ('unhealthy', 'expired')
+
+
+class HealthMonitor:
+    """
+    thread واحد يفحص /health لكل worker مسجل كل HEALTH_INTERVAL (مع jitter)،
+    ويحفظ آخر RTT و availability على آخر HEALTH_WINDOW فحص.
+    الحالة: unknown → healthy / unhealthy (بعد HEALTH_UNHEALTHY_AFTER فشل متتالي)
+    → expired (متوقف لمدة HEALTH_EXPIRE_AFTER). worker في unhealthy / expired لا يستقبل طلبات،
+    والفحص يستمر (بـ backoff) حتى يعود.
+    المسارات تقرأ الحالة المحفوظة فقط، بدون أي طلب شبكة.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._state = {}
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=HEALTH_PROBE_WORKERS, thread_name_prefix='health')
+        self.counters = {"probes": 0, "failures": 0, "transitions": 0}
+
+    @staticmethod
+    def _new_state():
+        return {
+            "status": "unknown",
+            "samples": deque(maxlen=HEALTH_WINDOW),
+            "consecutive_failures": 0,
+            "checked_at": None,
+            "last_ok_at": None,
+            "down_since": None,
+            "last_rtt_ms": None,
+            "last_health": None,
+            "last_error": None,
+            "last_error_kind": None,
+            "next_probe_at": 0,
+            "probing": False,
+        }
+
+    def _ensure_thread(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='health-monitor', daemon=True)
+            self._thread.start()
+
+    def track(self, worker_id, reset=False):
+        """worker جديد أو رابط جديد: الحالة تبدأ unknown وفحص فوري في الخلفية"""
+        with self._cond:
+            if reset or worker_id not in self._state:
+                self._state[worker_id] = self._new_state()
+            self._cond.notify_all()
+        self._ensure_thread()
+
+    def forget(self, worker_id):
+        with self._cond:
+            self._state.pop(worker_id, None)
+
+    def probe_soon(self, worker_id):
+        """إشارة من طلب فشل في الاتصال: لا ننتظر موعد الفحص التالي"""
+        with self._cond:
+            state = self._state.get(worker_id)
+            if state and not state["probing"]:
+                state["next_probe_at"] = 0
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                due = [wid for wid, st in self._state.items() if not st["probing"] and st["next_probe_at"] <= now]
+                if not due:
+                    next_at = min((st["next_probe_at"] for st in self._state.values() if not st["probing"]),
+                                  default=None)
+                    self._cond.wait(None if next_at is None else next_at - now)
+                    continue
+                for wid in due:
+                    self._state[wid]["probing"] = True
+            for wid in due:
+                self._executor.submit(self._probe_and_record, wid)
+
+    def _probe(self, worker):
+        """(ok, rtt_ms, health_json, error, error_kind) بدون circuit breaker: الفحص هو ما يكتشف العودة"""
+        t0 = time.perf_counter()
+        try:
+            response = colab_client.session.get(
+                f"{worker['url']}/health",
+                timeout=(min(COLAB_CONNECT_TIMEOUT, HEALTH_TIMEOUT), HEALTH_TIMEOUT),
+            )
+            rtt = time.perf_counter() - t0
+            worker_request_seconds.observe(rtt, '/health', str(response.status_code))
+            if response.status_code != 200:
+                return False, rtt * 1000, None, f"Colab health returned HTTP {response.status_code}", "http"
+            return True, rtt * 1000, response.json(), None, None
+        except requests.exceptions.Timeout:
+            worker_request_seconds.observe(time.perf_counter() - t0, '/health', "timeout")
+            return False, None, None, "Connection to Colab timed out", "timeout"
+        except requests.exceptions.ConnectionError as e:
+            worker_request_seconds.observe(time.perf_counter() - t0, '/health', "error")
+            return False, None, None, f"Cannot reach Colab. The ngrok tunnel may have expired. ({e})", "connection"
+        except ValueError:
+            return False, (time.perf_counter() - t0) * 1000, None, "Colab health is not JSON", "http"
+
+    def _probe_and_record(self, worker_id):
+        worker = worker_pool.get(worker_id)
+        if worker is None:
+            self.forget(worker_id)
+            return None
+        try:
+            result = self._probe(worker)
+        except Exception as e:
+            result = (False, None, None, str(e), "error")
+        return self._record(worker_id, *result)
+
+    def _record(self, worker_id, ok, rtt_ms, health, error, error_kind):
+        now = time.time()
+        with self._cond:
+            state = self._state.get(worker_id)
+            if state is None:
+                return None
+            self.counters["probes"] += 1
+            previous = state["status"]
+            state["probing"] = False
+            state["checked_at"] = now
+            state["samples"].append((ok, rtt_ms))
+            state["last_rtt_ms"] = round(rtt_ms, 1) if rtt_ms is not None else None
+            if ok:
+                state.update(status="healthy", consecutive_failures=0, last_ok_at=now, down_since=None,
+                             last_health=health, last_error=None, last_error_kind=None)
+                interval = HEALTH_INTERVAL
+            else:
+                self.counters["failures"] += 1
+                state["consecutive_failures"] += 1
+                state.update(last_error=error, last_error_kind=error_kind)
+                state["down_since"] = state["down_since"] or now
+                if now - state["down_since"] >= HEALTH_EXPIRE_AFTER:
+                    state["status"] = "expired"
+                elif state["consecutive_failures"] >= HEALTH_UNHEALTHY_AFTER:
+                    state["status"] = "unhealthy"
+                if state["consecutive_failures"] < HEALTH_UNHEALTHY_AFTER:
+                    # تأكيد سريع قبل إيقاف الـ worker
+                    interval = min(HEALTH_INTERVAL, 2.0)
+                else:
+                    interval = min(HEALTH_MAX_INTERVAL,
+                                   HEALTH_INTERVAL * 2 ** (state["consecutive_failures"] - HEALTH_UNHEALTHY_AFTER))
+            state["next_probe_at"] = now + interval * random.uniform(1 - HEALTH_JITTER, 1 + HEALTH_JITTER)
+            status = state["status"]
+            if status != previous:
+                self.counters["transitions"] += 1
+            self._cond.notify_all()
+
+        if ok and isinstance(health, dict) and "ready" in health:
+            worker_pool.set_ready(worker_id, health["ready"])
+        if status != previous:
+            worker_pool.set_health(worker_id, status)
+            icon = "💚" if status == "healthy" else "💔"
+            print(f"{icon} Worker {worker_id}: {previous} → {status}" + (f" ({error})" if error else ""))
+        return self.snapshot(worker_id)
+
+    def probe_now(self, worker_id):
+        """فحص متزامن (GET /api/test-colab-connection?fresh=1 أو worker لم يُفحص بعد)"""
+        with self._cond:
+            state = self._state.get(worker_id)
+            if state is None:
+                return None
+            state["probing"] = True
+        return self._probe_and_record(worker_id)
+
+    def snapshot(self, worker_id):
+        with self._cond:
+            state = self._state.get(worker_id)
+            if state is None:
+                return None
+            samples = list(state["samples"])
+            rtts = sorted(rtt for ok, rtt in samples if ok and rtt is not None)
+            now = time.time()
+            return {
+                "status": state["status"],
+                "consecutive_failures": state["consecutive_failures"],
+                "availability": round(sum(1 for ok, _ in samples if ok) / len(samples), 3) if samples else None,
+                "samples": len(samples),
+                "rtt_ms_last": state["last_rtt_ms"],
+                "rtt_ms_avg": round(sum(rtts) / len(rtts), 1) if rtts else None,
+                "rtt_ms_p95": round(rtts[min(len(rtts) - 1, int(len(rtts) * 0.95))], 1) if rtts else None,
+                "checked_at": datetime.fromtimestamp(state["checked_at"]).isoformat() if state["checked_at"] else None,
+                "age_seconds": round(now - state["checked_at"], 1) if state["checked_at"] else None,
+                "down_seconds": round(now - state["down_since"], 1) if state["down_since"] else None,
+                "next_probe_in_seconds": round(max(0.0, state["next_probe_at"] - now), 1),
+                "last_health": state["last_health"],
+                "last_error": state["last_error"],
+                "last_error_kind": state["last_error_kind"],
+            }
+
+    def stats(self):
+        with self._cond:
+            by_status = {}
+            for state in self._state.values():
+                by_status[state["status"]] = by_status.get(state["status"], 0) + 1
+            return {
+                "interval_seconds": HEALTH_INTERVAL,
+                "jitter": HEALTH_JITTER,
+                "timeout_seconds": HEALTH_TIMEOUT,
+                "unhealthy_after": HEALTH_UNHEALTHY_AFTER,
+                "expire_after_seconds": HEALTH_EXPIRE_AFTER,
+                "workers": by_status,
+                "running": bool(self._thread and self._thread.is_alive()),
+                **self.counters,
+            }
+
+
+health_monitor = HealthMonitor()
+
+
+# ============================================
+# Admission Control (حدود لكل مستخدم + حد عام + أولوية التحويل على التدريب)
+# ============================================
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', 16))
+ADMISSION_BACKGROUND_MAX = int(os.environ.get('ADMISSION_BACKGROUND_MAX', max(1, ADMISSION_MAX_CONCURRENT // 2)))
+ADMISSION_USER_MAX_CONCURRENT = int(os.environ.get('ADMISSION_USER_MAX_CONCURRENT', 2))      # الطلبات التفاعلية فقط
+ADMISSION_USER_BACKGROUND_MAX = int(os.environ.get('ADMISSION_USER_BACKGROUND_MAX', 1))      # مهام train / preprocess الجارية
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 200))
+ADMISSION_USER_MAX_QUEUED = int(os.environ.get('ADMISSION_USER_MAX_QUEUED', 10))
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 30))
+ADMISSION_USER_RATE = float(os.environ.get('ADMISSION_USER_RATE', 2))       # tokens/ثانية لكل مستخدم، 0 = بدون حد
+ADMISSION_USER_BURST = float(os.environ.get('ADMISSION_USER_BURST', 20))
+ADMISSION_GLOBAL_RATE = float(os.environ.get('ADMISSION_GLOBAL_RATE', 0))   # 0 = بدون حد عام
+ADMISSION_GLOBAL_BURST = float(os.environ.get('ADMISSION_GLOBAL_BURST', 200))
+ADMISSION_USER_MAX_JOBS = int(os.environ.get('ADMISSION_USER_MAX_JOBS', 3))  # مهام queued + running لكل مستخدم، 0 = بدون حد
+ADMISSION_MAX_USERS = 10000
+
+# الأقل = أولاً. التحويل تفاعلي، التدريب والمعالجة يمكن أن ينتظرا
+ADMISSION_PRIORITIES = {'convert': 0, 'preprocess': 1, 'train': 1}
+ADMISSION_COSTS = {'convert': 1, 'preprocess': 5, 'train': 10}
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def shortfall(self, cost, now):
+        """ثواني الانتظار حتى يتوفر cost (0 = متوفر الآن)"""
+        self._refill(now)
+        # طلب أكبر من burst (batch كبير) يُقبل عندما يمتلئ الـ bucket ويترك رصيداً سالباً
+        if self.tokens >= min(cost, self.burst):
+            return 0.0
+        return (min(cost, self.burst) - self.tokens) / self.rate
+
+    def take(self, cost):
+        self.tokens -= cost
+
+
+class AdmissionTicket:
+    def __init__(self, kind, user_key, ref=None, on_grant=None):
+        self.kind = kind
+        self.user_key = user_key
+        self.priority = ADMISSION_PRIORITIES.get(kind, 1)
+        self.ref = ref
+        self.on_grant = on_grant
+        self.granted = threading.Event()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.queue_position = 0
+        self.released = False
+        self.withdrawn = False
+
+    @property
+    def background(self):
+        return self.priority > 0
+
+    def wait_ms(self):
+        end = self.started_at or time.monotonic()
+        return round((end - self.enqueued_at) * 1000, 1)
+
+    def as_dict(self):
+        return {
+            "kind": self.kind,
+            "priority": self.priority,
+            "queue_position": self.queue_position,
+            "wait_ms": self.wait_ms(),
+        }
+
+
+class AdmissionController:
+    """
+    طبقة قبول أمام الـ worker pool:
+    - token bucket لكل مستخدم (+ اختيارياً bucket عام) حسب تكلفة نوع الطلب
+    - حد عام للطلبات الجارية، وحد لكل مستخدم، وحد منفصل للمهام الخلفية
+      حتى لا يحجز التدريب كل الأماكن. المهام الخلفية لا تُحسب ضمن حد المستخدم للتحويل
+      (لها حدها الخاص لكل مستخدم)، فالتدريب لا يمنع التحويل طوال مدته
+    - طابور أولوية: التحويل قبل التدريب، ثم الأقدم أولاً.
+      مستخدم وصل لحده لا يوقف من خلفه في الطابور
+    الطلب الذي لا يمكن قبوله يأخذ AdmissionRejected مع retry_after بدل الانتظار حتى timeout
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._global_bucket = TokenBucket(ADMISSION_GLOBAL_RATE, ADMISSION_GLOBAL_BURST) if ADMISSION_GLOBAL_RATE > 0 else None
+        self._waiting = []          # مرتبة حسب (priority, seq)
+        self._seq = itertools.count()
+        self._running = 0
+        self._running_background = 0
+        self._running_by_user = {}        # الطلبات التفاعلية
+        self._background_by_user = {}
+        self._queued_by_user = {}
+        self._avg_service = 1.0     # EWMA لمدة الطلب، لتقدير Retry-After
+        self._admitted = 0
+        self._rejected = 0
+
+    def _bucket(self, user_key):
+        bucket = self._buckets.get(user_key)
+        if bucket is None:
+            bucket = self._buckets[user_key] = TokenBucket(ADMISSION_USER_RATE, ADMISSION_USER_BURST)
+            if len(self._buckets) > ADMISSION_MAX_USERS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_key)
+        return bucket
+
+    def _reject(self, kind, message, retry_after, reason):
+        self._rejected += 1
+        admission_rejected_total.inc(kind, reason)
+        return AdmissionRejected(message, retry_after, reason)
+
+    def charge(self, kind, user_key, cost=None, dry_run=False):
+        """
+        يخصم تكلفة الطلب من bucket المستخدم (والعام). لا يخصم شيئاً إذا رُفض.
+        dry_run: نفس الرفض بدون خصم (قبل رفع ملف، والخصم الفعلي عند إنشاء المهمة)
+        """
+        cost = ADMISSION_COSTS.get(kind, 1) if cost is None else cost
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(user_key) if ADMISSION_USER_RATE > 0 else None
+            wait = bucket.shortfall(cost, now) if bucket else 0
+            if wait:
+                raise self._reject(kind, "Rate limit exceeded for this user", wait, "user_rate")
+            if self._global_bucket:
+                wait = self._global_bucket.shortfall(cost, now)
+                if wait:
+                    raise self._reject(kind, "Server is busy, please retry later", wait, "global_rate")
+            if dry_run:
+                return
+            if self._global_bucket:
+                self._global_bucket.take(cost)
+            if bucket:
+                bucket.take(cost)
+
+    def _can_run(self, ticket):
+        if self._running >= ADMISSION_MAX_CONCURRENT:
+            return False
+        if ticket.background:
+            return (self._running_background < ADMISSION_BACKGROUND_MAX
+                    and self._background_by_user.get(ticket.user_key, 0) < ADMISSION_USER_BACKGROUND_MAX)
+        return self._running_by_user.get(ticket.user_key, 0) < ADMISSION_USER_MAX_CONCURRENT
+
+    def _by_user(self, ticket):
+        return self._background_by_user if ticket.background else self._running_by_user
+
+    def _grant(self, ticket):
+        ticket.started_at = time.monotonic()
+        self._running += 1
+        if ticket.background:
+            self._running_background += 1
+        by_user = self._by_user(ticket)
+        by_user[ticket.user_key] = by_user.get(ticket.user_key, 0) + 1
+        self._admitted += 1
+        ticket.granted.set()
+        admission_wait_seconds.observe(ticket.started_at - ticket.enqueued_at, ticket.kind)
+        if ticket.on_grant:
+            ticket.on_grant()
+
+    def _unqueue(self, entry):
+        self._waiting.remove(entry)
+        ticket = entry[2]
+        left = self._queued_by_user[ticket.user_key] - 1
+        if left:
+            self._queued_by_user[ticket.user_key] = left
+        else:
+            del self._queued_by_user[ticket.user_key]
+
+    def _dispatch(self):
+        for entry in list(self._waiting):
+            if self._running >= ADMISSION_MAX_CONCURRENT:
+                break
+            if self._can_run(entry[2]):
+                self._unqueue(entry)
+                self._grant(entry[2])
+
+    def _estimate_wait(self, ahead):
+        return self._avg_service * (ahead + 1) / max(1, ADMISSION_MAX_CONCURRENT)
+
+    def _check_queue(self, kind, user_key):
+        if len(self._waiting) >= ADMISSION_MAX_QUEUE:
+            raise self._reject(kind, "Server is busy, please retry later",
+                               self._estimate_wait(len(self._waiting)), "queue_full")
+        if self._queued_by_user.get(user_key, 0) >= ADMISSION_USER_MAX_QUEUED:
+            raise self._reject(kind, "Too many queued requests for this user",
+                               self._estimate_wait(len(self._waiting)), "user_queue")
+
+    def enqueue(self, kind, user_key, ref=None, on_grant=None):
+        """يرجع ticket: إما مقبول مباشرة أو في الطابور (on_grant يُستدعى عند القبول)"""
+        ticket = AdmissionTicket(kind, user_key, ref, on_grant)
+        with self._lock:
+            # بعد كل _dispatch لا يوجد في الطابور طلب يمكن تشغيله، فلا أحد يسبقه هنا
+            if self._can_run(ticket):
+                self._grant(ticket)
+                return ticket
+            # المهام الخلفية محدودة أصلاً بعدد JOB_WORKERS، فالحدود هنا للطلبات التفاعلية
+            if not ticket.background:
+                self._check_queue(kind, user_key)
+            entry = (ticket.priority, next(self._seq), ticket)
+            position = bisect.bisect(self._waiting, entry[:2], key=lambda e: e[:2])
+            self._waiting.insert(position, entry)
+            self._queued_by_user[user_key] = self._queued_by_user.get(user_key, 0) + 1
+            ticket.queue_position = position + 1
+        return ticket
+
+    def _withdraw(self, ticket):
+        """يخرج من الطابور (داخل القفل). False إذا كان قد قُبل قبل ذلك"""
+        if ticket.granted.is_set():
+            return False
+        for entry in self._waiting:
+            if entry[2] is ticket:
+                self._unqueue(entry)
+                break
+        return True
+
+    def abandon(self, ticket):
+        """
+        انتهت مهلة الانتظار: يخرج من الطابور ويرجع AdmissionRejected.
+        إذا قُبل في نفس اللحظة يرجع None والطلب يكمل عادياً
+        """
+        with self._lock:
+            if not self._withdraw(ticket):
+                return None
+            ahead = len(self._waiting)
+            return self._reject(ticket.kind, "Server is busy, please retry later",
+                                self._estimate_wait(ahead), "timeout")
+
+    def withdraw(self, ref):
+        """
+        إلغاء مهمة تنتظر في الطابور (ref = job_id): تخرج منه و wait يرجع مباشرة مع withdrawn=True
+        بدل أن تحجز thread المهام حتى يأتي دورها. False إذا لم تكن تنتظر
+        """
+        with self._lock:
+            for entry in self._waiting:
+                ticket = entry[2]
+                if ticket.ref == ref:
+                    self._unqueue(entry)
+                    ticket.withdrawn = ticket.released = True
+                    ticket.granted.set()
+                    return True
+        return False
+
+    def wait(self, ticket, timeout=ADMISSION_MAX_WAIT):
+        if ticket.granted.wait(timeout):
+            return ticket
+        error = self.abandon(ticket)
+        if error:
+            raise error
+        return ticket
+
+    def acquire(self, kind, user_key, timeout=ADMISSION_MAX_WAIT, ref=None):
+        with trace_span("admission"):
+            return self.wait(self.enqueue(kind, user_key, ref), timeout)
+
+    def release(self, ticket):
+        """نهاية الطلب (أو إلغاؤه وهو في الطابور). استدعاؤه مرتين لا يغير شيئاً"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if self._withdraw(ticket):
+                return
+            duration = time.monotonic() - ticket.started_at
+            self._running -= 1
+            if ticket.background:
+                self._running_background -= 1
+            by_user = self._by_user(ticket)
+            left = by_user[ticket.user_key] - 1
+            if left:
+                by_user[ticket.user_key] = left
+            else:
+                del by_user[ticket.user_key]
+            if not ticket.background:
+                self._avg_service = 0.9 * self._avg_service + 0.1 * duration
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, kind, user_key, timeout=ADMISSION_MAX_WAIT):
+        """مكان جارٍ حتى نهاية الـ block (charge يُستدعى قبله في الـ route)"""
+        ticket = self.acquire(kind, user_key, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def position(self, ref):
+        with self._lock:
+            for index, entry in enumerate(self._waiting):
+                if entry[2].ref == ref:
+                    return index + 1
+        return None
+
+    def stats(self):
+        with self._lock:
+            waiting = [entry[2] for entry in self._waiting]
+            return {
+                "running": self._running,
+                "running_background": self._running_background,
+                "waiting": len(waiting),
+                "waiting_by_kind": {kind: sum(1 for t in waiting if t.kind == kind)
+                                    for kind in ADMISSION_PRIORITIES},
+                "oldest_wait_ms": max((t.wait_ms() for t in waiting), default=0),
+                "users_running": len(self._running_by_user.keys() | self._background_by_user.keys()),
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "avg_service_seconds": round(self._avg_service, 3),
+                "limits": {
+                    "max_concurrent": ADMISSION_MAX_CONCURRENT,
+                    "background_max": ADMISSION_BACKGROUND_MAX,
+                    "user_max_concurrent": ADMISSION_USER_MAX_CONCURRENT,
+                    "user_background_max": ADMISSION_USER_BACKGROUND_MAX,
+                    "max_queue": ADMISSION_MAX_QUEUE,
+                    "user_max_queued": ADMISSION_USER_MAX_QUEUED,
+                    "max_wait_seconds": ADMISSION_MAX_WAIT,
+                    "user_rate": ADMISSION_USER_RATE,
+                    "user_burst": ADMISSION_USER_BURST,
+                    "global_rate": ADMISSION_GLOBAL_RATE,
+                    "user_max_jobs": ADMISSION_USER_MAX_JOBS,
+                },
+            }
+
+
+admission = AdmissionController()
+
+
+def client_address(forwarded_for, remote_addr):
+    """نفس اختيار ProxyFix: العنوان رقم TRUSTED_PROXY_HOPS من آخر X-Forwarded-For (ما أضافه الـ proxy)"""
+    values = [value.strip() for value in (forwarded_for or '').split(',') if value.strip()]
+    if TRUSTED_PROXY_HOPS and len(values) >= TRUSTED_PROXY_HOPS:
+        return values[-TRUSTED_PROXY_HOPS]
+    return remote_addr
+
+
+def admission_key(user_id):
+    """الطلبات بدون user_id تُحسب حسب IP العميل (بعد ProxyFix) حتى لا تتشارك كلها نفس الحد"""
+    return str(user_id) if user_id else f"ip:{request.remote_addr}"
+
+
+def _admission_response(e):
+    return jsonify({
+        "success": False,
+        "error": str(e),
+        "reason": e.reason,
+        "retry_after": e.retry_after,
+    }), 429, {'Retry-After': str(e.retry_after)}
+
+
+# ============================================
+# Job Queue (preprocess / train تعمل في الخلفية بدل حجز worker)
+# ============================================
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', 'jobs.db')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 50))
+JOBS_FIRESTORE_MIRROR = os.environ.get('JOBS_FIRESTORE_MIRROR', '0') == '1'
+
+JOB_FINAL_STATES = ('succeeded', 'failed', 'cancelled')
+JOB_RETRY_AFTER = int(os.environ.get('JOB_RETRY_AFTER', 60))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 120))  # مهمة running بدون تجديد خلالها ترجع للانتظار
+
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+_job_handlers = {}
+_job_owner = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+@contextmanager
+def _jobs_db():
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def init_jobs_db():
+    with _jobs_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id               TEXT PRIMARY KEY,
+                kind             TEXT NOT NULL,
+                user_id          TEXT,
+                state            TEXT NOT NULL,
+                progress         REAL NOT NULL DEFAULT 0,
+                payload          TEXT,
+                result           TEXT,
+                error            TEXT,
+                owner            TEXT,
+                attempts         INTEGER NOT NULL DEFAULT 0,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created_at       TEXT NOT NULL,
+                updated_at       TEXT NOT NULL,
+                lease_expires_at REAL
+            )
+        """)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "lease_expires_at" not in columns:
+            try:
+                conn.execute("ALTER TABLE jobs ADD COLUMN lease_expires_at REAL")
+            except sqlite3.OperationalError:
+                pass  # عملية أخرى أضافته في نفس اللحظة
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs(user_id, created_at)")
+
+
+def _job_to_dict(row, include_payload=False):
+    job = {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "user_id": row["user_id"],
+        "state": row["state"],
+        "progress": row["progress"],
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "attempts": row["attempts"],
+        "cancel_requested": bool(row["cancel_requested"]),
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+    if include_payload:
+        job["payload"] = json.loads(row["payload"]) if row["payload"] else None
+    return job
+
+
+def _mirror_job(job_id):
+    """نسخة اختيارية من حالة المهمة في Firestore (بدون payload)"""
+    if not (db and JOBS_FIRESTORE_MIRROR):
+        return
+    try:
+        job = get_job(job_id)
+        if job:
+            persist_queue.set(f"gateway_jobs/{job_id}", job, merge=True)
+    except Exception as e:
+        print(f"⚠️ Could not mirror job {job_id}: {e}")
+
+
+def create_job(kind, user_id, payload, user_key=None):
+    """
+    user_key: حد المعدل الذي يُخصم منه (admission_key). الخصم بعد نجاح كل الفحوص،
+    فالطلب الذي يُرفض بـ JobQueueFull أو user_jobs لا يخسر tokens
+    """
+    now = datetime.now().isoformat()
+    job_id = uuid.uuid4().hex
+    with _jobs_db() as conn:
+        pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+        if pending >= JOB_MAX_PENDING:
+            raise JobQueueFull(f"Job queue is full ({pending} pending)")
+        if user_id and ADMISSION_USER_MAX_JOBS:
+            active = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND state IN ('queued', 'running')", (user_id,)
+            ).fetchone()[0]
+            if active >= ADMISSION_USER_MAX_JOBS:
+                admission_rejected_total.inc(kind, "user_jobs")
+                raise AdmissionRejected(f"Too many active jobs for this user ({active})",
+                                        JOB_RETRY_AFTER, "user_jobs")
+        if user_key is not None:
+            admission.charge(kind, user_key)
+        conn.execute(
+            "INSERT INTO jobs (id, kind, user_id, state, payload, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, kind, user_id, json.dumps(payload), now, now),
+        )
+    _mirror_job(job_id)
+    return job_id
+
+
+def get_job(job_id, include_payload=False):
+    with _jobs_db() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_to_dict(row, include_payload) if row else None
+
+
+def job_queue_position(job_id):
+    """ترتيب المهمة بين المهام المنتظرة (1 = التالية)، أو None إذا لم تعد منتظرة"""
+    with _jobs_db() as conn:
+        row = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND created_at <= "
+            "(SELECT created_at FROM jobs WHERE id = ? AND state = 'queued')",
+            (job_id,),
+        ).fetchone()
+    return row[0] or None
+
+
+def list_jobs(user_id=None, state=None, limit=50):
+    query, args = "SELECT * FROM jobs WHERE 1 = 1", []
+    if user_id:
+        query += " AND user_id = ?"
+        args.append(user_id)
+    if state:
+        query += " AND state = ?"
+        args.append(state)
+    query += " ORDER BY created_at DESC LIMIT ?"
+    args.append(limit)
+    with _jobs_db() as conn:
+        rows = conn.execute(query, args).fetchall()
+    return [_job_to_dict(row) for row in rows]
+
+
+def update_job(job_id, **fields):
+    if "result" in fields:
+        fields["result"] = json.dumps(fields["result"])
+    fields["updated_at"] = datetime.now().isoformat()
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    with _jobs_db() as conn:
+        conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+    _mirror_job(job_id)
+
+
+def claim_job(job_id):
+    """يحجز المهمة لهذه العملية فقط (آمن مع عدة gunicorn workers)"""
+    with _jobs_db() as conn:
+        cur = conn.execute(
+            "UPDATE jobs SET state = 'running', owner = ?, attempts = attempts + 1, updated_at = ?, "
+            "lease_expires_at = ? WHERE id = ? AND state = 'queued'",
+            (_job_owner, datetime.now().isoformat(), time.time() + JOB_LEASE_SECONDS, job_id),
+        )
+    return cur.rowcount == 1
+
+
+def cancel_job(job_id):
+    """
+    المهام في الانتظار تُلغى مباشرة.
+    المهام الجارية لا يمكن إيقافها في Colab، لذلك نتجاهل نتيجتها عند الوصول.
+    """
+    now = datetime.now().isoformat()
+    with _jobs_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET state = 'cancelled', updated_at = ? WHERE id = ? AND state = 'queued'",
+            (now, job_id),
+        )
+        conn.execute(
+            "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ? AND state = 'running'",
+            (now, job_id),
+        )
+    # الـ thread الذي ينتظر دورها في طابور القبول يتحرر الآن بدل أن يبقى محجوزاً حتى تُقبل
+    admission.withdraw(job_id)
+    _mirror_job(job_id)
+    return get_job(job_id)
+
+
+def job_cancel_requested(job_id):
+    job = get_job(job_id)
+    return job is None or job["cancel_requested"]
+
+
+def submit_job(job_id):
+    _job_executor.submit(_run_traced_job, job_id)
+
+
+def _run_job(job_id):
+    job = get_job(job_id)
+    if not job or job["state"] != 'queued':
+        return
+    # المهمة تبقى queued (ويمكن إلغاؤها) حتى تسمح طبقة القبول، والتحويل له الأولوية
+    ticket = admission.enqueue(job["kind"], job["user_id"] or f"job:{job_id}", ref=job_id)
+    if get_job(job_id)["state"] != 'queued':
+        admission.release(ticket)  # أُلغيت قبل دخول الطابور
+        return
+    with trace_span("admission"):
+        admission.wait(ticket, timeout=None)
+    if ticket.withdrawn:
+        return  # أُلغيت وهي في طابور القبول
+    try:
+        _execute_job(job_id)
+    finally:
+        admission.release(ticket)
+
+
+def _execute_job(job_id):
+    if not claim_job(job_id):
+        return
+    job = get_job(job_id, include_payload=True)
+    handler = _job_handlers[job["kind"]]
+    print(f"⚙️ Job {job_id} ({job['kind']}) started")
+
+    try:
+        update_job(job_id, progress=0.1)
+        with job_leases.hold(job_id):
+            result = handler(job_id, job["payload"])
+    except (NoWorkerAvailable, CircuitOpen) as e:
+        update_job(job_id, state='failed', error=str(e))
+        return
+    except requests.exceptions.Timeout:
+        update_job(job_id, state='failed', error="Colab timed out")
+        return
+    except requests.exceptions.ConnectionError:
+        update_job(job_id, state='failed', error="Cannot connect to Colab")
+        return
+    except Exception as e:
+        import traceback; traceback.print_exc()
+        update_job(job_id, state='failed', error=str(e))
+        return
+
+    if job_cancel_requested(job_id):
+        state = 'cancelled'
+    else:
+        state = 'succeeded' if result.get("success") else 'failed'
+    update_job(job_id, state=state, progress=1.0, result=result,
+               error=None if state != 'failed' else result.get("error"))
+    print(f"✅ Job {job_id} finished: {state}")
+
+
+def _run_traced_job(job_id):
+    """نفس _run_job مع trace باسم المهمة (job_id هو trace id المرسل إلى Colab)"""
+    trace = _trace_local.trace = Trace(job_id, "job")
+    try:
+        _run_job(job_id)
+    finally:
+        _trace_local.trace = None
+        job = get_job(job_id)
+        if job and trace.spans:
+            trace.name = f"job:{job['kind']}"
+            _write_trace(trace, None, job["state"])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobLeases:
+    """
+    كل مهمة running لها lease_expires_at تجدده العملية التي تنفذها كل JOB_LEASE_SECONDS / 4.
+    lease منتهٍ = العملية ماتت أو السيرفر انتقل إلى host آخر: المهمة ترجع للانتظار وتُنفذ من جديد
+    بدل أن تبقى running للأبد (وتُحسب ضمن ADMISSION_USER_MAX_JOBS).
+    كل عملية تفحص الـ leases المنتهية، و UPDATE المشروط يضمن أن عملية واحدة فقط تعيدها.
+    """
+
+    def __init__(self, lease_seconds):
+        self.lease_seconds = lease_seconds
+        self._held = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @contextmanager
+    def hold(self, job_id):
+        with self._lock:
+            self._held.add(job_id)
+        self.start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held.discard(job_id)
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='job-leases', daemon=True)
+            self._thread.start()
+
+    def renew(self):
+        with self._lock:
+            held = list(self._held)
+        if not held:
+            return
+        with _jobs_db() as conn:
+            conn.execute(
+                f"UPDATE jobs SET lease_expires_at = ? WHERE state = 'running' "
+                f"AND id IN ({', '.join('?' * len(held))})",
+                (time.time() + self.lease_seconds, *held),
+            )
+
+    def reap(self):
+        """المهام running التي انتهى الـ lease الخاص بها → queued. يرجع ids التي أعادتها هذه العملية"""
+        now = time.time()
+        requeued = []
+        with _jobs_db() as conn:
+            # lease_expires_at فارغ = مهمة من قبل الـ leases
+            expired = conn.execute(
+                "SELECT id FROM jobs WHERE state = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < ?)",
+                (now,),
+            ).fetchall()
+            for row in expired:
+                cur = conn.execute(
+                    "UPDATE jobs SET state = 'queued', owner = NULL, lease_expires_at = NULL, updated_at = ? "
+                    "WHERE id = ? AND state = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < ?)",
+                    (datetime.now().isoformat(), row["id"], now),
+                )
+                if cur.rowcount:
+                    requeued.append(row["id"])
+        return requeued
+
+    def _run(self):
+        while True:
+            time.sleep(self.lease_seconds / 4)
+            try:
+                self.renew()
+                for job_id in self.reap():
+                    print(f"♻️ Job {job_id} lease expired, re-queued")
+                    _mirror_job(job_id)
+                    submit_job(job_id)
+            except Exception as e:
+                print(f"⚠️ Job lease error: {e}")
+
+
+job_leases = JobLeases(JOB_LEASE_SECONDS)
+
+
+def recover_jobs():
+    """
+    بعد إعادة تشغيل السيرفر: المهام الجارية التي ماتت عمليتها (أو انتهى الـ lease الخاص بها) ترجع للانتظار،
+    ثم يتم إرسال كل المهام المنتظرة للتنفيذ.
+    """
+    host = socket.gethostname()
+    with _jobs_db() as conn:
+        running = conn.execute("SELECT id, owner FROM jobs WHERE state = 'running'").fetchall()
+        for row in running:
+            # نفس الـ host والعملية لم تعد موجودة: لا داعي لانتظار انتهاء الـ lease
+            owner_host, _, owner_pid = (row["owner"] or "").rpartition(":")
+            if owner_host != host or not owner_pid.isdigit():
+                continue
+            if int(owner_pid) != os.getpid() and _pid_alive(int(owner_pid)):
+                continue
+            conn.execute(
+                "UPDATE jobs SET state = 'queued', owner = NULL, lease_expires_at = NULL, updated_at = ? "
+                "WHERE id = ? AND state = 'running'",
+                (datetime.now().isoformat(), row["id"]),
+            )
+    job_leases.reap()
+    with _jobs_db() as conn:
+        queued = conn.execute(
+            "SELECT id FROM jobs WHERE state = 'queued' ORDER BY created_at"
+        ).fetchall()
+
+    for row in queued:
+        submit_job(row["id"])
+    if queued:
+        print(f"♻️ Recovered {len(queued)} queued job(s)")
+    job_leases.start()
+
+
+try:
+    init_jobs_db()
+except Exception as e:
+    print(f"❌ Job store initialization error: {e}")
+
+# ============================================
+# Blob Store (ملفات الصوت على القرص حسب sha256 بدل base64 داخل JSON و Firestore)
+# ============================================
+BLOB_DIR = os.environ.get('BLOB_DIR', 'blobs')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 200 * 1024 * 1024))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class BlobStore:
+    """
+    content-addressed: الملف يُكتب على دفعات في ملف مؤقت مع حساب sha256،
+    ثم يُنقل إلى blobs/<ab>/<sha256>. نفس المحتوى يُخزن مرة واحدة فقط.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put_stream(self, stream, max_bytes=UPLOAD_MAX_BYTES):
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+                    hasher.update(chunk)
+                    tmp.write(chunk)
+            digest = hasher.hexdigest()
+            final_path = self.path(digest)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            if os.path.exists(final_path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, final_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return {"sha256": digest, "size": size}
+
+    def put_bytes(self, data):
+        return self.put_stream(io.BytesIO(data), max_bytes=None)
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+
+blob_store = BlobStore(BLOB_DIR)
+
+# ============================================
+# Binary Transport (الصوت كـ bytes بين السيرفر و Colab بدل روابط / base64 داخل JSON)
+#   RVCF | version (1 byte) | طول الـ header (4 bytes big-endian) | header JSON | الصوت حتى نهاية الـ body
+# ============================================
+FRAME_CONTENT_TYPE = 'application/x-rvc-frame'
+FRAME_MAGIC = b'RVCF'
+FRAME_VERSION = 1
+FRAME_MAX_HEADER = 1024 * 1024
+BINARY_TUNNEL_ENCODING = os.environ.get('BINARY_TUNNEL_ENCODING', 'flac')  # flac | wav
+BINARY_COMPRESS_INPUT = os.environ.get('BINARY_COMPRESS_INPUT', '1') == '1'
+AUDIO_MIMETYPES = {"flac": "audio/flac", "wav": "audio/wav"}
+AUDIO_ENCODINGS = {
+    "audio/wav": "wav", "audio/x-wav": "wav", "audio/wave": "wav", "audio/flac": "flac", "audio/x-flac": "flac",
+    "audio/mpeg": "mp3", "audio/mp3": "mp3", "audio/ogg": "ogg", "audio/mp4": "m4a", "audio/aac": "aac",
+}
+
+try:
+    import soundfile as sf  # اختياري: بدونه يمر الصوت كما هو بدون flac
+except ImportError:
+    sf = None
+
+
+class FrameBody:
+    """
+    body الطلب إلى Colab: prefix + الملف على دفعات.
+    __len__ حتى يرسل requests الـ Content-Length بدل chunked
+    """
+
+    def __init__(self, header, audio=None, size=0):
+        self._prefix = io.BytesIO(frame_prefix(header))
+        self._audio = audio
+        self._len = len(self._prefix.getvalue()) + size
+
+    def __len__(self):
+        return self._len
+
+    def read(self, size=-1):
+        chunk = self._prefix.read(size)
+        if not chunk and self._audio is not None:
+            chunk = self._audio.read(size)
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def frame_prefix(header):
+    raw = json.dumps(header, ensure_ascii=False, default=str).encode()
+    return FRAME_MAGIC + bytes([FRAME_VERSION]) + len(raw).to_bytes(4, 'big') + raw
+
+
+def parse_frame(data):
+    """رد Colab كاملاً → (header, audio bytes)"""
+    if len(data) < 9 or data[:4] != FRAME_MAGIC:
+        raise ValueError("Not an RVC frame")
+    if data[4] != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {data[4]}")
+    size = int.from_bytes(data[5:9], 'big')
+    if size > FRAME_MAX_HEADER or len(data) < 9 + size:
+        raise ValueError("Truncated frame")
+    return json.loads(data[9:9 + size]), data[9 + size:]
+
+
+def audio_encoding(content_type, filename=None):
+    """الصيغة من الـ Content-Type ثم من امتداد الملف"""
+    encoding = AUDIO_ENCODINGS.get(content_type or '')
+    if encoding is None and filename and '.' in filename:
+        encoding = filename.rsplit('.', 1)[1].lower()
+    return encoding or 'wav'
+
+
+@contextmanager
+def open_upload_audio(blob, encoding):
+    """
+    الملف المرفوع كما سيُرسل إلى Colab → (file, size, encoding).
+    WAV بـ PCM_16 / PCM_24 يُضغط flac بدون فقد (≈ نصف الحجم عبر النفق) إذا كان soundfile متاحاً
+    """
+    path = blob_store.path(blob['sha256'])
+    if sf is not None and BINARY_COMPRESS_INPUT and encoding == 'wav':
+        try:
+            info = sf.info(path)
+            if info.subtype in ('PCM_16', 'PCM_24'):
+                with trace_span("compress_input"):
+                    audio, sr = sf.read(path, dtype='int32' if info.subtype == 'PCM_24' else 'int16')
+                    buf = io.BytesIO()
+                    sf.write(buf, audio, sr, format='FLAC', subtype=info.subtype)
+                size = buf.tell()
+                buf.seek(0)
+                yield buf, size, 'flac'
+                return
+        except RuntimeError as e:
+            print(f"⚠️ FLAC compression skipped: {e}")
+
+    with blob_store.open(blob['sha256']) as f:
+        yield f, blob['size'], encoding
+
+
+def flac_to_wav(payload):
+    """flac القادم من Colab → wav للعميل (بدون فقد)"""
+    with trace_span("transcode_output"):
+        subtype = sf.info(io.BytesIO(payload)).subtype
+        audio, sr = sf.read(io.BytesIO(payload), dtype='int32')
+        buf = io.BytesIO()
+        sf.write(buf, audio, sr, format='WAV', subtype=subtype)
+    return buf.getvalue()
+
+# ============================================
+# Voice Cache (model_path / index_path لكل صوت بدل قراءة Firestore في كل convert)
+# ============================================
+VOICE_CACHE_SIZE = int(os.environ.get('VOICE_CACHE_SIZE', 1024))
+VOICE_CACHE_TTL = float(os.environ.get('VOICE_CACHE_TTL', 300))
+VOICE_CACHE_NEGATIVE_TTL = float(os.environ.get('VOICE_CACHE_NEGATIVE_TTL', 60))
+VOICE_CACHE_WATCH = os.environ.get('VOICE_CACHE_WATCH', '0') == '1'
+
+RVC_ROOT = '/content/RVC/RVC1006AMD_Intel1'
+
+
+def default_voice_paths(voice_name):
+    return f'{RVC_ROOT}/assets/weights/{voice_name}.pth', f'{RVC_ROOT}/logs/{voice_name}'
+
+
+class VoiceCache:
+    """
+    TTL + LRU cache للمفتاح (voice_name, user_id).
+    الأصوات غير الموجودة (المسار الافتراضي) تُخزن كـ negative entries بـ TTL أقصر.
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "negative_hits": 0, "misses": 0,
+                         "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return False, None
+            expires_at, value, negative = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self.counters["expired"] += 1
+                self.counters["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.counters["negative_hits" if negative else "hits"] += 1
+            return True, value
+
+    def peek(self, key):
+        """مثل get بدون عدادات ولا ترتيب LRU → (hit, value, negative)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() >= entry[0]:
+                return False, None, False
+            return True, entry[1], entry[2]
+
+    def put(self, key, value, negative=False):
+        ttl = self.negative_ttl if negative else self.ttl
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value, negative)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self, voice_name=None):
+        """حذف كل الإدخالات لصوت معيّن (لكل المستخدمين)، أو الكل"""
+        with self._lock:
+            if voice_name is None:
+                keys = list(self._entries)
+            else:
+                keys = [k for k in self._entries if k[0] == voice_name]
+            for key in keys:
+                del self._entries[key]
+            self.counters["invalidations"] += len(keys)
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["negative_hits"] + counters["misses"]
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "negative_ttl": self.negative_ttl,
+            "watching": VOICE_CACHE_WATCH,
+            "hit_rate": round((counters["hits"] + counters["negative_hits"]) / lookups, 4) if lookups else None,
+            **counters,
+        }
+
+
+voice_cache = VoiceCache(VOICE_CACHE_SIZE, VOICE_CACHE_TTL, VOICE_CACHE_NEGATIVE_TTL)
+
+
+def lookup_voice_paths(client, voice_name, user_id):
+    """
+    البحث في Firestore عن مسار النموذج
+    يرجع (model_path, index_path, found)
+    """
+    # البحث في training_voices (الأصوات المشتركة)
+    voice_docs = client.collection('training_voices')\
+                       .where('voiceName', '==', voice_name)\
+                       .limit(1)\
+                       .get()
+
+    if voice_docs:
+        voice_data = voice_docs[0].to_dict()
+        print(f"✅ Found in training_voices: {voice_name}")
+        return voice_data.get('modelPath'), voice_data.get('indexPath', ''), True
+
+    # إذا لم يوجد في training_voices، ابحث في الأصوات المخصصة للمستخدم
+    custom_voice = client.collection('exp_dir')\
+                         .document(user_id)\
+                         .collection('voices')\
+                         .document(voice_name)\
+                         .get()
+
+    if custom_voice.exists:
+        custom_data = custom_voice.to_dict()
+        exp_dir = custom_data.get('exp_dir', voice_name)
+        print(f"✅ Found in user voices: {voice_name}")
+        return (*default_voice_paths(exp_dir), True)
+
+    # صوت افتراضي
+    print(f"ℹ️ Using default path: {voice_name}")
+    return (*default_voice_paths(voice_name), False)
+
+
+def resolve_voice(voice_name, user_id):
+    """مسار النموذج من الـ cache أو من Firestore"""
+    if not db:
+        # إذا لم يكن Firebase متصل
+        return default_voice_paths(voice_name)
+
+    key = (voice_name, user_id or '')
+    hit, value = voice_cache.get(key)
+    if hit:
+        return value
+
+    try:
+        with firestore_seconds.time("voice_lookup"):
+            model_path, index_path, found = lookup_voice_paths(db, voice_name, user_id)
+    except Exception as db_error:
+        firestore_errors_total.inc("voice_lookup")
+        # لا نخزن الأخطاء المؤقتة، نستخدم المسار الافتراضي فقط
+        print(f"⚠️ Firestore error: {db_error}")
+        return default_voice_paths(voice_name)
+
+    voice_cache.put(key, (model_path, index_path), negative=not found)
+    return model_path, index_path
+
+
+def start_voice_cache_watch(client):
+    """
+    (اختياري) مستمع Firestore: أي تغيير في training_voices أو exp_dir/*/voices
+    يحذف الصوت من الـ cache مباشرة بدل انتظار TTL
+    """
+    def on_training_voices(col_snapshot, changes, read_time):
+        for change in changes:
+            voice_cache.invalidate((change.document.to_dict() or {}).get('voiceName'))
+
+    def on_user_voices(col_snapshot, changes, read_time):
+        for change in changes:
+            voice_cache.invalidate(change.document.id)
+
+    watches = [
+        client.collection('training_voices').on_snapshot(on_training_voices),
+        client.collection_group('voices').on_snapshot(on_user_voices),
+    ]
+    print("👀 Voice cache is watching Firestore for changes")
+    return watches
+
+
+_voice_cache_watches = []
+if db and VOICE_CACHE_WATCH:
+    try:
+        _voice_cache_watches = start_voice_cache_watch(db)
+    except Exception as e:
+        print(f"⚠️ Could not start voice cache watch: {e}")
+
+# ============================================
+# Single-flight (طلبات convert المتطابقة المتزامنة تنفذ مرة واحدة في Colab)
+# ============================================
+COALESCE_CONVERT = os.environ.get('COALESCE_CONVERT', '1') == '1'
+
+
+def convert_fingerprint(payload):
+    """
+    بصمة الطلب بعد resolve: مسار النموذج + مرجع الصوت + كل المعاملات.
+    أي اختلاف (حتى user_id) يعطي بصمة مختلفة
+    """
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+        self.task = None  # وضع ASGI: الـ asyncio task التي تنفذ الطلب
+
+
+class SingleFlight:
+    """
+    أول طلب بمفتاح معين (leader) ينفذ الدالة، والطلبات المتطابقة التي تصل أثناء
+    تنفيذها (followers) تنتظر نفس النتيجة أو نفس الخطأ بدل تنفيذ جديد.
+    لا يوجد cache: بعد انتهاء الطلب الأول، الطلب التالي ينفذ من جديد
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._leaders = 0
+        self._coalesced = 0
+
+    def join(self, key):
+        """(flight, leader): leader=True يعني أن المستدعي هو من ينفذ ويجب أن يستدعي finish"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._leaders += 1
+            else:
+                flight.followers += 1
+                self._coalesced += 1
+        singleflight_total.inc(self.name, "leader" if leader else "follower")
+        return flight, leader
+
+    def finish(self, key, flight, result=None, error=None):
+        flight.result, flight.error = result, error
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.done.set()
+
+    def do(self, key, fn):
+        """يرجع (result, shared) حيث shared=True إذا جاءت النتيجة من طلب آخر"""
+        flight, leader = self.join(key)
+        if not leader:
+            with trace_span(f"{self.name} coalesced"):
+                flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, flight, error=e)
+            raise
+        self.finish(key, flight, result)
+        return result, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "waiting_followers": sum(f.followers for f in self._flights.values()),
+                "leaders": self._leaders,
+                "coalesced": self._coalesced,
+            }
+
+
+convert_flight = SingleFlight("convert")
+
+
+# ============================================
+# Main Routes
+# ============================================
+
+@app.route('/')
+def home():
+    """الصفحة الرئيسية - معلومات عن السيرفر"""
+    workers = worker_pool.snapshot()
+    return jsonify({
+        "message": "RVC API Server is running (Python/Flask)",
+        "status": "active",
+        "colab_connected": worker_pool.has_workers(),
+        "colab_url": workers[0]["url"] if workers else None,
+        "colab_registered_at": workers[0]["registered_at"] if workers else None,
+        "colab_workers": len(workers),
+        "firebase_connected": db is not None,
+        "timestamp": datetime.now().isoformat(),
+        "endpoints": {
+            "health": "/health",
+            "register_colab": "/api/register-colab (POST)",
+            "colab_status": "/api/colab-status (GET)",
+            "test_colab": "/api/test-colab-connection (GET, ?fresh=1 to probe now)",
+            "drain_worker": "/api/workers/<worker_id>/drain (POST)",
+            "resume_worker": "/api/workers/<worker_id>/resume (POST)",
+            "remove_worker": "/api/workers/<worker_id> (DELETE)",
+            "preprocess": "/api/preprocess (POST)",
+            "preprocess_upload": "/api/preprocess/upload (POST, multipart or octet-stream)",
+            "train": "/api/train (POST)",
+            "convert": "/api/convert (POST)",
+            "convert_batch": "/api/convert/batch (POST, NDJSON stream)",
+            "convert_stream": "/api/convert/stream (POST, SSE stream)",
+            "convert_audio": "/api/convert/audio (POST, audio in → audio out)",
+            "jobs": "/api/jobs (GET)",
+            "job_status": "/api/jobs/<job_id> (GET)",
+            "job_cancel": "/api/jobs/<job_id>/cancel (POST)",
+            "progress": "/api/progress/<exp_dir> (GET)",
+            "progress_stream": "/api/progress/<exp_dir>/stream (GET, SSE stream)",
+            "voice_cache": "/api/voice-cache (GET)",
+            "voice_cache_invalidate": "/api/voice-cache/invalidate (POST)",
+            "persistence": "/api/persistence (GET)",
+            "persistence_flush": "/api/persistence/flush (POST)",
+            "admission": "/api/admission (GET)",
+            "metrics": "/metrics (GET, Prometheus text format)",
+            "traces_slowest": "/api/traces/slowest (GET)",
+            "trace": "/api/traces/<trace_id> (GET)"
+        }
+    })
+
+
+@app.route('/health')
+def health():
+    """فحص صحة السيرفر"""
+    return jsonify({
+        "status": "ok",
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """المقاييس بصيغة Prometheus (لكل عملية gunicorn على حدة)"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# ============================================
+# Colab Management Routes
+# ============================================
+
+@app.route('/api/register-colab', methods=['POST'])
+def register_colab():
+    """
+    Colab يرسل رابطه هنا عند بدء التشغيل، ثم يعيد الإرسال دورياً كـ heartbeat
+    
+    Expected payload:
+    {
+        "colab_url": "https://xxxx.ngrok-free.app",
+        "worker_id": "colab-1",                          (اختياري)
+        "capacity": 1,                                   (اختياري)
+        "capabilities": ["convert", "train", "preprocess"] (اختياري)
+        "ready": false                                   (اختياري: أثناء الـ prewarm، لا يُرسل له طلبات)
+    }
+    """
+    try:
+        data = request.get_json()
+        colab_url = data.get('colab_url')
+        
+        if not colab_url:
+            return jsonify({
+                "success": False,
+                "error": "colab_url is required"
+            }), 400
+        
+        worker, is_new = worker_pool.register(
+            colab_url,
+            worker_id=data.get('worker_id'),
+            capacity=data.get('capacity', 1),
+            capabilities=data.get('capabilities'),
+            ready=data.get('ready', True),
+        )
+        
+        if not is_new:
+            return jsonify({
+                "success": True,
+                "message": "Heartbeat received",
+                "worker_id": worker["worker_id"],
+                "colab_url": worker["url"],
+                "registered_at": worker["registered_at"],
+                "health": worker["health"],
+                "ready": worker["ready"]
+            })
+        
+        print(f"✅ Colab registered: {worker['worker_id']} → {worker['url']}")
+        print(f"   Registered at: {worker['registered_at']}")
+        print(f"   Capacity: {worker['capacity']} | Capabilities: {worker['capabilities']}")
+        
+        # فحص /health يتم في الخلفية (health monitor) بدل انتظاره هنا
+        return jsonify({
+            "success": True,
+            "message": "Colab URL registered successfully",
+            "worker_id": worker["worker_id"],
+            "colab_url": worker["url"],
+            "registered_at": worker["registered_at"],
+            "health": worker["health"],
+            "ready": worker["ready"]
+        })
+        
+    except Exception as e:
+        print(f"❌ Error registering Colab: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/colab-status', methods=['GET'])
+def colab_status():
+    """
+    الحصول على حالة كل الـ workers المسجلين (من آخر فحص في الخلفية، بدون طلب إلى Colab)
+    """
+    workers = worker_pool.snapshot()
+    return jsonify({
+        "colab_connected": worker_pool.has_workers(),
+        "colab_url": workers[0]["url"] if workers else None,
+        "registered_at": workers[0]["registered_at"] if workers else None,
+        "heartbeat_ttl": WORKER_HEARTBEAT_TTL,
+        "workers": workers,
+        "health_monitor": health_monitor.stats(),
+        "http_client": colab_client.stats(),
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+HEALTH_ERROR_STATUS = {"timeout": 504, "connection": 503, "http": 503}
+
+
+def _probe_worker(worker, fresh=False):
+    """
+    حالة /health لـ worker واحد من health monitor.
+    فحص متزامن فقط مع ?fresh=1 أو إذا لم يُفحص بعد
+    """
+    health = health_monitor.snapshot(worker["worker_id"])
+    if fresh or health is None or health["checked_at"] is None:
+        print(f"🔍 Testing connection to: {worker['url']}/health")
+        health = health_monitor.probe_now(worker["worker_id"]) or health
+
+    if health is None:
+        return {"success": False, "worker_id": worker["worker_id"], "error": "Worker is not tracked",
+                "colab_url": worker["url"]}, 503
+
+    body = {
+        "worker_id": worker["worker_id"],
+        "colab_url": worker["url"],
+        "registered_at": worker["registered_at"],
+        "health": health["status"],
+        "checked_at": health["checked_at"],
+        "age_seconds": health["age_seconds"],
+        "availability": health["availability"],
+        "rtt_ms_avg": health["rtt_ms_avg"],
+    }
+    if health["status"] == "healthy":
+        return {**body, "success": True, "colab_health": health["last_health"],
+                "response_time_ms": health["rtt_ms_last"]}, 200
+    return {**body, "success": False, "error": health["last_error"] or f"Worker is {health['status']}",
+            "down_seconds": health["down_seconds"]}, HEALTH_ERROR_STATUS.get(health["last_error_kind"], 500)
+
+
+@app.route('/api/test-colab-connection', methods=['GET'])
+def test_colab():
+    """
+    اختبار الاتصال مع Colab (كل الـ workers أو ?worker_id=...)
+    النتيجة من آخر فحص في الخلفية، و ?fresh=1 يفحص الآن
+    """
+    workers = worker_pool.snapshot()
+    fresh = request.args.get('fresh', '').lower() in ('1', 'true')
+    worker_id = request.args.get('worker_id')
+    if worker_id:
+        workers = [w for w in workers if w["worker_id"] == worker_id]
+    
+    if not workers:
+        return jsonify({
+            "success": False,
+            "error": "Colab is not registered. Please run the Colab notebook first.",
+            "colab_url": None,
+            "registered_at": None
+        }), 503
+    
+    results = [_probe_worker(w, fresh) for w in workers]
+    ok = [r for r, status in results if r["success"]]
+    first, status = (ok[0], 200) if ok else results[0]
+    
+    body = {
+        **first,
+        "workers": [r for r, _ in results],
+        "timestamp": datetime.now().isoformat()
+    }
+    if ok:
+        body["message"] = f"Colab is connected and responding ({len(ok)}/{len(results)} workers)"
+    return jsonify(body), status
+
+
+@app.route('/api/disconnect-colab', methods=['POST'])
+def disconnect_colab():
+    """
+    فصل Colab (للاستخدام اليدوي أو عند إعادة التشغيل)
+    بدون worker_id يتم فصل كل الـ workers
+    """
+    data = request.get_json(silent=True) or {}
+    worker_id = data.get('worker_id')
+    
+    if worker_id:
+        removed = [w for w in [worker_pool.remove(worker_id)] if w]
+    else:
+        removed = worker_pool.clear()
+    
+    old_urls = [w["url"] for w in removed]
+    print(f"🔌 Colab disconnected: {old_urls}")
+    
+    return jsonify({
+        "success": True,
+        "message": "Colab disconnected",
+        "previous_url": old_urls[0] if old_urls else None,
+        "removed_workers": [w["worker_id"] for w in removed]
+    })
+
+
+@app.route('/api/workers/<worker_id>/drain', methods=['POST'])
+def drain_worker(worker_id):
+    """
+    إيقاف إرسال طلبات جديدة لـ worker (الطلبات الجارية تكتمل)
+    """
+    worker = worker_pool.set_state(worker_id, "draining")
+    if not worker:
+        return jsonify({"success": False, "error": "Worker not found"}), 404
+    print(f"🚰 Worker draining: {worker_id} ({worker['in_flight']} in flight)")
+    return jsonify({"success": True, "worker": worker})
+
+
+@app.route('/api/workers/<worker_id>/resume', methods=['POST'])
+def resume_worker(worker_id):
+    worker = worker_pool.set_state(worker_id, "active")
+    if not worker:
+        return jsonify({"success": False, "error": "Worker not found"}), 404
+    print(f"▶️ Worker resumed: {worker_id}")
+    return jsonify({"success": True, "worker": worker})
+
+
+@app.route('/api/workers/<worker_id>', methods=['DELETE'])
+def remove_worker(worker_id):
+    worker = worker_pool.remove(worker_id)
+    if not worker:
+        return jsonify({"success": False, "error": "Worker not found"}), 404
+    print(f"🔌 Worker removed: {worker_id} ({worker['in_flight']} in flight)")
+    return jsonify({"success": True, "worker": worker})
+
+
+# ============================================
+# RVC Processing Routes
+# ============================================
+
+def _run_preprocess(job_id, doc_data):
+    """تنفيذ preprocess في الخلفية: إرسال الصوت كـ stream إلى Colab ثم الحفظ في Firestore"""
+    if 'audio_base64' in doc_data:
+        # مهام قديمة محفوظة قبل blob store
+        doc_data['audio_blob'] = blob_store.put_bytes(base64.b64decode(doc_data.pop('audio_base64')))
+
+    blob = doc_data['audio_blob']
+    with worker_pool.lease('preprocess') as worker, blob_store.open(blob['sha256']) as audio:
+        response = colab_client.post(
+            worker, '/preprocess',
+            data = audio,
+            headers = {
+                'Content-Type': 'application/octet-stream',
+                'X-RVC-Params': json.dumps(doc_data),
+            },
+            timeout = 800
+        )
+
+    preprocess_data = response.json()
+    print(f"colab_response : {preprocess_data}")
+
+    if db and not job_cancel_requested(job_id):
+        try:
+            # فقط المرجع + metadata، بدون الصوت نفسه
+            persist_queue.set(f"training_voices/{doc_data['user_id']}/{doc_data['exp_dir']}/data", doc_data, merge=True)
+            print('training_voices is queued for firestore')
+        except Exception as f:
+            print(f'training_voices is not created in firebase : {f}')
+
+    return {**preprocess_data , "every_thing": "ok", "http_status": response.status_code, "worker_id": worker["worker_id"]}
+
+
+_job_handlers['preprocess'] = _run_preprocess
+
+
+PREPROCESS_REQUIRED_FIELDS = ["exp_dir" , "sr" , "n_p" , "user_id" , "is_favorite" , "gpus" ,"f0method" , "if_f0" , "version19" , "gpus_rmvpe"]
+
+
+def _build_preprocess_doc(data):
+    return {
+        "exp_dir" : data.get('exp_dir1'),
+        "sr" : data.get('sr'),
+        "n_p" : data.get('n_p'),
+        "user_id" : data.get('user_id'),
+        "is_favorite" : data.get('is_favorite'),
+        'gpus' : data.get("gpus16"),
+        'f0method' : data.get("f0method8"),
+        'if_f0' : data.get("if_f0_3"),
+        'version19' : data.get("version19"),
+        'gpus_rmvpe' : data.get("gpus_rmvpe"),
+        'spk_id5':data.get("spk_id5"),
+        'save_epoch10':data.get("save_epoch10"),
+        'total_epoch11':data.get("total_epoch11"),
+        'batch_size12':data.get("batch_size12"),
+        'if_save_latest13':data.get("if_save_latest13"),
+        'pretrained_G14':data.get("pretrained_G14"),
+        'pretrained_D15':data.get("pretrained_D15"),
+        'if_cache_gpu17':data.get("if_cache_gpu17"),
+        'if_save_every_weights18':data.get("if_save_every_weights18")
+    }
+
+
+def _queue_preprocess(doc_data):
+    job_id = create_job('preprocess', doc_data['user_id'], doc_data, admission_key(doc_data['user_id']))
+    submit_job(job_id)
+    print(f"📥 Preprocess job queued: {job_id} (audio {doc_data['audio_blob']['sha256'][:12]}…)")
+
+    return jsonify({
+        "success": True,
+        "message": "Preprocess job queued",
+        "job_id": job_id,
+        "status_url": f"/api/jobs/{job_id}",
+        "queue_position": job_queue_position(job_id),
+        "audio_blob": doc_data['audio_blob'],
+        "every_thing": "ok"
+    }), 202
+
+
+def _form_value(value):
+    """قيم multipart تصل كنصوص: "2" → 2, "true" → True, "40k" يبقى نصاً"""
+    try:
+        return json.loads(value)
+    except (ValueError, TypeError):
+        return value
+
+
+@app.route('/api/preprocess' , methods = ['POST'])
+def preprocess():
+    """
+    (قديم) الصوت كـ base64 داخل JSON في trainset_dir.
+    الأفضل استخدام /api/preprocess/upload
+    يضيف مهمة preprocess إلى الطابور ويرجع job_id مباشرة.
+    تابع الحالة عبر GET /api/jobs/<job_id>
+    """
+    try:
+        if not worker_pool.has_workers('preprocess'):
+            return jsonify({"error": "Colab is not connected. Please run Colab first."}), 503
+        data = request.get_json()
+        audio_base64 = data.get('trainset_dir')
+
+        doc_data = _build_preprocess_doc(data)
+        missing_field = [field for field in PREPROCESS_REQUIRED_FIELDS if doc_data.get(field) is None]
+        if audio_base64 is None:
+            missing_field.insert(0, "audio_base64")
+        if missing_field:
+            return jsonify(f"doc_data is not found is {missing_field}")
+
+        admission.charge('preprocess', admission_key(doc_data['user_id']), dry_run=True)
+        doc_data['audio_blob'] = {
+            **blob_store.put_bytes(base64.b64decode(audio_base64)),
+            "content_type": "audio/wav",
+            "filename": None,
+        }
+        return _queue_preprocess(doc_data)
+
+    except AdmissionRejected as e:
+        return _admission_response(e)
+    except JobQueueFull as q:
+        return jsonify({"success": False, "error": str(q)}), 429
+    except Exception as d:
+        print(f"Error is {d}")
+        return jsonify({"error_farouk": str(d)}), 500
+
+
+@app.route('/api/preprocess/upload' , methods = ['POST'])
+def preprocess_upload():
+    """
+    رفع الصوت بدون base64، بطريقتين:
+    1. multipart/form-data: ملف في الحقل audio + باقي الحقول كـ form fields
+    2. application/octet-stream: الصوت في body والحقول في query string
+    الصوت يُكتب على القرص على دفعات (blob store) ويُرسل إلى Colab كـ stream
+    """
+    try:
+        if not worker_pool.has_workers('preprocess'):
+            return jsonify({"error": "Colab is not connected. Please run Colab first."}), 503
+
+        if request.content_length and request.content_length > UPLOAD_MAX_BYTES:
+            return jsonify({"success": False, "error": f"Upload exceeds {UPLOAD_MAX_BYTES} bytes"}), 413
+
+        if request.mimetype == 'multipart/form-data':
+            fields = request.form
+            upload = request.files.get('audio')
+            if upload is None:
+                return jsonify({"success": False, "error": "audio file part is required"}), 400
+            stream, content_type, filename = upload.stream, upload.mimetype, upload.filename
+        else:
+            fields = request.args
+            stream, content_type, filename = request.stream, request.mimetype, fields.get('filename')
+
+        data = {key: _form_value(value) for key, value in fields.items()}
+        doc_data = _build_preprocess_doc(data)
+        missing_field = [field for field in PREPROCESS_REQUIRED_FIELDS if doc_data.get(field) is None]
+        if missing_field:
+            return jsonify({"success": False, "error": f"doc_data is not found is {missing_field}"}), 400
+
+        # قبل كتابة الملف على القرص حتى لا نستقبل رفعاً كاملاً ثم نرفضه (الخصم عند إنشاء المهمة)
+        admission.charge('preprocess', admission_key(doc_data['user_id']), dry_run=True)
+        blob = blob_store.put_stream(stream)
+        if not blob["size"]:
+            return jsonify({"success": False, "error": "audio is empty"}), 400
+
+        doc_data['audio_blob'] = {**blob, "content_type": content_type, "filename": filename}
+        return _queue_preprocess(doc_data)
+
+    except UploadTooLarge as u:
+        return jsonify({"success": False, "error": str(u)}), 413
+    except AdmissionRejected as e:
+        return _admission_response(e)
+    except JobQueueFull as q:
+        return jsonify({"success": False, "error": str(q)}), 429
+    except Exception as d:
+        print(f"Error is {d}")
+        return jsonify({"success": False, "error": str(d)}), 500
+
+
+
+
+@app.route('/api/add_to_favorite' , methods = ['POST'])
+def add_to_favorite():
+    try:
+        if not worker_pool.has_workers():
+            return jsonify({"error": "Colab is not connected. Please run Colab first."}), 503
+        data = request.get_json()
+        user_id = data.get("user_id")
+        is_favorite = data.get("is_favorite" , False)
+        exp_dir = data.get('exp_dir1')
+
+        if db:
+            try:
+                path = f"training_voices/{user_id}/{exp_dir}/data"
+                # update على مستند غير موجود كان يفشل مباشرة. بدون قراءة Firestore هنا: الصوت معروف
+                # أنه غير موجود (negative في voice_cache) ولم يكتبه هذا الـ gateway → نفس الخطأ.
+                # غير ذلك تُرسل الكتابة، وإذا لم يكن المستند موجوداً تُسقط وتظهر في /api/persistence
+                _, _, negative = voice_cache.peek((exp_dir, user_id or ''))
+                if negative and not persist_queue.known(path):
+                    raise LookupError(f"No document to update: {path}")
+                persist_queue.update(path, {"is_favorite": is_favorite})
+                return jsonify({"messege" : "add to favorite is sucessfull" , "status" : "True"})
+            except Exception as f:
+                return jsonify(f"messege : add to favorite is Error : {f}")
+
+    except Exception as d:
+        print(f'error:{d}')
+    
+
+
+def _run_train(job_id, data):
+    """تنفيذ التدريب في الخلفية: إرسال إلى Colab ثم الحفظ في Firestore"""
+    exp_dir1      = data.get('exp_dir1')
+    trainset_dir4 = data.get('trainset_dir4')
+    user_id       = data.get('user_id')
+
+    sources = trainset_dir4 if isinstance(trainset_dir4, list) else [trainset_dir4]
+
+    with worker_pool.lease('train') as worker:
+        print(f"📤 Sending to Colab: {worker['url']}/train ({worker['worker_id']}, {len(sources)} source(s))")
+
+        colab_response = colab_client.post(
+            worker, '/train',
+            json=data,
+            timeout=600  # 10 دقائق للتدريب
+        )
+
+    colab_data = colab_response.json()
+    print(f"📨 Colab response: {json.dumps(colab_data, indent=2, ensure_ascii=False)}")
+
+    # حفظ في Firestore (إلا إذا تم إلغاء المهمة)
+    if db and not job_cancel_requested(job_id):
+        try:
+            doc_data = {
+                "userId":       user_id,
+                "exp_dir":      exp_dir1,
+                "audioUrl":     trainset_dir4,
+                "status":       "trained" if colab_data.get("success") else "failed",
+                "colab_result": colab_data,
+                "jobId":        job_id,
+                "updatedAt":    firestore.SERVER_TIMESTAMP,
+                "trainedAt":    datetime.now().isoformat()
+            }
+
+            # resolve_voice متزامن قد يعيد المسار القديم إلى الـ cache قبل commit: نبطله مرة أخرى بعده
+            persist_queue.set(f"exp_dir/{user_id}/voices/{exp_dir1}", doc_data, merge=True,
+                              on_commit=lambda: voice_cache.invalidate(exp_dir1))
+
+            print("✅ Queued for Firestore")
+
+            # ✅ حفظ في القائمة العامة بعد نجاح التدريب
+            if colab_data.get("success"):
+                try:
+                    model_path, index_path = default_voice_paths(exp_dir1)
+                    persist_queue.add('training_voices', {
+                        'voiceName': exp_dir1,
+                        'modelPath': model_path,
+                        'indexPath': index_path,
+                        'createdBy': user_id,
+                        'createdAt': firestore.SERVER_TIMESTAMP,
+                        'isPublic': True,
+                        'downloads': 0,
+                    })
+                    print(f"✅ Added {exp_dir1} to training_voices collection")
+                except Exception as e:
+                    print(f"⚠️ Could not add to training_voices: {e}")
+
+        except Exception as db_error:
+            print(f"❌ Firestore error: {db_error}")
+
+        # الصوت تغيّر: لا نستخدم المسار القديم من الـ cache
+        voice_cache.invalidate(exp_dir1)
+
+    return {
+        "success": colab_data.get("success", False),
+        "message": "Training completed on Colab",
+        "data": colab_data,
+        "http_status": colab_response.status_code,
+        "worker_id": worker["worker_id"],
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+_job_handlers['train'] = _run_train
+
+TRAIN_MAX_SOURCES = int(os.environ.get('TRAIN_MAX_SOURCES', 500))  # نفس INGEST_MAX_SOURCES في Colab
+
+
+@app.route('/api/train', methods=['POST'])
+def train():
+    """
+    تدريب نموذج RVC
+    يضيف المهمة إلى الطابور ويرجع job_id مباشرة (202)
+    تابع الحالة عبر GET /api/jobs/<job_id>
+    
+    Expected payload:
+    {
+        "exp_dir1": "model_name",
+        "trainset_dir4": "/path/to/audio",
+        "user_id": "user_123"
+    }
+
+    trainset_dir4 يقبل رابطاً واحداً أو قائمة روابط (ملفات صوت أو zip / tar)
+    """
+    try:
+        data = request.get_json()
+        print(f"\n📥 Training request received:")
+        print(f"   {json.dumps(data, indent=2, ensure_ascii=False)}")
+
+        exp_dir1      = data.get('exp_dir1')
+        trainset_dir4 = data.get('trainset_dir4')
+        user_id       = data.get('user_id')
+
+        if not all([exp_dir1, trainset_dir4, user_id]):
+            return jsonify({
+                "success": False,
+                "error": "Missing required fields: exp_dir1, trainset_dir4, user_id"
+            }), 400
+
+        sources = trainset_dir4 if isinstance(trainset_dir4, list) else [trainset_dir4]
+        if len(sources) > TRAIN_MAX_SOURCES or not all(isinstance(u, str) and u for u in sources):
+            return jsonify({
+                "success": False,
+                "error": f"trainset_dir4 must be a URL or a list of at most {TRAIN_MAX_SOURCES} URLs"
+            }), 400
+
+        if not worker_pool.has_workers('train'):
+            return jsonify({
+                "success": False,
+                "error": "Colab is not connected. Please run the Colab notebook first."
+            }), 503
+
+        job_id = create_job('train', user_id, data, admission_key(user_id))
+        submit_job(job_id)
+        print(f"📥 Training job queued: {job_id}")
+
+        return jsonify({
+            "success": True,
+            "message": "Training job queued",
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}",
+            "queue_position": job_queue_position(job_id),
+            "timestamp": datetime.now().isoformat()
+        }), 202
+
+    except AdmissionRejected as e:
+        return _admission_response(e)
+    except JobQueueFull as q:
+        return jsonify({
+            "success": False,
+            "error": str(q)
+        }), 429
+
+    except Exception as e:
+        print(f"❌ Error in train: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+def _build_convert_payload(data, model_path, index_path, user_id):
+    """البيانات التي تُرسل إلى Colab /convert"""
+    return {
+        'spk_item': data.get('spk_item', 0),
+        'input_audio0': data.get('input_audio0'),
+        'vc_transform0': data.get('vc_transform0', 0),
+        'f0_file': data.get('f0_file'),
+        'f0method0': data.get('f0method0', 'rmvpe'),
+        'file_index1': '',  # فارغ
+        'file_index2': model_path,  # ✅ المسار الكامل للنموذج
+        'index_path': index_path,   # ✅ مسار index
+        'index_rate1': data.get('index_rate1', 0.75),
+        'filter_radius0': data.get('filter_radius0', 3),
+        'resample_sr0': data.get('resample_sr0', 0),
+        'rms_mix_rate0': data.get('rms_mix_rate0', 0.25),
+        'protect0': data.get('protect0', 0.33),
+        'user_id': user_id,
+        'input_type': data.get('input_type', 'file'),
+        'use_cache': data.get('use_cache', True),
+    }
+
+
+@app.route('/api/convert', methods=['POST'])
+def convert():
+    try:
+        data = request.get_json()
+        print(f"\n📥 Convert request received:")
+        print(f"   {json.dumps(data, indent=2, ensure_ascii=False)}")
+
+        # ✅ استخراج voice_name من الطلب
+        voice_name = data.get('file_index2')  # Flutter يرسل اسم الصوت هنا
+        user_id = data.get('user_id')
+        
+        if not voice_name:
+            return jsonify({
+                "success": False,
+                "error": "voice_name (file_index2) is required"
+            }), 400
+
+        user_key = admission_key(user_id)
+        admission.charge('convert', user_key)
+
+        # ✅ البحث عن معلومات الصوت (cache ثم Firestore)
+        with trace_span("voice_lookup"):
+            model_path, index_path = resolve_voice(voice_name, user_id)
+
+        # ✅ إعداد البيانات للإرسال إلى Colab
+        colab_payload = _build_convert_payload(data, model_path, index_path, user_id)
+
+        def upstream():
+            with admission.slot('convert', user_key) as ticket, worker_pool.lease('convert') as worker:
+                print(f"📤 Sending to Colab: {worker['worker_id']}")
+                print(f"   Model: {model_path}")
+                print(f"   Index: {index_path}")
+
+                colab_response = colab_client.post(
+                    worker, '/convert',
+                    idempotent=True,
+                    json=colab_payload,
+                    timeout=300
+                )
+
+            with trace_span("decode_response"):
+                colab_data = colab_response.json()
+            print(f"📨 Colab response: {json.dumps(colab_data, indent=2)}")
+            return {
+                "data": colab_data,
+                "status": colab_response.status_code,
+                "worker_id": worker["worker_id"],
+                "admission": ticket.as_dict(),
+            }
+
+        # ضغطتان على نفس الزر أو retry أثناء تنفيذ الطلب الأول: Colab ينفذ مرة واحدة
+        if COALESCE_CONVERT and data.get('coalesce', True):
+            result, coalesced = convert_flight.do(convert_fingerprint(colab_payload), upstream)
+        else:
+            result, coalesced = upstream(), False
+
+        colab_data = result["data"]
+        trace = current_trace()
+        trace.worker = colab_data.get("timings")
+        return jsonify({
+            "success": colab_data.get("success", False),
+            "message": "Convert request processed",
             "data": colab_data,
+            "worker_id": result["worker_id"],
+            "trace_id": trace.trace_id,
+            "timings": trace.timings(),
+            "admission": result["admission"],
+            "coalesced": coalesced,
             "timestamp": datetime.now().isoformat()
-        }), colab_response.status_code
+        }), result["status"]
+
+    except AdmissionRejected as e:
+        return _admission_response(e)
+    except NoWorkerAvailable:
+        return jsonify({"success": False, "error": "Colab is not connected."}), 503
+    except CircuitOpen as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+    except requests.exceptions.Timeout:
+        return jsonify({"success": False, "error": "Colab timed out"}), 504
+    except requests.exceptions.ConnectionError:
+        return jsonify({"success": False, "error": "Cannot connect to Colab"}), 503
+    except Exception as e:
+        import traceback; traceback.print_exc()
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+BATCH_GROUP_WORKERS = int(os.environ.get('BATCH_GROUP_WORKERS', 8))
+
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_GROUP_WORKERS, thread_name_prefix='batch')
+
+
+def _colab_error_message(e):
+    if isinstance(e, (NoWorkerAvailable, CircuitOpen)):
+        return str(e)
+    if isinstance(e, requests.exceptions.Timeout):
+        return "Colab timed out"
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return "Cannot connect to Colab"
+    return str(e)
+
+
+def _run_batch_group(model_path, group, results):
+    """
+    يرسل كل عناصر نفس النموذج إلى worker واحد كوحدة واحدة،
+    ويمرر كل سطر NDJSON إلى results فور وصوله
+    """
+    pending = {item['index'] for item in group['items']}
+    error = "No result from Colab"
+    try:
+        with worker_pool.lease('convert') as worker:
+            print(f"📤 Batch group → {worker['worker_id']}: {len(group['items'])} item(s), model {model_path}")
+            response = colab_client.post(
+                worker, '/convert/batch',
+                json={**group['common'], 'items': group['items']},
+                stream=True,
+                timeout=300
+            )
+            with response:
+                if response.status_code != 200:
+                    try:
+                        error = response.json().get('error') or f"Colab returned HTTP {response.status_code}"
+                    except ValueError:
+                        error = f"Colab returned HTTP {response.status_code}"
+                    return
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    if result.get('index') not in pending:
+                        error = result.get('error') or error
+                        continue
+                    pending.discard(result['index'])
+                    results.put({**result, "worker_id": worker["worker_id"]})
+    except Exception as e:
+        error = _colab_error_message(e)
+        print(f"❌ Batch group failed ({model_path}): {error}")
+    finally:
+        for index in sorted(pending):
+            results.put({"index": index, "success": False, "error": error})
+        results.put(None)
+
+
+def _once(fn):
+    """
+    fn تُنفَّذ مرة واحدة فقط. تحرير الموارد في الـ streaming يُستدعى من finally الخاص بالـ generator
+    ومن call_on_close معاً: إذا قطع العميل الاتصال قبل أول chunk لا يبدأ الـ generator أصلاً
+    """
+    lock = threading.Lock()
+    done = []
+
+    def wrapper(*args, **kwargs):
+        with lock:
+            if done:
+                return None
+            done.append(True)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/api/convert/batch', methods=['POST'])
+def convert_batch():
+    """
+    تحويل عدة ملفات في طلب واحد. العناصر تُجمع حسب النموذج وكل مجموعة تُرسل
+    إلى Colab كوحدة واحدة (تحميل النموذج مرة واحدة).
+    النتائج ترجع كـ NDJSON: سطر لكل عنصر فور انتهائه ثم سطر ملخص {"done": true}
+
+    Expected payload:
+    {
+        "user_id": "user_123",
+        "defaults": {"file_index2": "voice_name", "vc_transform0": 0},
+        "items": [
+            {"id": "clip-1", "input_audio0": "https://..."},
+            {"id": "clip-2", "input_audio0": "https://...", "vc_transform0": 12}
+        ]
+    }
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+
+    error = _validate_batch(items)
+    if error:
+        return jsonify({"success": False, "error": error[0]}), error[1]
+
+    print(f"\n📥 Batch convert request received: {len(items)} item(s)")
+
+    # الـ batch كله يأخذ مكاناً واحداً في طبقة القبول، وتكلفته بعدد العناصر
+    user_key = admission_key(data.get('user_id'))
+    try:
+        admission.charge('convert', user_key, cost=len(items))
+        ticket = admission.acquire('convert', user_key)
+    except AdmissionRejected as e:
+        return _admission_response(e)
+
+    try:
+        early_errors, groups = _group_batch_items(items, data.get('defaults') or {}, data.get('user_id'))
+    except Exception:
+        admission.release(ticket)
+        raise
+
+    results = queue.Queue()
+    for model_path, group in groups.items():
+        _batch_executor.submit(_run_batch_group, model_path, group, results)
+
+    def generate():
+        t0 = time.time()
+        succeeded = failed = 0
+        try:
+            for result in early_errors:
+                failed += 1
+                yield json.dumps(result) + "\n"
+
+            finished = 0
+            while finished < len(groups):
+                result = results.get()
+                if result is None:
+                    finished += 1
+                    continue
+                if result.get("success"):
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(result) + "\n"
+        finally:
+            release()
+
+        summary = _batch_summary(len(items), succeeded, failed, len(groups), t0)
+        yield json.dumps({**summary, "admission": ticket.as_dict()}) + "\n"
+
+    release = _once(lambda: admission.release(ticket))
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.call_on_close(release)
+    return response
+
+
+def _validate_batch(items):
+    """(error, status) أو None"""
+    if not isinstance(items, list) or not items:
+        return "items must be a non-empty list", 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return f"Too many items (max {BATCH_MAX_ITEMS})", 400
+    if not worker_pool.has_workers('convert'):
+        return "Colab is not connected.", 503
+    return None
+
+
+def _group_batch_items(items, defaults, user_id):
+    """العناصر → (أخطاء فورية، مجموعات حسب model_path)"""
+    early_errors = []
+    groups = OrderedDict()
+    for index, item in enumerate(items):
+        merged = {**defaults, **(item if isinstance(item, dict) else {})}
+        item_id = merged.get('id')
+        voice_name = merged.get('file_index2')
+        if not voice_name or not merged.get('input_audio0'):
+            early_errors.append({"index": index, "id": item_id, "success": False,
+                                 "error": "file_index2 and input_audio0 are required"})
+            continue
+
+        model_path, index_path = resolve_voice(voice_name, user_id)
+        payload = _build_convert_payload(merged, model_path, index_path, user_id)
+        group = groups.setdefault(model_path, {
+            "common": {'file_index2': model_path, 'index_path': index_path, 'user_id': user_id},
+            "items": [],
+        })
+        group["items"].append({**payload, "index": index, "id": item_id})
+    return early_errors, groups
+
+
+def _batch_summary(total, succeeded, failed, groups, t0):
+    return {
+        "done": True,
+        "total": total,
+        "succeeded": succeeded,
+        "failed": failed,
+        "groups": groups,
+        "elapsed_ms": round((time.time() - t0) * 1000, 1),
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+# نفس الحدود في Colab (parse_segment_options)
+STREAM_MIN_SEGMENT_SECONDS = float(os.environ.get('STREAM_MIN_SEGMENT_SECONDS', 1))
+STREAM_MAX_SEGMENT_SECONDS = float(os.environ.get('STREAM_MAX_SEGMENT_SECONDS', 30))
+STREAM_MAX_OVERLAP_SECONDS = float(os.environ.get('STREAM_MAX_OVERLAP_SECONDS', 2))
+
+
+def _stream_segment_options(data):
+    """segment_seconds / overlap_seconds المرسلة من العميل بعد التحقق، أو ValueError"""
+    options = {}
+    for key, low, high in (('segment_seconds', STREAM_MIN_SEGMENT_SECONDS, STREAM_MAX_SEGMENT_SECONDS),
+                           ('overlap_seconds', 0.0, STREAM_MAX_OVERLAP_SECONDS)):
+        if key not in data:
+            continue
+        try:
+            value = float(data[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"{key} must be a number")
+        if not low <= value <= high:
+            raise ValueError(f"{key} must be between {low:g} and {high:g}")
+        options[key] = value
+    return options
+
+
+@app.route('/api/convert/stream', methods=['POST'])
+def convert_stream():
+    """
+    تحويل تدريجي: نفس payload الخاص بـ /api/convert (مع segment_seconds / overlap_seconds اختيارياً)
+    والنتيجة Server-Sent Events من Colab تُمرَّر كما هي:
+    meta (sample_rate, format) → chunk (pcm base64) × N → done  أو error
+    """
+    data = request.get_json(silent=True) or {}
+    voice_name = data.get('file_index2')
+    user_id = data.get('user_id')
+
+    if not voice_name or not data.get('input_audio0'):
+        return jsonify({"success": False, "error": "file_index2 and input_audio0 are required"}), 400
+    try:
+        segment_options = _stream_segment_options(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    print(f"\n📥 Streaming convert request received: {voice_name}")
+
+    user_key = admission_key(user_id)
+    try:
+        admission.charge('convert', user_key)
+    except AdmissionRejected as e:
+        return _admission_response(e)
+
+    model_path, index_path = resolve_voice(voice_name, user_id)
+    colab_payload = _build_convert_payload(data, model_path, index_path, user_id)
+    colab_payload.update(segment_options)
+
+    try:
+        ticket = admission.acquire('convert', user_key)
+    except AdmissionRejected as e:
+        return _admission_response(e)
+
+    try:
+        worker = worker_pool.acquire('convert')
+    except (NoWorkerAvailable, CircuitOpen) as e:
+        admission.release(ticket)
+        return jsonify({"success": False, "error": _colab_error_message(e)}), 503
+
+    try:
+        colab_response = colab_client.post(
+            worker, '/convert/stream',
+            json=colab_payload,
+            stream=True,
+            timeout=300
+        )
+    except Exception as e:
+        worker_pool.release(worker["worker_id"], ok=False)
+        admission.release(ticket)
+        status = 504 if isinstance(e, requests.exceptions.Timeout) else 503
+        return jsonify({"success": False, "error": _colab_error_message(e)}), status
+
+    if colab_response.status_code != 200:
+        worker_pool.release(worker["worker_id"], ok=False)
+        admission.release(ticket)
+        try:
+            body = colab_response.json()
+        except ValueError:
+            body = {"success": False, "error": colab_response.text[:500]}
+        return jsonify(body), colab_response.status_code
+
+    outcome = {"ok": False}
 
+    @_once
+    def release():
+        try:
+            colab_response.close()
+        finally:
+            worker_pool.release(worker["worker_id"], outcome["ok"])
+            admission.release(ticket)
+
+    def generate():
+        try:
+            for chunk in colab_response.iter_content(chunk_size=None):
+                if chunk:
+                    yield chunk
+            outcome["ok"] = True
+        finally:
+            release()
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'X-Worker-Id': worker["worker_id"],
+        'X-Queue-Position': str(ticket.queue_position),
+        'X-Admission-Wait-Ms': str(ticket.wait_ms()),
+    })
+    response.call_on_close(release)
+    return response
+
+
+@app.route('/api/convert/audio', methods=['POST'])
+def convert_audio():
+    """
+    نفس /api/convert لكن الصوت يدخل ويخرج كـ bytes:
+    1. multipart/form-data: الملف في الحقل audio + حقول /api/convert كـ form fields
+    2. application/octet-stream: الصوت في body والحقول في query string
+    (بدون ملف يمكن إرسال input_audio0 كرابط كالمعتاد)
+    الرد هو الصوت الناتج (format: wav افتراضياً أو flac)، والتفاصيل في headers X-RVC-*.
+    بين السيرفر و Colab طلب واحد بـ frame ثنائي، والصوت flac بدون فقد إذا كان soundfile متاحاً
+    """
+    try:
+        if request.content_length and request.content_length > UPLOAD_MAX_BYTES:
+            return jsonify({"success": False, "error": f"Upload exceeds {UPLOAD_MAX_BYTES} bytes"}), 413
+
+        if request.mimetype == 'multipart/form-data':
+            fields = request.form
+            upload = request.files.get('audio')
+            stream, content_type, filename = (upload.stream, upload.mimetype, upload.filename) if upload else (None, None, None)
+        else:
+            fields = request.args
+            stream, content_type, filename = request.stream, request.mimetype, fields.get('filename')
+
+        data = {key: _form_value(value) for key, value in fields.items()}
+        voice_name = data.get('file_index2')
+        user_id = data.get('user_id')
+        output_format = data.get('format', 'wav')
+        if not voice_name:
+            return jsonify({"success": False, "error": "voice_name (file_index2) is required"}), 400
+        if output_format not in AUDIO_MIMETYPES:
+            return jsonify({"success": False, "error": f"format must be one of {list(AUDIO_MIMETYPES)}"}), 400
+
+        user_key = admission_key(user_id)
+        admission.charge('convert', user_key)
+
+        blob = blob_store.put_stream(stream) if stream is not None else None
+        if blob is not None and not blob["size"]:
+            blob = None
+        if blob is None and not data.get('input_audio0'):
+            return jsonify({"success": False, "error": "audio file or input_audio0 is required"}), 400
+
+        with trace_span("voice_lookup"):
+            model_path, index_path = resolve_voice(voice_name, user_id)
+
+        colab_payload = _build_convert_payload(data, model_path, index_path, user_id)
+        # flac عبر النفق ثم wav للعميل يحتاج soundfile هنا؛ بدونه نطلب صيغة العميل مباشرة
+        colab_payload['response_encoding'] = BINARY_TUNNEL_ENCODING if sf is not None else output_format
+        encoding = audio_encoding(content_type, filename) if blob else None
+
+        with admission.slot('convert', user_key) as ticket, worker_pool.lease('convert') as worker:
+            print(f"📤 Sending binary convert to Colab: {worker['worker_id']}")
+            if blob is None:
+                colab_response = colab_client.post(
+                    worker, '/convert/binary', data=FrameBody(colab_payload),
+                    headers={'Content-Type': FRAME_CONTENT_TYPE}, timeout=300)
+            else:
+                with open_upload_audio(blob, encoding) as (audio, size, sent):
+                    header = {**colab_payload, 'audio': {"encoding": sent, "size": size, "filename": filename}}
+                    colab_response = colab_client.post(
+                        worker, '/convert/binary', data=FrameBody(header, audio, size),
+                        headers={'Content-Type': FRAME_CONTENT_TYPE}, timeout=300)
+                worker_bytes_total.inc("upload", sent, amount=size)
+
+        trace = current_trace()
+        if colab_response.headers.get('Content-Type', '').split(';')[0] != FRAME_CONTENT_TYPE:
+            # خطأ قبل قراءة الـ frame (طلب غير صالح / استثناء في Colab)
+            try:
+                colab_data = colab_response.json()
+            except ValueError:
+                colab_data = {"success": False, "error": colab_response.text[:500]}
+            return jsonify({**colab_data, "worker_id": worker["worker_id"], "trace_id": trace.trace_id}), \
+                colab_response.status_code if colab_response.status_code >= 400 else 502
+
+        try:
+            with trace_span("decode_response"):
+                colab_data, payload = parse_frame(colab_response.content)
+        except ValueError as e:
+            return jsonify({"success": False, "error": f"Bad frame from Colab: {e}"}), 502
+        trace.worker = colab_data.get("timings")
+        audio_meta = colab_data.pop("audio", None)
+        if not colab_data.get("success") or not audio_meta:
+            return jsonify({
+                "success": False,
+                "error": colab_data.get("error", "Colab returned no audio"),
+                "data": colab_data,
+                "worker_id": worker["worker_id"],
+                "trace_id": trace.trace_id,
+                "timings": trace.timings(),
+            }), colab_response.status_code if colab_response.status_code >= 400 else 502
+
+        received = audio_meta["encoding"]
+        worker_bytes_total.inc("download", received, amount=len(payload))
+        if received == 'flac' and output_format == 'wav' and sf is not None:
+            payload, received = flac_to_wav(payload), 'wav'
+
+        result = colab_data.get("data") or {}
+        return Response(payload, 200, mimetype=AUDIO_MIMETYPES.get(received, 'application/octet-stream'), headers={
+            'X-Worker-Id': worker["worker_id"],
+            'X-RVC-Timings': json.dumps(trace.timings()),
+            'X-RVC-Cache-Status': str(result.get("cache_status")),
+            'X-RVC-Sample-Rate': str(audio_meta.get("sample_rate")),
+            'X-RVC-Tunnel-Bytes': str(audio_meta.get("size")),
+            'X-Queue-Position': str(ticket.queue_position),
+            'X-Admission-Wait-Ms': str(ticket.wait_ms()),
+        })
+
+    except UploadTooLarge as u:
+        return jsonify({"success": False, "error": str(u)}), 413
+    except AdmissionRejected as e:
+        return _admission_response(e)
+    except (NoWorkerAvailable, CircuitOpen) as e:
+        return jsonify({"success": False, "error": _colab_error_message(e)}), 503
     except requests.exceptions.Timeout:
         return jsonify({"success": False, "error": "Colab timed out"}), 504
     except requests.exceptions.ConnectionError:
@@ -567,6 +3871,244 @@ def convert():
     except Exception as e:
         import traceback; traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
+
+
+# ============================================
+# Job Routes
+# ============================================
+
+def _limit_arg(default, maximum=500):
+    """?limit=<n>: default إذا لم يُرسل (بحد أقصى maximum)، و None إذا لم يكن عدداً صحيحاً موجباً"""
+    raw = request.args.get('limit')
+    if raw is None or raw == '':
+        return default
+    try:
+        limit = int(raw)
+    except ValueError:
+        return None
+    return min(limit, maximum) if limit > 0 else None
+
+
+def _bad_limit():
+    return jsonify({"success": False, "error": "limit must be a positive integer"}), 400
+
+
+@app.route('/api/jobs', methods=['GET'])
+def jobs_list():
+    """
+    قائمة المهام (اختياري: ?user_id=...&state=...&limit=...)
+    """
+    limit = _limit_arg(50)
+    if limit is None:
+        return _bad_limit()
+    try:
+        jobs = list_jobs(
+            user_id=request.args.get('user_id'),
+            state=request.args.get('state'),
+            limit=limit,
+        )
+        return jsonify({"success": True, "count": len(jobs), "jobs": jobs})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    حالة مهمة واحدة: state, progress, result
+    """
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    if job["state"] == 'queued':
+        job["queue_position"] = job_queue_position(job_id)
+        job["admission_position"] = admission.position(job_id)
+    return jsonify({"success": True, "job": job})
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    """
+    إلغاء مهمة (المنتظرة تُلغى فوراً، الجارية تُتجاهل نتيجتها)
+    """
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    if job["state"] in JOB_FINAL_STATES:
+        return jsonify({"success": False, "error": f"Job already {job['state']}", "job": job}), 409
+
+    job = cancel_job(job_id)
+    print(f"🛑 Job cancel requested: {job_id} ({job['state']})")
+    return jsonify({"success": True, "message": "Job cancellation requested", "job": job})
+
+
+def _since_arg():
+    """?since=<seq>: 0 إذا لم يُرسل، و None إذا لم يكن عدداً صحيحاً موجباً"""
+    raw = request.args.get('since')
+    if raw is None or raw == '':
+        return 0
+    try:
+        since = int(raw)
+    except ValueError:
+        return None
+    return since if since >= 0 else None
+
+
+def _bad_since():
+    return jsonify({"success": False, "error": "since must be a non-negative integer"}), 400
+
+
+def _find_progress_worker(exp_dir, worker_id=None, since=0):
+    """يبحث عن الـ worker الذي يملك تقدم exp_dir → (worker, progress) أو (None, None)"""
+    workers = worker_pool.snapshot()
+    if worker_id:
+        workers = [w for w in workers if w["worker_id"] == worker_id]
+    for worker in workers:
+        try:
+            response = colab_client.get(worker, f'/progress/{exp_dir}', params={'since': since}, timeout=10)
+        except (CircuitOpen, requests.exceptions.RequestException):
+            continue
+        if response.status_code == 200:
+            return worker, response.json().get("data")
+    return None, None
+
+
+@app.route('/api/progress/<exp_dir>', methods=['GET'])
+def preprocess_progress(exp_dir):
+    """
+    تقدم preprocess لـ exp_dir من Colab: processed / errors / elapsed + آخر events
+    (اختياري: ?since=<seq>&worker_id=...)
+    """
+    since = _since_arg()
+    if since is None:
+        return _bad_since()
+    worker, progress = _find_progress_worker(exp_dir, request.args.get('worker_id'), since)
+    if not progress:
+        return jsonify({"success": False, "error": f"No progress for {exp_dir}"}), 404
+    return jsonify({"success": True, "worker_id": worker["worker_id"], "progress": progress})
+
+
+@app.route('/api/progress/<exp_dir>/stream', methods=['GET'])
+def preprocess_progress_stream(exp_dir):
+    """
+    نفس التقدم كـ Server-Sent Events (يُمرَّر من Colab كما هو حتى انتهاء العملية)
+    """
+    since = _since_arg()
+    if since is None:
+        return _bad_since()
+    worker, progress = _find_progress_worker(exp_dir, request.args.get('worker_id'), since)
+    if not progress:
+        return jsonify({"success": False, "error": f"No progress for {exp_dir}"}), 404
+
+    try:
+        colab_response = colab_client.get(
+            worker, f'/progress/{exp_dir}/stream',
+            params={'since': since},
+            stream=True,
+            timeout=60
+        )
+    except Exception as e:
+        status = 504 if isinstance(e, requests.exceptions.Timeout) else 503
+        return jsonify({"success": False, "error": _colab_error_message(e)}), status
+
+    def generate():
+        try:
+            for chunk in colab_response.iter_content(chunk_size=None):
+                if chunk:
+                    yield chunk
+        finally:
+            colab_response.close()
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'X-Worker-Id': worker["worker_id"],
+    })
+
+
+# ============================================
+# Cache Routes
+# ============================================
+
+@app.route('/api/voice-cache', methods=['GET'])
+def voice_cache_stats():
+    """
+    إحصائيات cache الأصوات (hits / misses / size)
+    """
+    return jsonify({"success": True, "voice_cache": voice_cache.stats()})
+
+
+@app.route('/api/voice-cache/invalidate', methods=['POST'])
+def voice_cache_invalidate():
+    """
+    حذف صوت من الـ cache ({"voice_name": "..."}) أو حذف الكل بدون body
+    """
+    data = request.get_json(silent=True) or {}
+    removed = voice_cache.invalidate(data.get('voice_name'))
+    return jsonify({"success": True, "removed": removed})
+
+
+# ============================================
+# Persistence Routes
+# ============================================
+
+@app.route('/api/persistence', methods=['GET'])
+def persistence_stats():
+    """
+    حالة طابور كتابات Firestore: depth / in_flight / flush latency / retries
+    """
+    return jsonify({"success": True, "persistence": persist_queue.stats()})
+
+
+@app.route('/api/persistence/flush', methods=['POST'])
+def persistence_flush():
+    """
+    إرسال كل الكتابات المنتظرة الآن (ينتظر حتى 10 ثوان)
+    """
+    flushed = persist_queue.flush(timeout=10)
+    return jsonify({"success": flushed, "persistence": persist_queue.stats()}), 200 if flushed else 504
+
+
+# ============================================
+# Admission Routes
+# ============================================
+
+@app.route('/api/admission', methods=['GET'])
+def admission_stats():
+    """
+    حالة طبقة القبول: الجاري / المنتظر حسب النوع / المرفوض والحدود الحالية
+    + عدد طلبات convert التي شاركت نتيجة طلب مطابق جارٍ (coalescing)
+    """
+    return jsonify({"success": True, "admission": admission.stats(), "coalescing": convert_flight.stats()})
+
+
+# ============================================
+# Trace Routes
+# ============================================
+
+@app.route('/api/traces/slowest', methods=['GET'])
+def traces_slowest():
+    """
+    أبطأ الطلبات من سجل traces (اختياري: ?limit=20&route=/api/convert&since=2024-01-01T00:00)
+    """
+    limit = _limit_arg(20)
+    if limit is None:
+        return _bad_limit()
+    traces = trace_sink.slowest(limit, request.args.get('route'), request.args.get('since'))
+    return jsonify({"success": True, "count": len(traces), "traces": traces})
+
+
+@app.route('/api/traces/<trace_id>', methods=['GET'])
+def trace_detail(trace_id):
+    """
+    سجلات trace id معين (مهام الخلفية تستخدم job_id كـ trace id)
+    """
+    traces = trace_sink.find(trace_id)
+    if not traces:
+        return jsonify({"success": False, "error": "Trace not found"}), 404
+    return jsonify({"success": True, "traces": traces})
+
+
 # ============================================
 # Error Handlers
 # ============================================
@@ -587,6 +4129,17 @@ def internal_error(e):
     }), 500
 
 
+try:
+    persist_queue.recover()
+except Exception as e:
+    print(f"❌ Persistence journal recovery error: {e}")
+
+try:
+    recover_jobs()
+except Exception as e:
+    print(f"❌ Job recovery error: {e}")
+
+
 # ============================================
 # Run Server
 # ============================================
@@ -599,7 +4152,7 @@ if __name__ == '__main__':
     print("="*60)
     print(f"🌐 Running on port {port}")
     print(f"🔥 Firebase: {'✅ Connected' if db else '❌ Not configured'}")
-    print(f"🔗 Colab: {'✅ Will connect when notebook runs' if not COLAB_URL else f'Already connected to {COLAB_URL}'}")
+    print(f"🔗 Colab: ✅ Workers will register when notebooks run (heartbeat TTL {WORKER_HEARTBEAT_TTL}s)")
     print("="*60)
     print("\n📋 Available endpoints:")
     print("   GET  /              - Server info")
@@ -608,9 +4161,25 @@ if __name__ == '__main__':
     print("   GET  /api/colab-status         - Check Colab status")
     print("   GET  /api/test-colab-connection - Test Colab connection")
     print("   POST /api/disconnect-colab     - Disconnect Colab")
-    print("   POST /api/preprocess           - Preprocess audio")
+    print("   POST /api/workers/<id>/drain   - Drain worker")
+    print("   POST /api/workers/<id>/resume  - Resume worker")
+    print("   DEL  /api/workers/<id>         - Remove worker")
+    print("   POST /api/preprocess           - Preprocess audio (base64)")
+    print("   POST /api/preprocess/upload    - Preprocess audio (streaming upload)")
     print("   POST /api/train                - Train model")
     print("   POST /api/convert              - Convert audio")
+    print("   POST /api/convert/batch        - Convert many clips (NDJSON)")
+    print("   POST /api/convert/stream       - Progressive convert (SSE)")
+    print("   POST /api/convert/audio        - Convert raw audio bytes (binary transport)")
+    print("   GET  /api/jobs                 - List jobs")
+    print("   GET  /api/jobs/<id>            - Job status")
+    print("   POST /api/jobs/<id>/cancel     - Cancel job")
+    print("   GET  /api/progress/<exp_dir>   - Preprocess progress (+ /stream SSE)")
+    print("   GET  /api/voice-cache          - Voice cache stats")
+    print("   GET  /api/persistence          - Firestore write queue stats")
+    print("   GET  /api/admission            - Admission control stats")
+    print("   GET  /metrics                  - Prometheus metrics")
+    print("   GET  /api/traces/slowest       - Slowest traced requests")
     print("="*60 + "\n")
     
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,561 @@
+"""
+وضع ASGI للـ gateway:
+مسارات التحويل الطويلة (/api/convert, /api/convert/batch, /api/convert/stream) تعمل بـ asyncio + httpx،
+فالطلب الذي ينتظر Colab لا يحجز thread أو process. كل باقي المسارات تمر إلى تطبيق Flask كما هي
+(نفس worker pool و circuit breakers و voice cache و metrics و traces).
+
+التشغيل (process واحد يكفي لمئات الطلبات المتزامنة):
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager, nullcontext
+from datetime import datetime
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as gateway
+from app import (
+    ADMISSION_MAX_WAIT, COLAB_CONNECT_TIMEOUT, COLAB_POOL_SIZE, RETRYABLE_STATUS, TRACE_HEADER,
+    AdmissionRejected, CircuitOpen, NoWorkerAvailable, Trace,
+    admission, colab_client, convert_flight, health_monitor, worker_pool, resolve_voice,
+    http_errors_total, http_in_flight, http_request_bytes, http_request_seconds, http_requests_total,
+    worker_request_seconds, worker_timeouts_total,
+)
+
+ASGI_MAX_CONNECTIONS = int(os.environ.get('ASGI_MAX_CONNECTIONS', 1000))
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 16))
+
+
+# ============================================
+# Async Colab client (نفس retries و circuit breaker الخاصة بـ ColabClient)
+# ============================================
+
+class AsyncColabClient:
+    def __init__(self, max_connections=ASGI_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=COLAB_POOL_SIZE),
+                headers={'User-Agent': 'rvc-gateway'},
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request(self, method, worker, path, trace=None, idempotent=False, retries=None,
+                      timeout=30, stream=False, **kwargs):
+        breaker = colab_client.breaker(worker["worker_id"])
+        if not breaker.allow():
+            raise CircuitOpen(f"Colab worker {worker['worker_id']} is unavailable (circuit open)")
+
+        attempts = 1 + ((colab_client.max_retries if retries is None else retries) if idempotent else 0)
+        url = f"{worker['url']}{path}"
+        endpoint = gateway._worker_endpoint(path)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if trace is not None:
+            headers[TRACE_HEADER] = trace.trace_id
+        timeout = httpx.Timeout(timeout, connect=min(COLAB_CONNECT_TIMEOUT, timeout))
+
+        # finally يغطي أيضاً CancelledError (مثلاً batch يلغي المهام المتبقية)
+        settled = False
+        try:
+            for attempt in range(attempts):
+                colab_client._count("requests")
+                t0 = time.perf_counter()
+                try:
+                    with trace.span(f"colab {endpoint}") if trace is not None else nullcontext():
+                        request = self.client.build_request(method, url, headers=headers, timeout=timeout, **kwargs)
+                        response = await self.client.send(request, stream=stream)
+                except httpx.TransportError as e:
+                    timed_out = isinstance(e, httpx.TimeoutException)
+                    worker_request_seconds.observe(time.perf_counter() - t0, endpoint, "timeout" if timed_out else "error")
+                    if timed_out:
+                        worker_timeouts_total.inc(endpoint, type(e).__name__)
+                    # ReadTimeout لا يُعاد: الـ worker ربما ما زال يعالج الطلب
+                    retryable = not isinstance(e, httpx.ReadTimeout)
+                    if retryable and attempt + 1 < attempts:
+                        await self._retry_sleep(attempt)
+                        continue
+                    colab_client._count("failures")
+                    settled = True
+                    breaker.record_failure()
+                    if retryable:
+                        health_monitor.probe_soon(worker["worker_id"])
+                    raise
+
+                worker_request_seconds.observe(time.perf_counter() - t0, endpoint, str(response.status_code))
+                if response.status_code in RETRYABLE_STATUS:
+                    if attempt + 1 < attempts:
+                        await response.aclose()
+                        await self._retry_sleep(attempt)
+                        continue
+                    colab_client._count("failures")
+                    settled = True
+                    breaker.record_failure()
+                    return response
+
+                settled = True
+                breaker.record_success()
+                return response
+        finally:
+            if not settled:
+                breaker.release_trial()
+
+    async def _retry_sleep(self, attempt):
+        colab_client._count("retries")
+        delay = min(colab_client.backoff * (2 ** attempt), 10.0)
+        await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+
+async_colab = AsyncColabClient()
+
+
+def _colab_error(e):
+    """(error, status) بنفس الرسائل والأكواد التي ترجعها مسارات Flask، أو None لأي خطأ آخر"""
+    if isinstance(e, NoWorkerAvailable):
+        return "Colab is not connected.", 503
+    if isinstance(e, CircuitOpen):
+        return str(e), 503
+    if isinstance(e, httpx.TimeoutException):
+        return "Colab timed out", 504
+    if isinstance(e, httpx.TransportError):
+        return "Cannot connect to Colab", 503
+    return None
+
+
+def observed(rule):
+    """metrics + trace لكل مسار async (مسارات Flask تسجلها hooks الخاصة بها)"""
+    def decorator(handler):
+        async def endpoint(request):
+            t0 = time.perf_counter()
+            trace_id = request.headers.get(TRACE_HEADER)
+            trace = Trace(trace_id if gateway._valid_trace_id(trace_id) else uuid.uuid4().hex, rule)
+            http_in_flight.inc(rule)
+            content_length = int(request.headers.get('content-length') or 0)
+            if content_length:
+                http_request_bytes.observe(content_length, rule)
+            try:
+                response = await handler(request, trace)
+            except Exception as e:
+                import traceback; traceback.print_exc()
+                response = JSONResponse({"success": False, "error": str(e)}, 500)
+            finally:
+                http_in_flight.dec(rule)
+
+            http_requests_total.inc(rule, request.method, str(response.status_code))
+            if response.status_code >= 500:
+                http_errors_total.inc(rule, request.method)
+            http_request_seconds.observe(time.perf_counter() - t0, rule, request.method)
+            response.headers[TRACE_HEADER] = trace.trace_id
+            await run_in_threadpool(gateway._write_trace, trace, request.method, response.status_code)
+            return response
+        return endpoint
+    return decorator
+
+
+def _admission_key(request, user_id):
+    """مثل gateway.admission_key لكن من request الخاص بـ Starlette (بدون ProxyFix: نقرأ X-Forwarded-For هنا)"""
+    if user_id:
+        return str(user_id)
+    remote_addr = request.client.host if request.client else None
+    return f"ip:{gateway.client_address(request.headers.get('x-forwarded-for'), remote_addr)}"
+
+
+def _admission_response(e):
+    return JSONResponse({
+        "success": False,
+        "error": str(e),
+        "reason": e.reason,
+        "retry_after": e.retry_after,
+    }, 429, headers={'Retry-After': str(e.retry_after)})
+
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def _admit(kind, user_key, trace):
+    """
+    مثل admission.acquire لكن الانتظار في الطابور لا يحجز thread:
+    القبول يصل كـ callback إلى الـ event loop
+    """
+    loop = asyncio.get_running_loop()
+    granted = loop.create_future()
+    with trace.span("admission"):
+        ticket = admission.enqueue(kind, user_key,
+                                   on_grant=lambda: loop.call_soon_threadsafe(_resolve_future, granted))
+        try:
+            if not ticket.granted.is_set():
+                await asyncio.wait_for(granted, ADMISSION_MAX_WAIT)
+        except asyncio.TimeoutError:
+            error = admission.abandon(ticket)
+            if error:
+                raise error
+        except asyncio.CancelledError:
+            # العميل قطع الاتصال أثناء الانتظار
+            admission.release(ticket)
+            raise
+    return ticket
+
+
+async def _coalesced(key, upstream, trace):
+    """
+    gateway.convert_flight داخل الـ event loop: الطلب الأول يشغل upstream كـ task،
+    والطلبات المتطابقة تنتظر نفس الـ task (shield: انقطاع أي عميل لا يلغيها للباقين)
+    """
+    flight, leader = convert_flight.join(key)
+    if leader:
+        flight.task = asyncio.ensure_future(upstream())
+
+        def finished(task):
+            if task.cancelled():
+                convert_flight.finish(key, flight, error=asyncio.CancelledError())
+            else:
+                convert_flight.finish(key, flight, task.result() if task.exception() is None else None,
+                                      task.exception())
+
+        flight.task.add_done_callback(finished)
+        return await asyncio.shield(flight.task), False
+
+    with trace.span("convert coalesced"):
+        if flight.task is None:
+            # بدأه thread من Flask (لا يحدث في وضع ASGI)
+            await run_in_threadpool(flight.done.wait)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        return await asyncio.shield(flight.task), True
+
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+# ============================================
+# Async routes
+# ============================================
+
+@observed('/api/convert')
+async def convert(request, trace):
+    try:
+        data = await request.json()
+        print(f"\n📥 Convert request received (async):")
+        print(f"   {json.dumps(data, indent=2, ensure_ascii=False)}")
+
+        voice_name = data.get('file_index2')
+        user_id = data.get('user_id')
+        if not voice_name:
+            return JSONResponse({"success": False, "error": "voice_name (file_index2) is required"}, 400)
+
+        user_key = _admission_key(request, user_id)
+        admission.charge('convert', user_key)
+
+        # Firestore متزامن: يعمل في threadpool حتى لا يوقف الـ event loop
+        with trace.span("voice_lookup"):
+            model_path, index_path = await run_in_threadpool(resolve_voice, voice_name, user_id)
+        colab_payload = gateway._build_convert_payload(data, model_path, index_path, user_id)
+
+        async def upstream():
+            ticket = await _admit('convert', user_key, trace)
+            try:
+                worker = worker_pool.acquire('convert')
+                ok = False
+                try:
+                    print(f"📤 Sending to Colab: {worker['worker_id']}")
+                    colab_response = await async_colab.request(
+                        'POST', worker, '/convert',
+                        trace=trace,
+                        idempotent=True,
+                        json=colab_payload,
+                        timeout=300
+                    )
+                    ok = True
+                finally:
+                    worker_pool.release(worker["worker_id"], ok)
+            finally:
+                admission.release(ticket)
+
+            with trace.span("decode_response"):
+                colab_data = colab_response.json()
+            print(f"📨 Colab response: {json.dumps(colab_data, indent=2)}")
+            return {
+                "data": colab_data,
+                "status": colab_response.status_code,
+                "worker_id": worker["worker_id"],
+                "admission": ticket.as_dict(),
+            }
+
+        if gateway.COALESCE_CONVERT and data.get('coalesce', True):
+            result, coalesced = await _coalesced(gateway.convert_fingerprint(colab_payload), upstream, trace)
+        else:
+            result, coalesced = await upstream(), False
+
+        colab_data = result["data"]
+        trace.worker = colab_data.get("timings")
+        return JSONResponse({
+            "success": colab_data.get("success", False),
+            "message": "Convert request processed",
+            "data": colab_data,
+            "worker_id": result["worker_id"],
+            "trace_id": trace.trace_id,
+            "timings": trace.timings(),
+            "admission": result["admission"],
+            "coalesced": coalesced,
+            "timestamp": datetime.now().isoformat()
+        }, result["status"])
+
+    except AdmissionRejected as e:
+        return _admission_response(e)
+    except Exception as e:
+        error = _colab_error(e)
+        if error is None:
+            import traceback; traceback.print_exc()
+            error = str(e), 500
+        return JSONResponse({"success": False, "error": error[0]}, error[1])
+
+
+async def _run_batch_group(model_path, group, results, trace):
+    """مثل gateway._run_batch_group لكن كـ coroutine تضع النتائج في asyncio.Queue"""
+    pending = {item['index'] for item in group['items']}
+    error = "No result from Colab"
+    try:
+        worker = worker_pool.acquire('convert')
+        ok = False
+        try:
+            print(f"📤 Batch group → {worker['worker_id']}: {len(group['items'])} item(s), model {model_path}")
+            response = await async_colab.request(
+                'POST', worker, '/convert/batch',
+                trace=trace,
+                json={**group['common'], 'items': group['items']},
+                stream=True,
+                timeout=300
+            )
+            try:
+                if response.status_code != 200:
+                    await response.aread()
+                    try:
+                        error = response.json().get('error') or f"Colab returned HTTP {response.status_code}"
+                    except ValueError:
+                        error = f"Colab returned HTTP {response.status_code}"
+                    return
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    if result.get('index') not in pending:
+                        error = result.get('error') or error
+                        continue
+                    pending.discard(result['index'])
+                    await results.put({**result, "worker_id": worker["worker_id"]})
+                ok = True
+            finally:
+                await response.aclose()
+        finally:
+            worker_pool.release(worker["worker_id"], ok)
+    except Exception as e:
+        error = (_colab_error(e) or (str(e),))[0]
+        print(f"❌ Batch group failed ({model_path}): {error}")
+    finally:
+        for index in sorted(pending):
+            await results.put({"index": index, "success": False, "error": error})
+        await results.put(None)
+
+
+@observed('/api/convert/batch')
+async def convert_batch(request, trace):
+    data = await _json_body(request) or {}
+    items = data.get('items')
+
+    error = gateway._validate_batch(items)
+    if error:
+        return JSONResponse({"success": False, "error": error[0]}, error[1])
+
+    print(f"\n📥 Batch convert request received (async): {len(items)} item(s)")
+
+    user_key = _admission_key(request, data.get('user_id'))
+    try:
+        admission.charge('convert', user_key, cost=len(items))
+        ticket = await _admit('convert', user_key, trace)
+    except AdmissionRejected as e:
+        return _admission_response(e)
+
+    try:
+        early_errors, groups = await run_in_threadpool(
+            gateway._group_batch_items, items, data.get('defaults') or {}, data.get('user_id')
+        )
+    except BaseException:
+        admission.release(ticket)
+        raise
+
+    results = asyncio.Queue()
+    tasks = [asyncio.create_task(_run_batch_group(model_path, group, results, trace))
+             for model_path, group in groups.items()]
+
+    async def generate():
+        t0 = time.time()
+        succeeded = failed = 0
+        try:
+            for result in early_errors:
+                failed += 1
+                yield json.dumps(result) + "\n"
+
+            finished = 0
+            while finished < len(groups):
+                result = await results.get()
+                if result is None:
+                    finished += 1
+                    continue
+                if result.get("success"):
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(result) + "\n"
+
+            summary = gateway._batch_summary(len(items), succeeded, failed, len(groups), t0)
+            yield json.dumps({**summary, "admission": ticket.as_dict()}) + "\n"
+        finally:
+            await release()
+
+    async def release():
+        for task in tasks:
+            task.cancel()
+        admission.release(ticket)
+
+    # العميل قد يقطع الاتصال قبل أن يبدأ الـ generator: BackgroundTask يعمل بعد الـ response في كل الأحوال
+    return StreamingResponse(generate(), media_type='application/x-ndjson', background=BackgroundTask(release))
+
+
+@observed('/api/convert/stream')
+async def convert_stream(request, trace):
+    data = await _json_body(request) or {}
+    voice_name = data.get('file_index2')
+    user_id = data.get('user_id')
+
+    if not voice_name or not data.get('input_audio0'):
+        return JSONResponse({"success": False, "error": "file_index2 and input_audio0 are required"}, 400)
+    try:
+        segment_options = gateway._stream_segment_options(data)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, 400)
+
+    print(f"\n📥 Streaming convert request received (async): {voice_name}")
+
+    user_key = _admission_key(request, user_id)
+    try:
+        admission.charge('convert', user_key)
+    except AdmissionRejected as e:
+        return _admission_response(e)
+
+    with trace.span("voice_lookup"):
+        model_path, index_path = await run_in_threadpool(resolve_voice, voice_name, user_id)
+    colab_payload = gateway._build_convert_payload(data, model_path, index_path, user_id)
+    colab_payload.update(segment_options)
+
+    try:
+        ticket = await _admit('convert', user_key, trace)
+    except AdmissionRejected as e:
+        return _admission_response(e)
+
+    try:
+        worker = worker_pool.acquire('convert')
+    except (NoWorkerAvailable, CircuitOpen) as e:
+        admission.release(ticket)
+        return JSONResponse({"success": False, "error": str(e)}, 503)
+
+    try:
+        colab_response = await async_colab.request(
+            'POST', worker, '/convert/stream',
+            trace=trace,
+            json=colab_payload,
+            stream=True,
+            timeout=300
+        )
+    except Exception as e:
+        worker_pool.release(worker["worker_id"], ok=False)
+        admission.release(ticket)
+        error = _colab_error(e) or (str(e), 500)
+        return JSONResponse({"success": False, "error": error[0]}, error[1])
+
+    if colab_response.status_code != 200:
+        worker_pool.release(worker["worker_id"], ok=False)
+        admission.release(ticket)
+        await colab_response.aread()
+        await colab_response.aclose()
+        try:
+            body = colab_response.json()
+        except ValueError:
+            body = {"success": False, "error": colab_response.text[:500]}
+        return JSONResponse(body, colab_response.status_code)
+
+    outcome = {"ok": False, "released": False}
+
+    async def release():
+        if outcome["released"]:
+            return
+        outcome["released"] = True
+        try:
+            await colab_response.aclose()
+        finally:
+            worker_pool.release(worker["worker_id"], outcome["ok"])
+            admission.release(ticket)
+
+    async def generate():
+        try:
+            async for chunk in colab_response.aiter_raw():
+                if chunk:
+                    yield chunk
+            outcome["ok"] = True
+        finally:
+            await release()
+
+    # العميل قد يقطع الاتصال قبل أول chunk: BackgroundTask يحرر الـ worker و الـ ticket مرة واحدة
+    return StreamingResponse(generate(), media_type='text/event-stream', background=BackgroundTask(release), headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'X-Worker-Id': worker["worker_id"],
+        'X-Queue-Position': str(ticket.queue_position),
+        'X-Admission-Wait-Ms': str(ticket.wait_ms()),
+    })
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    print("⚡ ASGI mode: async proxy for /api/convert, /api/convert/batch, /api/convert/stream")
+    yield
+    await async_colab.aclose()
+    await run_in_threadpool(gateway.persist_queue.flush)
+
+
+app = Starlette(
+    routes=[
+        Route('/api/convert', convert, methods=['POST']),
+        Route('/api/convert/batch', convert_batch, methods=['POST']),
+        Route('/api/convert/stream', convert_stream, methods=['POST']),
+        # كل شيء آخر (register-colab, jobs, preprocess, train, ...) عبر Flask
+        Mount('/', app=WSGIMiddleware(gateway.app, workers=ASGI_WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,488 @@
+"""
+قياس أداء الـ gateway بدون Colab و Firebase حقيقيين:
+- fake worker (Flask) يطبق /health و /preprocess و /train و /convert بزمن وحجم رد قابلين للتعديل
+- Firestore في الذاكرة يوضع مكان db في app.py
+- load generator يضغط /api/convert و /api/train بعدة مستويات concurrency
+  ويكتب throughput و p50/p95/p99 ونسبة الأخطاء كـ JSON
+
+أمثلة:
+    python bench.py
+    python bench.py --scenarios convert --concurrency 1,16,64 --duration 20 --output bench.json
+    python bench.py --baseline bench.json          # يفشل (exit 1) إذا ساء الأداء عن baseline
+    python bench.py --server asgi                  # نفس القياس عبر asgi.py (uvicorn)
+    python bench.py --scenarios convert-dup        # طلبات متطابقة: worker_calls يجب أن يكون أقل بكثير من requests
+    python bench.py --gateway-url http://127.0.0.1:5000 --worker-port 5111
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import requests
+from flask import Flask, Response, request, jsonify
+from werkzeug.serving import make_server
+
+
+# ============================================
+# Firestore في الذاكرة
+# ============================================
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._store, self.path + (name,))
+
+    def get(self):
+        self._store.delay()
+        with self._store.lock:
+            return FakeSnapshot(self.id, self._store.docs.get(self.path))
+
+    def set(self, data, merge=False):
+        self._store.delay()
+        with self._store.lock:
+            self._store.write(self.path, data, merge)
+
+    def update(self, data):
+        self._store.delay()
+        with self._store.lock:
+            if self.path not in self._store.docs:
+                raise KeyError(f"No document to update: {'/'.join(self.path)}")
+            self._store.write(self.path, data, True)
+
+
+class FakeCollection:
+    def __init__(self, store, path, filters=(), limit=None):
+        self._store = store
+        self.path = path
+        self._filters = filters
+        self._limit = limit
+
+    def document(self, doc_id=None):
+        return FakeDocument(self._store, self.path + (doc_id or uuid.uuid4().hex[:20],))
+
+    def add(self, data):
+        doc = self.document()
+        doc.set(data)
+        return datetime.now(), doc
+
+    def where(self, field, op, value):
+        if op != '==':
+            raise NotImplementedError(op)
+        return FakeCollection(self._store, self.path, self._filters + ((field, value),), self._limit)
+
+    def limit(self, count):
+        return FakeCollection(self._store, self.path, self._filters, count)
+
+    def get(self):
+        self._store.delay()
+        with self._store.lock:
+            docs = [FakeSnapshot(path[-1], data) for path, data in self._store.docs.items()
+                    if path[:-1] == self.path and all(data.get(f) == v for f, v in self._filters)]
+        return docs[:self._limit] if self._limit else docs
+
+
+class FakeBatch:
+    def __init__(self, store):
+        self._store = store
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append((ref, data, merge, False))
+
+    def update(self, ref, data):
+        self._ops.append((ref, data, True, True))
+
+    def commit(self):
+        self._store.delay()
+        with self._store.lock:
+            for ref, data, merge, must_exist in self._ops:
+                if must_exist and ref.path not in self._store.docs:
+                    raise KeyError(f"No document to update: {'/'.join(ref.path)}")
+            for ref, data, merge, _ in self._ops:
+                self._store.write(ref.path, data, merge)
+
+
+class FakeFirestore:
+    """يكفي لما يستخدمه app.py: collection / document / where / limit / get / set / update / batch"""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.docs = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def delay(self):
+        self.calls += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def write(self, path, data, merge):
+        data = {k: v for k, v in data.items()}
+        self.docs[path] = {**self.docs.get(path, {}), **data} if merge else data
+
+    def collection(self, name):
+        return FakeCollection(self, (name,))
+
+    def document(self, path):
+        return FakeDocument(self, tuple(path.split('/')))
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+# ============================================
+# Fake Colab worker
+# ============================================
+
+def create_fake_worker(latency_ms, jitter_ms, payload_kb, error_rate):
+    worker = Flask("fake_colab")
+    worker.calls = Counter()  # عدد الطلبات التي وصلت فعلاً لكل endpoint (لقياس coalescing)
+    filler = "x" * int(payload_kb * 1024)
+
+    def simulate():
+        worker.calls[request.path] += 1
+        time.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+        return random.random() < error_rate
+
+    @worker.route('/health')
+    def health():
+        return jsonify({"status": "ok", "source": "fake-colab"})
+
+    @worker.route('/preprocess', methods=['POST'])
+    def preprocess():
+        size = len(request.get_data())
+        if simulate():
+            return jsonify({"success": False, "error": "simulated failure"}), 500
+        return jsonify({"success": True, "data": {"audio_bytes": size, "preprocess_log": filler}})
+
+    @worker.route('/train', methods=['POST'])
+    def train():
+        if simulate():
+            return jsonify({"success": False, "error": "simulated failure"}), 500
+        return jsonify({"success": True, "message": "Training completed", "data": {"log": filler}})
+
+    @worker.route('/convert', methods=['POST'])
+    def convert():
+        t0 = time.perf_counter()
+        data = request.get_json() or {}
+        if simulate():
+            return jsonify({"success": False, "error": "simulated failure"}), 500
+        elapsed_ms = round((time.perf_counter() - t0) * 1000, 2)
+        return jsonify({
+            "success": True,
+            "message": "Conversion completed",
+            "data": {"info": filler, "output_path": f"/tmp/{uuid.uuid4().hex}.wav", "user_id": data.get('user_id')},
+            "timings": {"inference_ms": elapsed_ms, "total_ms": elapsed_ms},
+        })
+
+    @worker.route('/convert/batch', methods=['POST'])
+    def convert_batch():
+        data = request.get_json() or {}
+
+        def generate():
+            for position, item in enumerate(data.get('items') or []):
+                failed = simulate()
+                yield json.dumps({"index": item.get('index', position), "id": item.get('id'),
+                                  "success": not failed, "status": 500 if failed else 200}) + "\n"
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    return worker
+
+
+def serve(wsgi_app, port):
+    server = make_server('127.0.0.1', port, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_asgi(asgi_app, port):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=port,
+                                           log_level='warning', backlog=4096))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+# ============================================
+# Load generator
+# ============================================
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+def scenario_request(scenario, base_url, user_index, request_index):
+    user_id = f"bench-user-{user_index}"
+    if scenario == 'convert':
+        return 'POST', f"{base_url}/api/convert", {
+            "file_index2": f"voice-{request_index % 5}",
+            "input_audio0": f"https://example.invalid/audio/{request_index % 50}.wav",
+            "user_id": user_id,
+            "vc_transform0": 0,
+        }
+    if scenario == 'convert-dup':
+        # كل العملاء يرسلون نفس الطلب (double tap / retry): الـ gateway يجب أن يرسل نسخة واحدة للـ worker
+        return 'POST', f"{base_url}/api/convert", {
+            "file_index2": "voice-dup",
+            "input_audio0": "https://example.invalid/audio/dup.wav",
+            "user_id": "bench-dup-user",
+            "vc_transform0": 0,
+        }
+    if scenario == 'train':
+        return 'POST', f"{base_url}/api/train", {
+            "exp_dir1": f"bench-{user_index}-{request_index}",
+            "trainset_dir4": "https://example.invalid/dataset.wav",
+            "user_id": user_id,
+        }
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+def run_level(scenario, base_url, concurrency, duration, max_requests, timeout):
+    """concurrency threads كل منها يرسل طلباً بعد الآخر حتى انتهاء المدة أو عدد الطلبات"""
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    counter = iter(range(max_requests or 10 ** 12))
+    deadline = time.perf_counter() + duration
+
+    def user(user_index):
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            with lock:
+                request_index = next(counter, None)
+            if request_index is None:
+                return
+            method, url, payload = scenario_request(scenario, base_url, user_index, request_index)
+            t0 = time.perf_counter()
+            try:
+                status = session.request(method, url, json=payload, timeout=timeout).status_code
+            except requests.exceptions.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - t0
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] += 1
+
+    # عدد الـ threads في العملية (يشمل threads الـ load generator نفسها = concurrency)
+    peak_threads = [threading.active_count()]
+    stop_sampling = threading.Event()
+
+    def sample_threads():
+        while not stop_sampling.wait(0.05):
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+    threading.Thread(target=sample_threads, daemon=True).start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    stop_sampling.set()
+
+    latencies.sort()
+    total = len(latencies)
+    errors = sum(n for status, n in statuses.items() if not (status.isdigit() and int(status) < 400))
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": total,
+        "duration_s": round(wall, 3),
+        "throughput_rps": round(total / wall, 2) if wall else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": round(latencies[-1] * 1000, 2) if latencies else None,
+            "mean": round(sum(latencies) / total * 1000, 2) if total else None,
+        },
+        "error_rate": round(errors / total, 4) if total else None,
+        "status_counts": dict(statuses),
+        "peak_threads": peak_threads[0],
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """مقارنة مع تشغيل سابق: throughput أقل أو p95 أعلى من tolerance → regression"""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        old = previous.get((r["scenario"], r["concurrency"]))
+        if not old:
+            continue
+        if old["throughput_rps"] and r["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append({"scenario": r["scenario"], "concurrency": r["concurrency"],
+                                "metric": "throughput_rps", "baseline": old["throughput_rps"],
+                                "current": r["throughput_rps"]})
+        old_p95, new_p95 = old["latency_ms"]["p95"], r["latency_ms"]["p95"]
+        if old_p95 and new_p95 and new_p95 > old_p95 * (1 + tolerance):
+            regressions.append({"scenario": r["scenario"], "concurrency": r["concurrency"],
+                                "metric": "p95_ms", "baseline": old_p95, "current": new_p95})
+        if (r["error_rate"] or 0) > (old["error_rate"] or 0) + 0.01:
+            regressions.append({"scenario": r["scenario"], "concurrency": r["concurrency"],
+                                "metric": "error_rate", "baseline": old["error_rate"],
+                                "current": r["error_rate"]})
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_gateway(args, worker_url, state_dir):
+    """app.py داخل نفس العملية مع Firestore في الذاكرة وقاعدة مهام مؤقتة"""
+    os.environ.setdefault('JOBS_DB_PATH', os.path.join(state_dir, 'jobs.db'))
+    os.environ.setdefault('BLOB_DIR', os.path.join(state_dir, 'blobs'))
+    os.environ.setdefault('PERSIST_JOURNAL_PATH', os.path.join(state_dir, 'firestore_journal.db'))
+    os.environ.setdefault('TRACE_LOG_PATH', os.path.join(state_dir, 'traces.jsonl'))
+    os.environ.setdefault('JOB_MAX_PENDING', str(args.job_max_pending))
+    if not args.admission:
+        # بدون --admission نقيس قدرة الـ proxy نفسه، لا حدود المستخدمين
+        for name, value in (('ADMISSION_MAX_CONCURRENT', 100000), ('ADMISSION_USER_MAX_CONCURRENT', 100000),
+                            ('ADMISSION_USER_BACKGROUND_MAX', 100000),
+                            ('ADMISSION_MAX_QUEUE', 100000), ('ADMISSION_USER_RATE', 0),
+                            ('ADMISSION_USER_MAX_JOBS', 0)):
+            os.environ.setdefault(name, str(value))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import app as gateway
+    gateway.db = FakeFirestore(args.firestore_latency_ms)
+    gateway.worker_pool.register(worker_url, worker_id='bench-worker', capacity=args.worker_capacity)
+    if args.server == 'asgi':
+        import asgi
+        serve_asgi(asgi.app, args.gateway_port)
+    else:
+        serve(gateway.app, args.gateway_port)
+    return f"http://127.0.0.1:{args.gateway_port}", gateway
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway load test with a fake Colab worker and in-memory Firestore")
+    parser.add_argument('--scenarios', default='convert,train', help="comma separated: convert,convert-dup,train")
+    parser.add_argument('--concurrency', default='1,8,32', help="comma separated concurrency levels")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per level")
+    parser.add_argument('--requests', type=int, default=0, help="max requests per level (0 = duration only)")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--worker-latency-ms', type=float, default=50)
+    parser.add_argument('--worker-jitter-ms', type=float, default=10)
+    parser.add_argument('--worker-payload-kb', type=float, default=1)
+    parser.add_argument('--worker-error-rate', type=float, default=0.0)
+    parser.add_argument('--worker-capacity', type=int, default=64)
+    parser.add_argument('--worker-port', type=int, default=5111)
+    parser.add_argument('--firestore-latency-ms', type=float, default=20)
+    parser.add_argument('--job-max-pending', type=int, default=100000)
+    parser.add_argument('--admission', action='store_true',
+                        help="keep the gateway's admission limits (lifted by default to measure the proxy itself)")
+    parser.add_argument('--gateway-port', type=int, default=5099)
+    parser.add_argument('--register-repeat', type=int, default=16,
+                        help="register-colab calls against --gateway-url (one per gunicorn process is needed)")
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask',
+                        help="in-process gateway: Flask (thread per request) or asgi.py (uvicorn)")
+    parser.add_argument('--gateway-url', help="external gateway (gunicorn / uvicorn); the fake worker registers itself there")
+    parser.add_argument('--output', help="write JSON results to this file (default: stdout)")
+    parser.add_argument('--baseline', help="previous JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="allowed regression ratio")
+    parser.add_argument('--verbose', action='store_true', help="keep the gateway / worker logs")
+    args = parser.parse_args()
+
+    # سجلات كل طلب (print في app.py و werkzeug) تبطئ القياس وتخلط الـ JSON
+    report_stream = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    worker_url = f"http://127.0.0.1:{args.worker_port}"
+    fake_worker = create_fake_worker(args.worker_latency_ms, args.worker_jitter_ms,
+                                     args.worker_payload_kb, args.worker_error_rate)
+    serve(fake_worker, args.worker_port)
+
+    state_dir = tempfile.mkdtemp(prefix="gateway_bench_")
+    if args.gateway_url:
+        base_url, gateway = args.gateway_url.rstrip('/'), None
+        # worker pool في الذاكرة لكل process: نكرر التسجيل حتى يصل لكل gunicorn workers
+        for _ in range(args.register_repeat):
+            requests.post(f"{base_url}/api/register-colab", timeout=30, json={
+                "colab_url": worker_url, "worker_id": "bench-worker", "capacity": args.worker_capacity,
+            }).raise_for_status()
+    else:
+        base_url, gateway = start_gateway(args, worker_url, state_dir)
+
+    results = []
+    for scenario in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+        for concurrency in [int(c) for c in args.concurrency.split(',') if c.strip()]:
+            print(f"🏁 {scenario} @ concurrency {concurrency}...", file=sys.stderr)
+            calls_before = sum(fake_worker.calls.values())
+            result = run_level(scenario, base_url, concurrency, args.duration, args.requests, args.timeout)
+            result["worker_calls"] = sum(fake_worker.calls.values()) - calls_before
+            print(f"   {result['throughput_rps']} req/s, p50 {result['latency_ms']['p50']} ms, "
+                  f"p99 {result['latency_ms']['p99']} ms, errors {result['error_rate']}, "
+                  f"worker calls {result['worker_calls']}/{result['requests']}", file=sys.stderr)
+            results.append(result)
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "git_revision": git_revision(),
+        "gateway": base_url if args.gateway_url else f"in-process ({args.server})",
+        "config": {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        "results": results,
+    }
+    if gateway is not None:
+        report["persistence"] = gateway.persist_queue.stats()
+        report["firestore_calls"] = gateway.db.calls
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.tolerance)
+        if report["regressions"]:
+            print(f"❌ {len(report['regressions'])} regression(s) against {args.baseline}", file=sys.stderr)
+            exit_code = 1
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+        print(f"✅ Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output, file=report_stream)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
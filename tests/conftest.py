@@ -0,0 +1,108 @@
+"""
+الـ gateway يقرأ إعداداته من env عند الاستيراد: قاعدة المهام و الـ journal و الـ blobs و الـ traces
+تُكتب في مجلد مؤقت بدل مجلد المشروع، وبدون Firebase
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+import pytest
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = tempfile.mkdtemp(prefix="rvc-gateway-tests-")
+
+os.environ.pop("FIREBASE_SERVICE_ACCOUNT", None)
+for key, value in {
+    "JOBS_DB_PATH": f"{STATE_DIR}/jobs.db",
+    "PERSIST_JOURNAL_PATH": f"{STATE_DIR}/firestore_journal.db",
+    "BLOB_DIR": f"{STATE_DIR}/blobs",
+    "TRACE_LOG_PATH": f"{STATE_DIR}/traces.jsonl",
+}.items():
+    os.environ.setdefault(key, value)
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def gateway():
+    import app
+    return app
+
+
+class FakeWorker:
+    """worker بديل لـ Colab على منفذ محلي: نفس شكل الردود، ويعدّ الطلبات لكل endpoint"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.convert_delay = 0.0
+        self.batches = []
+        self._lock = threading.Lock()
+        self.app = Flask("fake-colab")
+        self.app.add_url_rule('/health', view_func=self.health)
+        self.app.add_url_rule('/convert', view_func=self.convert, methods=['POST'])
+        self.app.add_url_rule('/train', view_func=self.train, methods=['POST'])
+        self.app.add_url_rule('/convert/stream', view_func=self.convert_stream, methods=['POST'])
+        self.app.add_url_rule('/convert/batch', view_func=self.convert_batch, methods=['POST'])
+        self._server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    def health(self):
+        return jsonify({"status": "ok", "ready": True})
+
+    def convert(self):
+        self.count('convert')
+        time.sleep(self.convert_delay)
+        return jsonify({"success": True, "data": {"output_path": "/content/output.wav"},
+                        "timings": {"inference_ms": 1.0, "total_ms": 2.0}})
+
+    def train(self):
+        self.count('train')
+        return jsonify({"success": True, "data": {"segments": 1}})
+
+    def convert_stream(self):
+        self.count('convert/stream')
+
+        def events():
+            yield "event: meta\ndata: {}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        return Response(events(), mimetype='text/event-stream')
+
+    def convert_batch(self):
+        """سطر NDJSON لكل عنصر؛ input_audio0 فيه fail = خطأ، وفيه drop = لا سطر (انقطاع الـ worker)"""
+        self.count('convert/batch')
+        data = request.get_json()
+        with self._lock:
+            self.batches.append((data['file_index2'], [item['index'] for item in data['items']]))
+
+        def lines():
+            for item in data['items']:
+                if 'drop' in item['input_audio0']:
+                    continue
+                ok = 'fail' not in item['input_audio0']
+                yield json.dumps({"index": item['index'], "id": item.get('id'), "status": 200 if ok else 500,
+                                  "success": ok, **({} if ok else {"error": "inference failed"})}) + "\n"
+        return Response(lines(), mimetype='application/x-ndjson')
+
+    def stop(self):
+        self._server.shutdown()
+
+
+@pytest.fixture
+def fake_worker(gateway):
+    worker = FakeWorker()
+    worker.worker_id = f"fake-{uuid.uuid4().hex[:8]}"
+    gateway.worker_pool.register(worker.url, worker_id=worker.worker_id, capacity=64)
+    yield worker
+    gateway.worker_pool.remove(worker.worker_id)
+    worker.stop()
@@ -0,0 +1,72 @@
+"""
+تحميل أقسام من الـ colab notebook كـ module للاختبار (بدون خلايا Drive / pip / ngrok).
+الأقسام تُنفّذ بترتيبها في الـ notebook، وأرقام الأسطر في الـ traceback هي أرقام colab نفسها.
+"""
+import os
+import re
+import sys
+import types
+
+COLAB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "colab")
+
+# ما تعرّفه CELL 3 و CELL 5A قبل أول قسم
+PRELUDE = """
+import os
+import sys
+import threading
+import time
+import json
+import base64
+import logging
+from subprocess import Popen
+from time import sleep
+import requests as req
+from flask import Flask, Response, request, jsonify
+
+sr_dict = {"32k": 32000, "40k": 40000, "48k": 48000}
+logger = logging.getLogger(__name__)
+colab_app = Flask("colab_server")
+"""
+
+RULE = re.compile(r"^# ─+$")
+
+
+def read_sections():
+    """{عنوان القسم: (أول سطر, آخر سطر)} — القسم يبدأ من خط ─ الذي يسبق عنوانه"""
+    with open(COLAB_PATH, encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    starts = []
+    for i, line in enumerate(lines[:-1]):
+        opening = RULE.match(line) and not lines[i - 1].startswith("#")
+        if opening and lines[i + 1].startswith("# ") and not RULE.match(lines[i + 1]):
+            starts.append((i, lines[i + 1][2:]))
+    cells = [i for i, line in enumerate(lines) if line.startswith("# ====")]
+    sections = {}
+    for n, (start, title) in enumerate(starts):
+        end = starts[n + 1][0] if n + 1 < len(starts) else len(lines)
+        end = min([end] + [c for c in cells if c > start])
+        sections[title] = (start, end)
+    return lines, sections
+
+
+def load_colab(name, titles, now_dir, **globals_):
+    """
+    ينفّذ الأقسام التي تبدأ عناوينها بـ titles (بترتيب الـ notebook) داخل module جديد.
+    الـ module يُسجّل في sys.modules حتى تعمل الدوال داخل ProcessPoolExecutor
+    """
+    lines, sections = read_sections()
+    chosen = []
+    for prefix in titles:
+        matches = [span for title, span in sections.items() if title.startswith(prefix)]
+        if len(matches) != 1:
+            raise KeyError(f"colab section {prefix!r}: {len(matches)} match(es)")
+        chosen.append(matches[0])
+
+    module = types.ModuleType(name)
+    module.__dict__.update(now_dir=now_dir, RVC_PATH=now_dir, **globals_)
+    sys.modules[name] = module
+    exec(compile(PRELUDE, f"<{name} prelude>", "exec"), module.__dict__)
+    for start, end in sorted(chosen):
+        source = "\n" * start + "\n".join(lines[start:end])
+        exec(compile(source, COLAB_PATH, "exec"), module.__dict__)
+    return module
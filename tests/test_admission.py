@@ -0,0 +1,120 @@
+"""
+طبقة القبول: المهام الخلفية لها حدها الخاص لكل مستخدم ولا تمنع التحويل، إلغاء المهمة يحرر
+الـ thread الذي ينتظر دورها، و tokens تُخصم فقط عند إنشاء المهمة، والمفتاح بدون user_id هو IP العميل
+"""
+import threading
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def admission(gateway, monkeypatch):
+    monkeypatch.setattr(gateway, "ADMISSION_MAX_CONCURRENT", 16)
+    monkeypatch.setattr(gateway, "ADMISSION_BACKGROUND_MAX", 8)
+    monkeypatch.setattr(gateway, "ADMISSION_USER_MAX_CONCURRENT", 2)
+    monkeypatch.setattr(gateway, "ADMISSION_USER_BACKGROUND_MAX", 1)
+    controller = gateway.AdmissionController()
+    monkeypatch.setattr(gateway, "admission", controller)
+    return controller
+
+
+def test_background_jobs_do_not_block_convert(gateway, admission):
+    trains = [admission.enqueue('train', 'u1', ref=f"job-{index}") for index in range(2)]
+    assert trains[0].granted.is_set() and not trains[1].granted.is_set()
+
+    # قبل الفصل: تدريبان لنفس المستخدم = الحد (2)، والتحويل ينتظر حتى timeout ثم 429
+    converts = [admission.acquire('convert', 'u1', timeout=0.1) for _ in range(2)]
+    assert all(ticket.granted.is_set() for ticket in converts)
+    assert admission.stats()["running_background"] == 1
+
+
+def test_per_user_background_cap_does_not_hold_other_users(gateway, admission):
+    first = admission.enqueue('train', 'u1', ref="u1-a")
+    second = admission.enqueue('train', 'u1', ref="u1-b")
+    other = admission.enqueue('preprocess', 'u2', ref="u2-a")
+
+    assert first.granted.is_set() and other.granted.is_set()
+    assert not second.granted.is_set()
+    assert admission.position("u1-b") == 1
+
+    admission.release(first)
+    assert second.granted.is_set()
+
+
+def test_withdraw_wakes_a_waiting_job(gateway, admission):
+    admission.enqueue('train', 'u1', ref="running")
+    waiting = admission.enqueue('train', 'u1', ref="waiting")
+    woke = threading.Event()
+
+    def wait():
+        admission.wait(waiting, timeout=None)
+        woke.set()
+
+    threading.Thread(target=wait, daemon=True).start()
+    assert admission.withdraw("waiting")
+    assert woke.wait(2) and waiting.withdrawn
+    assert admission.stats()["waiting"] == 0
+    admission.release(waiting)  # لا يغير شيئاً
+    assert admission.stats()["running"] == 1
+    assert not admission.withdraw("waiting")
+
+
+def test_cancel_releases_the_job_thread_waiting_for_admission(gateway, admission):
+    user_id = f"user_{uuid.uuid4().hex[:8]}"
+    busy = admission.enqueue('train', user_id, ref="busy")
+    job_id = gateway.create_job('train', user_id, {})
+    runner = threading.Thread(target=gateway._run_job, args=(job_id,), daemon=True)
+    runner.start()
+    deadline = time.time() + 2
+    while admission.position(job_id) is None and time.time() < deadline:
+        time.sleep(0.01)
+    assert admission.position(job_id) == 1
+
+    assert gateway.cancel_job(job_id)["state"] == 'cancelled'
+    runner.join(2)
+    assert not runner.is_alive()
+    assert admission.stats()["running"] == 1
+    admission.release(busy)
+    assert admission.stats()["running"] == 0
+
+
+def test_rejected_job_keeps_its_tokens(gateway, admission, fake_worker, monkeypatch):
+    monkeypatch.setattr(gateway, "ADMISSION_USER_RATE", 0.001)
+    monkeypatch.setattr(gateway, "ADMISSION_USER_BURST", 20)
+    monkeypatch.setattr(gateway, "ADMISSION_USER_MAX_JOBS", 1)
+    monkeypatch.setattr(gateway, "submit_job", lambda job_id: None)
+    user_id = f"user_{uuid.uuid4().hex[:8]}"
+    client = gateway.app.test_client()
+    payload = {"exp_dir1": "voice", "trainset_dir4": "http://audio/a.wav", "user_id": user_id}
+
+    assert client.post('/api/train', json=payload).status_code == 202
+    tokens = admission._bucket(user_id).tokens
+    assert tokens == pytest.approx(10, abs=0.1)
+
+    response = client.post('/api/train', json=payload)
+    assert response.status_code == 429
+    assert response.get_json()["reason"] == "user_jobs"
+    assert admission._bucket(user_id).tokens == pytest.approx(tokens, abs=0.1)
+
+
+def test_anonymous_requests_are_keyed_by_forwarded_client(gateway, admission, monkeypatch):
+    keys = []
+    monkeypatch.setattr(admission, "charge", lambda kind, user_key, **kwargs: keys.append(user_key))
+    client = gateway.app.test_client()
+    for address in ("203.0.113.7", "198.51.100.9"):
+        client.post('/api/convert', json={"file_index2": "voice"},
+                    headers={"X-Forwarded-For": f"10.0.0.1, {address}"})
+
+    assert keys == ["ip:203.0.113.7", "ip:198.51.100.9"]
+
+
+def test_asgi_anonymous_key_reads_forwarded_for(gateway):
+    asgi = pytest.importorskip("asgi")
+    from starlette.requests import Request
+
+    request = Request({"type": "http", "headers": [(b"x-forwarded-for", b"203.0.113.7")],
+                       "client": ("10.0.0.2", 443)})
+    assert asgi._admission_key(request, None) == "ip:203.0.113.7"
+    assert asgi._admission_key(request, "user_1") == "user_1"
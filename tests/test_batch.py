@@ -0,0 +1,81 @@
+"""
+/api/convert/batch: العناصر تُجمع حسب النموذج (طلب واحد للـ worker لكل مجموعة)، العناصر الناقصة
+ترجع خطأ فوراً بدون الـ worker، وآخر سطر NDJSON ملخص {"done": true}
+"""
+import json
+import uuid
+
+
+def post_batch(gateway, items, **extra):
+    response = gateway.app.test_client().post('/api/convert/batch', json={
+        "user_id": f"user_{uuid.uuid4().hex[:8]}",
+        "defaults": {"file_index2": "voice_a"},
+        "items": items,
+        **extra,
+    })
+    return response, [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_items_are_grouped_by_model(gateway, fake_worker):
+    items = [
+        {"id": "a1", "input_audio0": "http://audio/1.wav"},
+        {"id": "b1", "input_audio0": "http://audio/2.wav", "file_index2": "voice_b"},
+        {"id": "a2", "input_audio0": "http://audio/3.wav", "vc_transform0": 12},
+    ]
+    response, lines = post_batch(gateway, items)
+
+    assert response.status_code == 200 and response.mimetype == 'application/x-ndjson'
+    assert fake_worker.calls['convert/batch'] == 2
+    assert sorted(fake_worker.batches) == [
+        (gateway.default_voice_paths("voice_a")[0], [0, 2]),
+        (gateway.default_voice_paths("voice_b")[0], [1]),
+    ]
+    results = {line["index"]: line for line in lines[:-1]}
+    assert sorted(results) == [0, 1, 2]
+    assert [results[index]["id"] for index in range(3)] == ["a1", "b1", "a2"]
+    assert all(result["worker_id"] == fake_worker.worker_id for result in results.values())
+
+
+def test_incomplete_items_fail_early(gateway, fake_worker):
+    items = [
+        {"id": "ok", "input_audio0": "http://audio/1.wav"},
+        {"id": "no-audio"},
+        "not an item",
+        {"id": "no-voice", "input_audio0": "http://audio/2.wav", "file_index2": ""},
+    ]
+    _, lines = post_batch(gateway, items)
+
+    # الأخطاء الفورية أولاً، قبل أي نتيجة من الـ worker
+    assert [line["index"] for line in lines[:3]] == [1, 2, 3]
+    assert all(not line["success"] and "required" in line["error"] for line in lines[:3])
+    assert lines[3]["index"] == 0 and lines[3]["success"]
+    assert fake_worker.batches == [(gateway.default_voice_paths("voice_a")[0], [0])]
+
+
+def test_summary_counts_worker_failures_and_missing_results(gateway, fake_worker):
+    items = [
+        {"input_audio0": "http://audio/1.wav"},
+        {"input_audio0": "http://audio/fail.wav"},
+        {"input_audio0": "http://audio/drop.wav"},
+        {"input_audio0": "http://audio/2.wav", "file_index2": "voice_b"},
+        {},
+    ]
+    _, lines = post_batch(gateway, items)
+    summary = lines[-1]
+
+    assert summary["done"] is True
+    assert (summary["total"], summary["succeeded"], summary["failed"], summary["groups"]) == (5, 2, 3, 2)
+    assert summary["admission"]["kind"] == "convert"
+    results = {line["index"]: line for line in lines[:-1]}
+    assert results[1]["error"] == "inference failed"
+    assert results[2] == {"index": 2, "success": False, "error": "No result from Colab"}
+    assert gateway.admission.stats()["running"] == 0
+
+
+def test_invalid_batches_are_rejected(gateway, fake_worker, monkeypatch):
+    monkeypatch.setattr(gateway, "BATCH_MAX_ITEMS", 2)
+    assert post_batch(gateway, [])[0].status_code == 400
+    response, _ = post_batch(gateway, [{"input_audio0": "http://audio/1.wav"}] * 3)
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Too many items (max 2)"
+    assert fake_worker.calls['convert/batch'] == 0
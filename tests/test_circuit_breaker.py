@@ -0,0 +1,111 @@
+"""
+الطلب التجريبي في half_open: أي نهاية بدون نجاح أو فشل من الـ worker يجب أن تحرّره
+"""
+import asyncio
+
+import httpx
+import pytest
+import requests
+
+
+@pytest.fixture
+def client(gateway):
+    return gateway.ColabClient(pool_size=2, max_retries=0, backoff=0, breaker_threshold=1, breaker_reset=0)
+
+
+def half_open(client, worker):
+    breaker = client.breaker(worker["worker_id"])
+    breaker.record_failure()  # threshold=1 و reset=0: الطلب التالي هو الطلب التجريبي
+    return breaker
+
+
+def test_trial_released_after_local_error(client):
+    worker = {"worker_id": "w-invalid-url", "url": "http://"}
+    breaker = half_open(client, worker)
+
+    with pytest.raises(requests.exceptions.InvalidURL):
+        client.post(worker, "/convert")
+
+    assert breaker.snapshot()["state"] == "half_open"
+    assert breaker.available()
+    assert breaker.allow()
+
+
+@pytest.mark.parametrize("error", [requests.exceptions.ChunkedEncodingError, ValueError, KeyboardInterrupt])
+def test_trial_released_after_any_exception(client, monkeypatch, error):
+    worker = {"worker_id": f"w-{error.__name__}", "url": "http://127.0.0.1:9"}
+    breaker = half_open(client, worker)
+
+    def fail(*args, **kwargs):
+        raise error("boom")
+
+    monkeypatch.setattr(client.session, "request", fail)
+    with pytest.raises(error):
+        client.post(worker, "/convert")
+
+    assert breaker.available()
+    assert breaker.allow()
+    assert not breaker.allow()  # طلب تجريبي واحد فقط في نفس الوقت
+
+
+def test_transport_failure_still_reopens(client):
+    worker = {"worker_id": "w-refused", "url": "http://127.0.0.1:9"}
+    breaker = half_open(client, worker)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(worker, "/convert", timeout=2)
+
+    assert breaker.snapshot()["state"] == "open"
+    breaker.reset_timeout = 60
+    assert not breaker.allow()
+
+
+@pytest.fixture
+def async_colab(gateway):
+    import asgi
+    stalled = asyncio.Event()
+
+    async def handler(request):
+        if request.url.path == "/decode-error":
+            raise httpx.DecodingError("bad gzip")
+        stalled.set()
+        await asyncio.sleep(30)
+
+    async_client = asgi.AsyncColabClient()
+    async_client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    async_client.stalled = stalled
+    return async_client
+
+
+def test_async_trial_released_when_cancelled(gateway, async_colab):
+    worker = {"worker_id": "w-async-cancel", "url": "http://worker"}
+    breaker = gateway.colab_client.breaker(worker["worker_id"])
+    breaker.reset_timeout = 0
+    for _ in range(gateway.colab_client.breaker_threshold):
+        breaker.record_failure()  # open، و reset=0: الطلب التالي تجريبي
+
+    async def run():
+        task = asyncio.create_task(async_colab.request("POST", worker, "/convert"))
+        await async_colab.stalled.wait()
+        assert not breaker.available()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert breaker.available()
+    assert breaker.allow()
+
+
+def test_async_trial_released_after_non_transport_error(gateway, async_colab):
+    worker = {"worker_id": "w-async-decode", "url": "http://worker"}
+    breaker = gateway.colab_client.breaker(worker["worker_id"])
+    breaker.reset_timeout = 0
+    for _ in range(gateway.colab_client.breaker_threshold):
+        breaker.record_failure()
+
+    with pytest.raises(httpx.DecodingError):
+        asyncio.run(async_colab.request("POST", worker, "/decode-error"))
+
+    assert breaker.available()
+    assert breaker.allow()
@@ -0,0 +1,55 @@
+"""
+N طلبات /api/convert متطابقة في نفس الوقت (double tap / retry): الـ worker ينفذ مرة واحدة فقط
+(نفس سيناريو bench.py --scenarios convert-dup لكن بتحقق فعلي من عدّاد الـ worker)
+"""
+import threading
+import uuid
+
+CONCURRENCY = 8
+
+
+def convert_concurrently(gateway, payloads):
+    barrier = threading.Barrier(len(payloads))
+    responses = [None] * len(payloads)
+
+    def send(index):
+        client = gateway.app.test_client()
+        barrier.wait()
+        response = client.post('/api/convert', json=payloads[index])
+        responses[index] = (response.status_code, response.get_json())
+
+    threads = [threading.Thread(target=send, args=(index,)) for index in range(len(payloads))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return responses
+
+
+def dup_payload(user_id, **extra):
+    return {"file_index2": "voice-dup", "input_audio0": "http://audio/dup.wav",
+            "user_id": user_id, "vc_transform0": 0, **extra}
+
+
+def test_identical_concurrent_converts_call_worker_once(gateway, fake_worker):
+    fake_worker.convert_delay = 0.5
+    user_id = f"user_{uuid.uuid4().hex[:8]}"
+
+    responses = convert_concurrently(gateway, [dup_payload(user_id) for _ in range(CONCURRENCY)])
+
+    assert fake_worker.calls['convert'] == 1
+    assert all(status == 200 and body["success"] for status, body in responses)
+    assert sum(body["coalesced"] for _, body in responses) == CONCURRENCY - 1
+    assert {body["data"]["data"]["output_path"] for _, body in responses} == {"/content/output.wav"}
+
+
+def test_different_or_opted_out_converts_are_not_coalesced(gateway, fake_worker):
+    fake_worker.convert_delay = 0.3
+    user_id = f"user_{uuid.uuid4().hex[:8]}"
+    payloads = [dup_payload(user_id, vc_transform0=index) for index in range(2)]
+    payloads += [dup_payload(user_id, coalesce=False) for _ in range(2)]
+
+    responses = convert_concurrently(gateway, payloads)
+
+    assert fake_worker.calls['convert'] == len(payloads)
+    assert all(status == 200 and not body["coalesced"] for status, body in responses)
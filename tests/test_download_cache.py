@@ -0,0 +1,162 @@
+"""
+DownloadCache أمام سيرفر HTTP محلي: طلبات متزامنة لنفس URL = تحميل واحد، الملف المحجوز لا يُحذف،
+LRU حسب الحجم، الأخطاء لا تُخزن، وبعد DOWNLOAD_REVALIDATE_AFTER طلب شرطي (304)
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from notebook import load_colab
+
+FILES = {f"/{name}.wav": name.encode().ljust(100, b"\0") for name in ("a", "b", "c")}
+FILES["/a-mirror.wav"] = FILES["/a.wav"]
+
+
+class Handler(BaseHTTPRequestHandler):
+    delay = 0.0
+    gets = Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with Handler.lock:
+            Handler.gets[self.path] += 1
+        time.sleep(Handler.delay)
+        body = FILES.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = f'"{self.path[1:]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+@pytest.fixture(scope="module")
+def colab(tmp_path_factory):
+    module = load_colab("colab_download_cache", ["Model Manager", "Download Cache"],
+                        str(tmp_path_factory.mktemp("rvc")))
+    yield module
+    sys.modules.pop("colab_download_cache", None)
+
+
+@pytest.fixture
+def cache(colab, tmp_path):
+    Handler.delay = 0.0
+    Handler.gets.clear()
+    return colab.DownloadCache(str(tmp_path / "downloads"), budget_bytes=250, revalidate_after=3600)
+
+
+def fetch(cache, url):
+    with cache.fetch(url) as path:
+        with open(path, "rb") as f:
+            return path, f.read()
+
+
+def test_concurrent_fetches_download_once(cache, server):
+    Handler.delay = 0.2
+    barrier = threading.Barrier(8)
+    results = []
+
+    def use():
+        barrier.wait()
+        results.append(fetch(cache, f"{server}/a.wav"))
+
+    threads = [threading.Thread(target=use) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert Handler.gets["/a.wav"] == 1
+    assert len(results) == 8 and len(set(results)) == 1
+    assert results[0][1] == FILES["/a.wav"]
+    stats = cache.stats()
+    assert stats["downloads"] == 1 and stats["coalesced"] + stats["hits"] == 7
+    assert all(entry["refs"] == 0 for entry in cache._files.values())
+
+
+def test_same_content_from_two_urls_is_stored_once(cache, server):
+    path, _ = fetch(cache, f"{server}/a.wav")
+    mirror, _ = fetch(cache, f"{server}/a-mirror.wav")
+    assert path == mirror
+    assert cache.stats()["files"] == 1 and cache.stats()["urls"] == 2
+
+
+def test_lru_eviction_by_size(cache, server):
+    for name in ("a", "b", "a", "c"):  # a أحدث من b عند تحميل c
+        fetch(cache, f"{server}/{name}.wav")
+
+    assert cache.stats()["evictions"] == 1 and cache.stats()["files"] == 2
+    fetch(cache, f"{server}/a.wav")
+    fetch(cache, f"{server}/b.wav")
+    assert Handler.gets == {"/a.wav": 1, "/b.wav": 2, "/c.wav": 1}
+
+
+def test_files_in_use_are_not_evicted(cache, server):
+    with cache.fetch(f"{server}/a.wav") as held:
+        for name in ("b", "c"):
+            fetch(cache, f"{server}/{name}.wav")
+        # a محجوز: b خرج بدلاً منه رغم أنه أحدث
+        assert os.path.exists(held)
+        assert cache.stats()["evictions"] == 1
+    fetch(cache, f"{server}/b.wav")
+    assert Handler.gets["/a.wav"] == 1 and not os.path.exists(held)
+
+
+def test_errors_are_shared_by_waiters_and_not_cached(cache, server, colab):
+    Handler.delay = 0.2
+    barrier = threading.Barrier(4)
+    errors = []
+
+    def use():
+        barrier.wait()
+        try:
+            fetch(cache, f"{server}/missing.wav")
+        except colab.DownloadError as e:
+            errors.append(e.status_code)
+
+    threads = [threading.Thread(target=use) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert errors == [404] * 4 and Handler.gets["/missing.wav"] == 1
+    with pytest.raises(colab.DownloadError):
+        fetch(cache, f"{server}/missing.wav")
+    assert Handler.gets["/missing.wav"] == 2
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_stale_url_is_revalidated(cache, server):
+    cache.revalidate_after = 0
+    first, _ = fetch(cache, f"{server}/a.wav")
+    second, body = fetch(cache, f"{server}/a.wav")
+
+    assert first == second and body == FILES["/a.wav"]
+    stats = cache.stats()
+    assert (stats["downloads"], stats["revalidated"]) == (1, 1)
+    assert Handler.gets["/a.wav"] == 2
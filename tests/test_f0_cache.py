@@ -0,0 +1,144 @@
+"""
+F0 Cache بـ numpy فقط: shift_f0 على منحنى محفوظ بدون transpose يساوي حساب Pipeline.get_f0 الأصلي
+في RVC (f0_coarse و f0bak) لكل transpose، و install_f0_cache يستخرج المنحنى مرة واحدة، و LRU حسب الحجم
+"""
+import os
+import sys
+import time
+import types
+
+import numpy as np
+import pytest
+
+from notebook import load_colab
+
+
+def rvc_get_f0_tail(f0, f0_up_key):
+    """نهاية Pipeline.get_f0 في RVC كما هي (بعد الاستخراج، بدون inp_f0)"""
+    f0_min = 50
+    f0_max = 1100
+    f0_mel_min = 1127 * np.log(1 + f0_min / 700)
+    f0_mel_max = 1127 * np.log(1 + f0_max / 700)
+    f0 = f0.copy()
+    f0 *= pow(2, f0_up_key / 12)
+    f0bak = f0.copy()
+    f0_mel = 1127 * np.log(1 + f0 / 700)
+    f0_mel[f0_mel > 0] = (f0_mel[f0_mel > 0] - f0_mel_min) * 254 / (f0_mel_max - f0_mel_min) + 1
+    f0_mel[f0_mel <= 1] = 1
+    f0_mel[f0_mel > 255] = 255
+    f0_coarse = np.rint(f0_mel).astype(np.int32)
+    return f0_coarse, f0bak
+
+
+def pitch_curve(frames=3000, dtype=np.float32, seed=0):
+    """منحنى مثل rmvpe: مقاطع صامتة (0)، قيم تحت f0_min وفوق f0_max بعد الـ transpose"""
+    rng = np.random.default_rng(seed)
+    f0 = rng.uniform(40, 1200, frames)
+    f0[rng.random(frames) < 0.3] = 0
+    f0[:50] = 0
+    return f0.astype(dtype)
+
+
+class FakePipeline:
+    """بديل infer.modules.vc.pipeline.Pipeline: الاستخراج دالة ثابتة للصوت، ونهايته هي كود RVC"""
+    sr = 16000
+    extractions = 0
+
+    def get_f0(self, input_audio_path, x, p_len, f0_up_key, f0_method, filter_radius, inp_f0=None):
+        FakePipeline.extractions += 1
+        f0 = (np.abs(x[::160][:p_len]) * 1000).astype(np.float32)
+        f0[f0 < 30] = 0
+        return rvc_get_f0_tail(f0, f0_up_key)
+
+
+@pytest.fixture(scope="module")
+def colab(tmp_path_factory):
+    module = load_colab("colab_f0_cache", ["Model Manager", "Download Cache", "F0 Cache"],
+                        str(tmp_path_factory.mktemp("rvc")))
+    yield module
+    sys.modules.pop("colab_f0_cache", None)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_shift_matches_rvc_for_every_transpose(colab, dtype):
+    f0 = pitch_curve(dtype=dtype)
+    f0.flags.writeable = False  # مثل np.load(mmap_mode="r") من الـ cache
+    for f0_up_key in range(-24, 25):
+        coarse, f0bak = colab.shift_f0(f0, f0_up_key)
+        expected_coarse, expected_bak = rvc_get_f0_tail(f0, f0_up_key)
+        assert np.array_equal(coarse, expected_coarse), f0_up_key
+        assert np.array_equal(f0bak, expected_bak) and f0bak.dtype == expected_bak.dtype
+        assert coarse.dtype == np.int32 and coarse.min() >= 1 and coarse.max() <= 255
+
+
+def test_cached_curve_round_trip_matches_rvc(colab, tmp_path):
+    cache = colab.F0Cache(str(tmp_path / "f0"), budget_bytes=1 << 20)
+    f0 = pitch_curve()
+    cache.put("clip", f0, extract_ms=120.0)
+    cached = cache.get("clip")
+
+    assert isinstance(cached, np.memmap)
+    for f0_up_key in (-12, 0, 7):
+        coarse, f0bak = colab.shift_f0(cached, f0_up_key)
+        expected_coarse, expected_bak = rvc_get_f0_tail(f0, f0_up_key)
+        assert np.array_equal(coarse, expected_coarse) and np.array_equal(f0bak, expected_bak)
+    assert cache.stats()["extract_ms_saved"] == 120.0
+
+
+def test_installed_cache_extracts_once_for_all_transposes(colab, tmp_path, monkeypatch):
+    pipeline_module = types.ModuleType("infer.modules.vc.pipeline")
+    pipeline_module.Pipeline = type("Pipeline", (FakePipeline,), {})
+    for name in ("infer", "infer.modules", "infer.modules.vc"):
+        monkeypatch.setitem(sys.modules, name, types.ModuleType(name))
+    monkeypatch.setitem(sys.modules, "infer.modules.vc.pipeline", pipeline_module)
+    monkeypatch.setattr(colab, "f0_cache", colab.F0Cache(str(tmp_path / "f0"), budget_bytes=1 << 20))
+    monkeypatch.setattr(colab, "F0_CACHE_ENABLED", True)
+    colab.install_f0_cache()
+
+    x = np.sin(np.linspace(0, 200, 16000 * 5)).astype(np.float32)
+    p_len = len(x) // 160
+    pipeline = pipeline_module.Pipeline()
+    FakePipeline.extractions = 0
+    for f0_up_key in (0, 2, 4, 7, -3, 12):
+        coarse, f0bak = pipeline.get_f0("clip.wav", x, p_len, f0_up_key, "rmvpe", 3)
+        expected_coarse, expected_bak = FakePipeline.get_f0(pipeline, "clip.wav", x, p_len, f0_up_key,
+                                                            "rmvpe", 3)
+        assert np.array_equal(coarse, expected_coarse) and np.array_equal(f0bak, expected_bak)
+
+    # استخراج واحد عبر الـ cache + استخراج المرجع في كل دورة
+    assert FakePipeline.extractions == 1 + 6
+    assert colab.f0_cache.stats()["hits"] == 5
+    assert colab.f0_cache.take_status() == "mixed"
+
+    # f0_file يمر للأصل بدون cache
+    inp_f0 = np.array([[0.0, 200.0], [1.0, 220.0]])
+    pipeline.get_f0("clip.wav", x, p_len, 0, "rmvpe", 3, inp_f0)
+    assert colab.f0_cache.stats()["misses"] == 1
+
+
+def test_lru_eviction_by_size(colab, tmp_path):
+    entry_bytes = len(pitch_curve(1000).tobytes()) + 128  # + header الـ .npy
+    cache = colab.F0Cache(str(tmp_path / "f0"), budget_bytes=int(entry_bytes * 2.5))
+    for key in ("a", "b"):
+        cache.put(key, pitch_curve(1000), extract_ms=10.0)
+    assert cache.get("a") is not None   # a أحدث استخدام الآن
+    cache.put("c", pitch_curve(1000), extract_ms=10.0)
+
+    assert cache.get("b") is None
+    assert not os.path.exists(cache._path("b"))
+    assert cache.get("a") is not None and cache.get("c") is not None
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"], stats["stores"]) == (2, 1, 3)
+
+
+def test_lru_order_survives_restart(colab, tmp_path):
+    root = str(tmp_path / "f0")
+    cache = colab.F0Cache(root, budget_bytes=1 << 20)
+    for key in ("a", "b"):
+        cache.put(key, pitch_curve(100), extract_ms=1.0)
+        time.sleep(0.01)
+    time.sleep(0.01)
+    cache.get("a")  # يحدّث mtime
+
+    reloaded = colab.F0Cache(root, budget_bytes=1 << 20)
+    assert list(reloaded._entries) == ["b", "a"]
@@ -0,0 +1,116 @@
+"""
+/train ingest: تحميل + فك الـ archives + decode / slice / resample الحقيقي من RVC داخل الـ process pool.
+يحتاج نسخة RVC (RVC_PATH) فيها infer/lib/audio.py و infer/lib/slicer2.py، و librosa / scipy / ffmpeg
+"""
+import functools
+import io
+import os
+import sys
+import threading
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from notebook import load_colab
+
+sf = pytest.importorskip("soundfile")
+pytest.importorskip("librosa")
+wavfile = pytest.importorskip("scipy.io.wavfile")
+
+RVC_PATH = os.environ.get("RVC_PATH")
+if not RVC_PATH or not os.path.exists(os.path.join(RVC_PATH, "infer", "lib", "slicer2.py")):
+    pytest.skip("RVC_PATH must point to an RVC checkout", allow_module_level=True)
+sys.path.insert(0, RVC_PATH)
+
+SR = 44100
+VOICED_SECONDS = 2.5
+
+
+def speech_like(bursts, seed):
+    """مقاطع صوت (أساس + توافقيات) بينها صمت، حتى يقسّمها الـ Slicer"""
+    rng = np.random.default_rng(seed)
+    parts = []
+    for _ in range(bursts):
+        t = np.arange(int(VOICED_SECONDS * SR)) / SR
+        f0 = rng.uniform(110, 220)
+        tone = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6))
+        parts += [0.3 * tone / np.abs(tone).max(), np.zeros(int(0.8 * SR))]
+    return np.concatenate(parts).astype(np.float32)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    files = tmp_path / "files"
+    files.mkdir()
+    sf.write(files / "a.wav", speech_like(3, 1), SR)
+    sf.write(files / "b.wav", speech_like(2, 2), SR)
+    (files / "corrupt.wav").write_bytes(b"RIFF not really audio" * 100)
+    flac = io.BytesIO()
+    sf.write(flac, speech_like(2, 3), SR, format="FLAC")
+    with zipfile.ZipFile(files / "set.zip", "w") as zf:
+        zf.writestr("voice/c.flac", flac.getvalue())
+        zf.writestr("voice/readme.txt", "not audio")
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(files)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    monkeypatch.setenv("WORKSPACE_ROOT", str(tmp_path / "workspaces"))
+    monkeypatch.setenv("INGEST_PROCESSES", "2")
+    module = load_colab("colab_ingest", ["Progress Tracking", "STEP 1 (train)", "Model Manager",
+                                         "Download Cache", "Workspaces"], str(tmp_path / "rvc"))
+    yield module
+    module.ingest_pool().shutdown(cancel_futures=True)
+    sys.modules.pop("colab_ingest", None)
+
+
+def test_ingest_slices_real_audio(worker, server):
+    sources = [f"{server}/a.wav", f"{server}/b.wav", f"{server}/set.zip",
+               f"{server}/corrupt.wav", f"{server}/missing.wav"]
+    with worker.workspaces.open("train", "user_1", discard=True) as ws:
+        stats, log = worker.ingest_dataset(sources, "exp1", "40k", ws)
+
+    assert stats["files"] == 3, stats["errors"]
+    assert stats["failed"] == 2
+    assert {e["source"].rsplit("/", 1)[1] for e in stats["errors"]} == {"corrupt.wav", "missing.wav"}
+    assert f"{server}/set.zip#voice/c.flac\t-> Success" in log.split("\n")
+
+    exp_path = f"{worker.now_dir}/logs/exp1"
+    gt = sorted(os.listdir(f"{exp_path}/0_gt_wavs"))
+    assert gt == sorted(os.listdir(f"{exp_path}/1_16k_wavs"))
+    assert len(gt) == stats["segments"] > 0
+
+    seconds = 0.0
+    for name in gt:
+        sr, audio = wavfile.read(f"{exp_path}/0_gt_wavs/{name}")
+        sr16, audio16 = wavfile.read(f"{exp_path}/1_16k_wavs/{name}")
+        assert (sr, sr16) == (40000, 16000)
+        assert audio.dtype == audio16.dtype == np.float32
+        assert 0 < np.abs(audio).max() <= 1.0
+        assert abs(len(audio16) - len(audio) * 16000 / 40000) <= 2
+        seconds += len(audio) / sr
+    # كل المقاطع المسموعة وصلت (التداخل بين المقاطع يزيد الطول قليلاً فقط)
+    assert seconds >= 0.9 * 7 * VOICED_SECONDS
+
+    for key in ("download_ms", "decode_ms", "slice_ms", "write_ms", "ingest_wall_ms"):
+        assert stats[key] > 0
+    assert worker.progress_tracker.snapshot("exp1")["state"] == "completed"
+    assert all(entry["refs"] == 0 for entry in worker.download_cache._files.values())
+    assert worker.workspaces.stats()["active"] == 0
+
+
+def test_ingest_without_usable_audio_is_rejected(worker, server):
+    with worker.workspaces.open("train", "user_1", discard=True) as ws:
+        with pytest.raises(ValueError, match="No usable audio"):
+            worker.ingest_dataset([f"{server}/corrupt.wav"], "exp2", "40k", ws)
@@ -0,0 +1,156 @@
+"""
+/train ingest بدون RVC: ingest_file بديل (بدون librosa / scipy) حتى يُختبر كل ما حوله في كل تشغيل —
+التحميل المتوازي، فك zip / tar، أخطاء 404 والملفات التالفة، وتحرير download_cache و الـ workspaces
+"""
+import functools
+import io
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from notebook import load_colab
+
+DOWNLOAD_DELAY = 0.2
+
+
+def fake_ingest_file(path, idx0, sr, exp_path):
+    """بديل ingest_file داخل الـ process pool: ملف يبدأ بـ BAD = decode فشل، غير ذلك مقطع واحد"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(b"BAD"):
+        return {"ok": False, "error": "RuntimeError: cannot decode", "segments": 0,
+                "decode_ms": 1.0, "slice_ms": 0.0, "write_ms": 0.0}
+    with open(f"{exp_path}/0_gt_wavs/{idx0}_0.wav", "wb") as f:
+        f.write(data)
+    return {"ok": True, "segments": 1, "filtered": 0, "seconds": len(data) / sr,
+            "decode_ms": 1.0, "slice_ms": 1.0, "write_ms": 1.0}
+
+
+class SlowHandler(SimpleHTTPRequestHandler):
+    """كل تحميل يأخذ DOWNLOAD_DELAY، ونسجل أكبر عدد تحميلات في نفس الوقت"""
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with SlowHandler.lock:
+            SlowHandler.active += 1
+            SlowHandler.peak = max(SlowHandler.peak, SlowHandler.active)
+        try:
+            time.sleep(DOWNLOAD_DELAY)
+            super().do_GET()
+        finally:
+            with SlowHandler.lock:
+                SlowHandler.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    files = tmp_path / "files"
+    files.mkdir()
+    for name in ("a.wav", "b.wav", "c.wav"):
+        (files / name).write_bytes(f"audio {name}".encode() * 50)
+    (files / "corrupt.wav").write_bytes(b"BAD" + b"\0" * 100)
+    with zipfile.ZipFile(files / "set.zip", "w") as zf:
+        zf.writestr("voice/d.flac", b"audio d" * 50)
+        zf.writestr("voice/e.wav", b"audio e" * 50)
+        zf.writestr("voice/readme.txt", "not audio")
+        zf.writestr("voice/.hidden.wav", b"audio hidden")
+    with tarfile.open(files / "set.tar.gz", "w:gz") as tf:
+        for name, data in (("../../escape.wav", b"audio f" * 50), ("notes.md", b"text")):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+    SlowHandler.active = SlowHandler.peak = 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(SlowHandler, directory=str(files)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    monkeypatch.setenv("WORKSPACE_ROOT", str(tmp_path / "workspaces"))
+    monkeypatch.setenv("INGEST_PROCESSES", "2")
+    monkeypatch.setenv("INGEST_DOWNLOAD_WORKERS", "4")
+    module = load_colab("colab_ingest_pipeline", ["Progress Tracking", "STEP 1 (train)", "Model Manager",
+                                                  "Download Cache", "Workspaces"], str(tmp_path / "rvc"))
+    module.ingest_file = fake_ingest_file
+    module.ingest_pool(reset=True)  # الـ processes الجديدة ترى البديل
+    yield module
+    module.ingest_pool().shutdown(cancel_futures=True)
+    sys.modules.pop("colab_ingest_pipeline", None)
+
+
+def test_ingest_pipeline_without_rvc(worker, server, tmp_path):
+    sources = [f"{server}/a.wav", f"{server}/b.wav", f"{server}/c.wav", f"{server}/set.zip",
+               f"{server}/set.tar.gz", f"{server}/corrupt.wav", f"{server}/missing.wav"]
+    t0 = time.perf_counter()
+    with worker.workspaces.open("train", "user_1", discard=True) as ws:
+        stats, log = worker.ingest_dataset(sources, "exp1", "40k", ws)
+        extracted = sorted(os.listdir(ws.path))
+        assert all(name.startswith("src") for name in extracted)
+    wall = time.perf_counter() - t0
+
+    # 7 تحميلات × 0.2 s بالتوالي = 1.4 s؛ بـ 4 threads أقل بكثير
+    assert SlowHandler.peak >= 3
+    assert wall < len(sources) * DOWNLOAD_DELAY
+
+    assert stats["files"] == 6, stats["errors"]
+    assert stats["segments"] == 6
+    assert stats["failed"] == 2
+    assert {e["source"].rsplit("/", 1)[1] for e in stats["errors"]} == {"corrupt.wav", "missing.wav"}
+    assert [e["error"] for e in stats["errors"] if e["source"].endswith("corrupt.wav")] == \
+        ["RuntimeError: cannot decode"]
+
+    lines = log.split("\n")
+    assert f"{server}/set.zip#voice/d.flac\t-> Success" in lines
+    assert f"{server}/set.zip#voice/e.wav\t-> Success" in lines
+    assert f"{server}/set.tar.gz#../../escape.wav\t-> Success" in lines
+    assert not any("readme" in line or "hidden" in line or "notes" in line for line in lines)
+    # عضو الـ tar باسم ../../ كُتب داخل الـ workspace باسم محلي فقط
+    assert extracted == ["src3_0.flac", "src3_1.wav", "src4_0.wav"]
+    assert not (tmp_path / "escape.wav").exists() and not (tmp_path / "workspaces" / "escape.wav").exists()
+
+    gt = sorted(os.listdir(f"{worker.now_dir}/logs/exp1/0_gt_wavs"))
+    assert len(gt) == 6 and len({name.split("_")[0] for name in gt}) == 6
+    with open(f"{worker.now_dir}/logs/exp1/preprocess.log") as f:
+        assert f.read() == log + "\n"
+
+    assert stats["archive_ms"] > 0 and stats["download_ms"] > 0 and stats["decode_ms"] == 7.0
+    assert worker.progress_tracker.snapshot("exp1")["state"] == "completed"
+
+    # لا شيء محجوز بعد الانتهاء: الملفات المحملة يمكن حذفها والـ workspace اختفى
+    assert worker.download_cache._files
+    assert all(entry["refs"] == 0 for entry in worker.download_cache._files.values())
+    assert worker.workspaces.stats()["active"] == 0
+    assert not os.path.exists(ws.path)
+
+
+def test_ingest_all_failed_is_rejected_and_releases(worker, server):
+    with worker.workspaces.open("train", "user_1", discard=True) as ws:
+        with pytest.raises(ValueError, match="No usable audio"):
+            worker.ingest_dataset([f"{server}/corrupt.wav", f"{server}/missing.wav"], "exp2", "40k", ws)
+
+    assert worker.progress_tracker.snapshot("exp2")["state"] == "failed"
+    assert all(entry["refs"] == 0 for entry in worker.download_cache._files.values())
+    assert worker.workspaces.stats()["active"] == 0
+
+
+def test_archive_budget_is_enforced(worker, server, monkeypatch):
+    monkeypatch.setattr(worker, "INGEST_MAX_EXTRACT_MB", 0)
+    with worker.workspaces.open("train", "user_1", discard=True) as ws:
+        with pytest.raises(ValueError, match="No usable audio"):
+            worker.ingest_dataset([f"{server}/set.zip"], "exp3", "40k", ws)
+        assert os.listdir(ws.path) == []
+    assert all(entry["refs"] == 0 for entry in worker.download_cache._files.values())
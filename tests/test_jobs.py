@@ -0,0 +1,91 @@
+"""
+مهام running من عملية أو host آخر: ترجع للانتظار عند انتهاء الـ lease بدل أن تبقى running للأبد،
+و ?limit في قائمة المهام عدد صحيح موجب
+"""
+import time
+import uuid
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def submitted(gateway, monkeypatch):
+    jobs = []
+    monkeypatch.setattr(gateway, "submit_job", jobs.append)
+    return jobs
+
+
+def insert_running(gateway, owner, lease_expires_at, user_id="user_lease"):
+    job_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    with gateway._jobs_db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, user_id, state, payload, owner, attempts, created_at, updated_at, "
+            "lease_expires_at) VALUES (?, 'train', ?, 'running', '{}', ?, 1, ?, ?, ?)",
+            (job_id, user_id, owner, now, now, lease_expires_at),
+        )
+    return job_id
+
+
+def test_expired_lease_from_another_host_is_requeued(gateway, submitted):
+    stale = insert_running(gateway, "old-host:4242", time.time() - 1)
+    live = insert_running(gateway, "other-host:17", time.time() + 300)
+
+    gateway.recover_jobs()
+
+    assert gateway.get_job(stale)["state"] == "queued"
+    assert gateway.get_job(live)["state"] == "running"
+    assert stale in submitted and live not in submitted
+
+
+def test_reap_requeues_once(gateway):
+    job_id = insert_running(gateway, "old-host:1", time.time() - 1)
+
+    assert job_id in gateway.job_leases.reap()
+    assert job_id not in gateway.job_leases.reap()
+    job = gateway.get_job(job_id)
+    assert job["state"] == "queued"
+    assert gateway.job_queue_position(job_id) is not None
+
+
+def test_held_job_lease_is_renewed(gateway):
+    job_id = insert_running(gateway, gateway._job_owner, time.time() + 0.01)
+    with gateway.job_leases.hold(job_id):
+        time.sleep(0.02)
+        gateway.job_leases.renew()
+        assert job_id not in gateway.job_leases.reap()
+    assert gateway.get_job(job_id)["state"] == "running"
+
+
+def test_stale_running_jobs_stop_blocking_the_user(gateway, monkeypatch, submitted):
+    """قبل الـ leases: مهام running من host قديم تحجز حد المستخدم للأبد"""
+    monkeypatch.setattr(gateway, "ADMISSION_USER_MAX_JOBS", 1)
+    user_id = f"user_{uuid.uuid4().hex[:8]}"
+    stale = insert_running(gateway, "old-host:99", time.time() - 1, user_id)
+
+    with pytest.raises(gateway.AdmissionRejected):
+        gateway.create_job('train', user_id, {})
+
+    gateway.recover_jobs()
+    assert stale in submitted
+    gateway.cancel_job(stale)  # ترجع للانتظار وتُنفذ أو تُلغى، ولا تبقى running
+    assert gateway.create_job('train', user_id, {})
+
+
+@pytest.mark.parametrize("limit", ["abc", "-1", "0", "1.5"])
+def test_jobs_list_rejects_bad_limit(gateway, limit):
+    response = gateway.app.test_client().get(f'/api/jobs?limit={limit}')
+    assert response.status_code == 400
+    assert response.get_json() == {"success": False, "error": "limit must be a positive integer"}
+
+
+def test_jobs_list_limit_is_capped(gateway, submitted):
+    user_id = f"user_{uuid.uuid4().hex[:8]}"
+    for _ in range(3):
+        gateway.create_job('preprocess', user_id, {})
+    client = gateway.app.test_client()
+
+    assert client.get(f'/api/jobs?user_id={user_id}&limit=2').get_json()["count"] == 2
+    assert client.get(f'/api/jobs?user_id={user_id}&limit=100000').get_json()["count"] == 3
+    assert client.get(f'/api/jobs?user_id={user_id}').get_json()["count"] == 3
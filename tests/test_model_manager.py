@@ -0,0 +1,207 @@
+"""
+ModelManager على CPU: loader و size_fn بديلان بدل RVC — تحميل واحد للطلبات المتزامنة، إخراج LRU
+تحت الميزانية، النموذج المستخدم حالياً لا يُخرج، و invalidate بعد إعادة التدريب
+"""
+import json
+import sys
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from notebook import load_colab
+
+MB = 1024 * 1024
+
+
+class FakeModel:
+    def __init__(self, key, size_mb):
+        self.key = key
+        self.size_mb = size_mb
+
+
+class FakeLoader:
+    """يعدّ التحميلات لكل صوت، وكل تحميل يأخذ delay حتى تتداخل الطلبات المتزامنة"""
+
+    def __init__(self, size_mb=1, delay=0.0):
+        self.size_mb = size_mb
+        self.delay = delay
+        self.loads = Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        with self.lock:
+            self.loads[key] += 1
+        time.sleep(self.delay)
+        return FakeModel(key, self.size_mb)
+
+
+@pytest.fixture(scope="module")
+def colab(tmp_path_factory):
+    module = load_colab("colab_model_manager", ["Model Manager"], str(tmp_path_factory.mktemp("rvc")))
+    yield module
+    sys.modules.pop("colab_model_manager", None)
+
+
+def manager(colab, loader, budget_mb):
+    return colab.ModelManager(loader, budget_mb * MB, size_fn=lambda model: model.size_mb * MB)
+
+
+def test_concurrent_acquires_load_once(colab):
+    loader = FakeLoader(delay=0.2)
+    models = manager(colab, loader, budget_mb=10)
+    barrier = threading.Barrier(8)
+    seen = []
+
+    def use():
+        barrier.wait()
+        with models.acquire("voice") as (model, info):
+            seen.append((id(model), info["hit"]))
+
+    threads = [threading.Thread(target=use) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert loader.loads == {"voice": 1}
+    assert len({model_id for model_id, _ in seen}) == 1
+    assert sum(not hit for _, hit in seen) == 1
+    assert (models.misses, models.hits) == (1, 7)
+
+
+def test_lru_eviction_under_budget(colab):
+    loader = FakeLoader(size_mb=4)
+    models = manager(colab, loader, budget_mb=10)
+    for key in ("a", "b"):
+        with models.acquire(key):
+            pass
+    with models.acquire("a"):  # a أحدث استخدام الآن
+        pass
+    with models.acquire("c"):
+        pass
+
+    assert [entry["voice"] for entry in models.stats()["resident"]] == ["c", "a"]
+    assert models.evictions == 1
+    with models.acquire("b") as (_, info):
+        assert not info["hit"]
+    assert loader.loads == {"a": 1, "b": 2, "c": 1}
+
+
+def test_models_in_use_are_not_evicted(colab):
+    loader = FakeLoader(size_mb=4)
+    models = manager(colab, loader, budget_mb=6)
+    with models.acquire("a") as (pinned, _):
+        with models.acquire("b"):
+            pass
+        with models.acquire("c"):
+            pass
+        # a محجوز طوال الوقت: b خرج بدلاً منه، والاستخدام تجاوز الميزانية مؤقتاً بدل حذف نموذج يعمل
+        resident = {entry["voice"]: entry["in_use"] for entry in models.stats()["resident"]}
+        assert resident == {"a": 1, "c": 0}
+    with models.acquire("a") as (again, info):
+        assert again is pinned and info["hit"]
+
+    with models.acquire("d"):
+        pass
+    assert [entry["voice"] for entry in models.stats()["resident"]] == ["d"]
+    assert loader.loads == {"a": 1, "b": 1, "c": 1, "d": 1}
+
+
+def test_invalidate_reloads_on_next_acquire(colab):
+    loader = FakeLoader()
+    models = manager(colab, loader, budget_mb=10)
+    with models.acquire("voice") as (old, _):
+        assert models.invalidate("voice")
+        # الطلب الجاري يكمل بالنموذج القديم
+        assert old.key == "voice"
+    assert not models.invalidate("voice")
+
+    with models.acquire("voice") as (new, info):
+        assert new is not old and not info["hit"]
+    assert loader.loads == {"voice": 2}
+
+
+class FakeVC:
+    def __init__(self, key, output_path, hold):
+        self.key = key
+        self.size_mb = 1
+        self.output_path = output_path
+        self.hold = hold
+
+    def vc_single(self, *args):
+        time.sleep(self.hold)
+        return "ok", self.output_path
+
+
+class NoF0Cache:
+    def take_status(self):
+        return None
+
+
+@pytest.fixture
+def convert_colab(tmp_path):
+    module = load_colab("colab_model_stages", ["Model Manager", "Flask Endpoints", "Binary Transport"],
+                        str(tmp_path / "rvc"))
+    output = tmp_path / "output.wav"
+    output.write_bytes(b"RIFF")
+    module.f0_cache = NoF0Cache()
+    module.model_manager = module.ModelManager(
+        lambda key: FakeVC(key, str(output), hold=0.3), 10 * MB, size_fn=lambda model: MB)
+    yield module
+    sys.modules.pop("colab_model_stages", None)
+
+
+def test_lock_wait_is_reported_apart_from_model_load(convert_colab, tmp_path):
+    data = {"input_audio0": str(tmp_path / "input.wav"), "file_index2": "voice.pth", "use_cache": False}
+    with convert_colab.model_manager.acquire("voice"):
+        pass  # محمّل مسبقاً: أي وقت بعد ذلك هو انتظار وليس تحميل
+    results = []
+
+    def convert():
+        timer = convert_colab.StageTimer()
+        body, status = convert_colab.run_convert(data, timer=timer)
+        results.append((status, timer.stages))
+
+    threads = [threading.Thread(target=convert) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    # inference ثاني على نفس الصوت ينتظر الأول (~0.3 s) في model_lock_wait_ms وليس model_load_ms
+    assert [status for status, _ in results] == [200, 200]
+    assert all(stages["model_load_ms"] < 50 for _, stages in results)
+    waits = sorted(stages["model_lock_wait_ms"] for _, stages in results)
+    assert waits[0] < 50 and waits[1] >= 250
+
+
+def test_batch_does_not_hold_the_voice_between_items(convert_colab, tmp_path):
+    items = [{"index": index, "input_audio0": str(tmp_path / f"clip{index}.wav")} for index in range(4)]
+    client = convert_colab.colab_app.test_client()
+    lines = []
+
+    def batch():
+        response = client.post('/convert/batch', json={"file_index2": "voice.pth", "use_cache": False,
+                                                        "items": items})
+        lines.extend(json.loads(line) for line in response.get_data(as_text=True).splitlines())
+
+    t0 = time.perf_counter()
+    thread = threading.Thread(target=batch)
+    thread.start()
+    time.sleep(0.1)  # أثناء أول عنصر
+
+    timer = convert_colab.StageTimer()
+    body, status = convert_colab.run_convert({"input_audio0": str(tmp_path / "single.wav"),
+                                              "file_index2": "voice.pth", "use_cache": False}, timer=timer)
+    single_done = time.perf_counter() - t0
+    thread.join(10)
+
+    # /convert ينتظر العنصر الحالي فقط (0.3 s) وليس الـ batch كله (4 × 0.3 s)
+    assert status == 200 and timer.stages["model_lock_wait_ms"] < 600
+    assert single_done < 1.0
+    assert [line["index"] for line in lines] == [0, 1, 2, 3]
+    assert all(line["success"] and line["status"] == 200 for line in lines)
+    assert convert_colab.model_manager.misses == 1
+    assert convert_colab.model_manager.stats()["resident"][0]["in_use"] == 0
@@ -0,0 +1,196 @@
+"""
+الكتابة عبر persist_queue تتم في الخلفية: ما يعتمد على المستند الجديد (إبطال voice_cache) يحدث بعد الـ commit،
+و add_to_favorite لا يقرأ Firestore: صوت غير موجود يرجع نفس خطأ update المتزامن، والمستند غير الموجود
+الذي لا يعرفه الـ gateway يُسقط في الخلفية بدون إعادة محاولة
+"""
+import threading
+import uuid
+
+import pytest
+
+
+class NotFound(Exception):
+    code = 404  # مثل google.api_core.exceptions.NotFound
+
+
+class FakeDb:
+    """Firestore بديل: المستندات في dict، و commit ينتظر gate حتى نفحص النافذة قبل الكتابة"""
+
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+        self.commits = 0
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def document(self, path):
+        return FakeRef(self, path)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class FakeRef:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+
+    def get(self):
+        self.db.reads += 1
+        return type("Snapshot", (), {"exists": self.path in self.db.docs})()
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(("set", ref.path, data))
+
+    def update(self, ref, data):
+        self.writes.append(("update", ref.path, data))
+
+    def commit(self):
+        self.db.gate.wait(5)
+        self.db.commits += 1
+        for kind, path, _ in self.writes:
+            if kind == "update" and path not in self.db.docs:
+                raise NotFound(f"No document to update: {path}")
+        for _, path, data in self.writes:
+            self.db.docs.setdefault(path, {}).update(data)
+
+
+@pytest.fixture
+def fake_db(gateway, monkeypatch, tmp_path):
+    db = FakeDb()
+    queue = gateway.PersistQueue(str(tmp_path / "journal.db"))
+    queue.init()
+    monkeypatch.setattr(gateway, "db", db)
+    monkeypatch.setattr(gateway, "persist_queue", queue)
+    return db
+
+
+def test_voice_cache_is_invalidated_again_after_commit(gateway, fake_db):
+    voice = f"voice_{uuid.uuid4().hex[:8]}"
+    path = f"exp_dir/user_a/voices/{voice}"
+    fake_db.gate.clear()
+
+    gateway.persist_queue.set(path, {"model_path": "new.pth"}, merge=True,
+                              on_commit=lambda: gateway.voice_cache.invalidate(voice))
+    gateway.voice_cache.invalidate(voice)
+    # resolve_voice بين الـ invalidate و الـ commit: يقرأ المستند القديم ويعيده للـ cache
+    gateway.voice_cache.put((voice, "user_a"), ("old.pth", "old.index"))
+    assert gateway.persist_queue.pending(path)
+
+    fake_db.gate.set()
+    assert gateway.persist_queue.flush()
+
+    assert fake_db.docs[path] == {"model_path": "new.pth"}
+    assert gateway.voice_cache.get((voice, "user_a")) == (False, None)
+
+
+def test_on_commit_survives_coalescing_and_runs_once(gateway, fake_db):
+    calls = []
+    fake_db.gate.clear()
+    gateway.persist_queue.set("docs/a", {"x": 1}, merge=True, on_commit=lambda: calls.append(1))
+    gateway.persist_queue.update("docs/a", {"y": 2}, on_commit=lambda: calls.append(2))
+    assert calls == []
+
+    fake_db.gate.set()
+    assert gateway.persist_queue.flush()
+    assert calls == [1, 2]
+    assert not gateway.persist_queue.pending("docs/a")
+    assert gateway.persist_queue.known("docs/a")
+
+
+def test_journal_replays_coalesced_writes_in_order(gateway, fake_db, tmp_path):
+    fake_db.gate.clear()
+    queue = gateway.persist_queue
+    queue.set("docs/b", {"x": 1, "y": 1}, merge=True)
+    queue.update("docs/b", {"y": 2})
+    queue.set("docs/c", {"old": True})
+    queue.set("docs/c", {"new": True})
+
+    replay = gateway.PersistQueue(queue.journal_path)
+    replay._ensure_thread = lambda: None  # نفحص الطابور قبل أن يأخذه thread الإرسال
+    replay.recover()
+    with replay._cond:
+        pending = {path: (op["kind"], op["data"], len(op["rows"])) for path, op in replay._pending.items()}
+    assert pending == {"docs/b": ("set", {"x": 1, "y": 2}, 2), "docs/c": ("set", {"new": True}, 2)}
+    del replay._ensure_thread
+    replay._ensure_thread()
+    fake_db.gate.set()
+    assert queue.flush() and replay.flush()
+
+
+def test_journal_write_does_not_hold_the_queue_lock(gateway, fake_db, monkeypatch):
+    queue = gateway.persist_queue
+    in_journal, release = threading.Event(), threading.Event()
+    save = queue._save
+
+    def slow_save(path, *args):
+        if path == "docs/slow":
+            in_journal.set()
+            release.wait(5)
+        return save(path, *args)
+
+    monkeypatch.setattr(queue, "_save", slow_save)
+    writer = threading.Thread(target=queue.set, args=("docs/slow", {"x": 1}), daemon=True)
+    writer.start()
+    assert in_journal.wait(2)
+
+    # كتابة أخرى تكمل بينما الأولى ما زالت في SQLite
+    done = threading.Event()
+    threading.Thread(target=lambda: (queue.set("docs/fast", {"y": 1}), done.set()), daemon=True).start()
+    assert done.wait(2)
+    release.set()
+    writer.join(2)
+    assert queue.flush()
+    assert fake_db.docs["docs/slow"] == {"x": 1} and fake_db.docs["docs/fast"] == {"y": 1}
+
+
+def favorite(gateway, exp_dir):
+    return gateway.app.test_client().post('/api/add_to_favorite', json={
+        "user_id": "user_fav", "exp_dir1": exp_dir, "is_favorite": True,
+    }).get_json()
+
+
+def test_add_to_favorite_unknown_voice_keeps_not_found_error(gateway, fake_worker, fake_db):
+    gateway.voice_cache.put(("missing_voice", "user_fav"), ("default.pth", ""), negative=True)
+
+    body = favorite(gateway, "missing_voice")
+
+    assert "add to favorite is Error" in body
+    assert "No document to update" in body
+    assert not gateway.persist_queue.pending("training_voices/user_fav/missing_voice/data")
+    assert fake_db.reads == 0
+
+
+def test_add_to_favorite_known_or_pending_doc(gateway, fake_worker, fake_db):
+    # الصوت غير موجود في cache الأصوات، لكن هذا الـ gateway كتب المستند (commit سابق أو في الطابور)
+    for exp_dir in ("saved", "fresh"):
+        gateway.voice_cache.put((exp_dir, "user_fav"), ("default.pth", ""), negative=True)
+    gateway.persist_queue.set("training_voices/user_fav/saved/data", {"is_favorite": False}, merge=True)
+    assert gateway.persist_queue.flush()
+    fake_db.gate.clear()
+    gateway.persist_queue.set("training_voices/user_fav/fresh/data", {"name": "fresh"}, merge=True)
+
+    assert favorite(gateway, "saved")["status"] == "True"
+    assert favorite(gateway, "fresh")["status"] == "True"
+
+    fake_db.gate.set()
+    assert gateway.persist_queue.flush()
+    assert fake_db.docs["training_voices/user_fav/saved/data"] == {"is_favorite": True}
+    assert fake_db.docs["training_voices/user_fav/fresh/data"] == {"name": "fresh", "is_favorite": True}
+    assert fake_db.reads == 0
+
+
+def test_missing_doc_is_reported_asynchronously(gateway, fake_worker, fake_db):
+    assert favorite(gateway, "never_written")["status"] == "True"
+    assert gateway.persist_queue.flush()
+
+    stats = gateway.persist_queue.stats()
+    assert stats["missing"] == 1 and stats["retries"] == 0
+    assert [item["path"] for item in stats["recent_missing"]] == ["training_voices/user_fav/never_written/data"]
+    assert fake_db.commits == 1 and fake_db.reads == 0
@@ -0,0 +1,48 @@
+"""
+?since=<seq> غير صالح: 400 بدل 500 (في الـ gateway و في Colab)
+"""
+import sys
+
+import pytest
+
+from notebook import load_colab
+
+BAD_SINCE = ["abc", "1.5", "-1"]
+
+
+@pytest.fixture(scope="module")
+def colab(tmp_path_factory):
+    module = load_colab("colab_progress", ["Progress Tracking", "Model Manager", "Flask Endpoints"],
+                        str(tmp_path_factory.mktemp("rvc")))
+    module.progress_tracker.start("exp_since", "preprocess")
+    yield module
+    sys.modules.pop("colab_progress", None)
+
+
+@pytest.mark.parametrize("path", ["/progress/exp_since", "/progress/exp_since/stream"])
+@pytest.mark.parametrize("since", BAD_SINCE)
+def test_worker_rejects_bad_since(colab, path, since):
+    response = colab.colab_app.test_client().get(path, query_string={"since": since})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "since must be a non-negative integer"
+
+
+@pytest.mark.parametrize("query", [{}, {"since": ""}, {"since": "0"}, {"since": "3"}])
+def test_worker_accepts_missing_or_numeric_since(colab, query):
+    response = colab.colab_app.test_client().get("/progress/exp_since", query_string=query)
+    assert response.status_code == 200
+    assert response.get_json()["data"]["exp_dir"] == "exp_since"
+
+
+@pytest.mark.parametrize("path", ["/api/progress/exp_since", "/api/progress/exp_since/stream"])
+@pytest.mark.parametrize("since", BAD_SINCE)
+def test_gateway_rejects_bad_since(gateway, path, since):
+    response = gateway.app.test_client().get(path, query_string={"since": since})
+    assert response.status_code == 400
+    assert response.get_json()["success"] is False
+
+
+def test_gateway_missing_since_is_not_an_error(gateway):
+    # بدون workers: 404 (لا يوجد تقدم) وليس 400 أو 500
+    response = gateway.app.test_client().get("/api/progress/exp_since")
+    assert response.status_code == 404
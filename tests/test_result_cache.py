@@ -0,0 +1,160 @@
+"""
+ResultCache: LRU حسب الحجم، وملف النتيجة الذي يقرأه الطلب لا يختفي إذا أخرجه الـ eviction
+أو invalidate_voice، و put متزامن لنفس المفتاح لا يتشارك ملفاً مؤقتاً
+"""
+import os
+import sys
+import threading
+
+import pytest
+
+from notebook import load_colab
+
+
+@pytest.fixture(scope="module")
+def colab(tmp_path_factory):
+    module = load_colab("colab_result_cache", ["Model Manager", "Download Cache", "Workspaces", "Result Cache"],
+                        str(tmp_path_factory.mktemp("rvc")))
+    yield module
+    sys.modules.pop("colab_result_cache", None)
+
+
+@pytest.fixture
+def output(tmp_path):
+    """مثل vc_single في نسخ RVC التي ترجع مسار ملف: 100 byte لكل نتيجة"""
+    def make(name, content=None):
+        path = tmp_path / f"{name}.wav"
+        path.write_bytes(content or name.encode().ljust(100, b"\0"))
+        return str(path)
+    return make
+
+
+@pytest.fixture
+def cache(colab, tmp_path):
+    return colab.ResultCache(str(tmp_path / "results"), budget_bytes=250)
+
+
+def test_lru_eviction_by_size(cache, output):
+    for key in ("a", "b"):
+        cache.put(key, output(key), "ok", "voice")
+    assert cache.get("a")          # a أحدث استخدام الآن
+    cache.put("c", output("c"), "ok", "voice")
+
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"], stats["stores"]) == (2, 1, 3)
+
+
+def test_returned_copy_survives_eviction(cache, output, tmp_path):
+    cache.put("a", output("a"), "ok", "voice")
+    dest = tmp_path / "request" / "output.wav"
+    dest.parent.mkdir()
+
+    hit = cache.get("a", str(dest))
+    assert hit["output_path"] == str(dest)
+    cache.put("b", output("b"), "ok", "voice")
+    cache.put("c", output("c"), "ok", "voice")  # a خرج من الـ cache
+
+    assert cache.get("a") is None
+    assert dest.read_bytes() == b"a".ljust(100, b"\0")
+
+
+def test_returned_copy_survives_invalidation(cache, output, tmp_path):
+    cache.put("a", output("a"), "ok", "voice")
+    dest = tmp_path / "output.wav"
+    cache.get("a", str(dest))
+
+    assert cache.invalidate_voice("voice") == 1
+    assert dest.exists() and cache.get("a") is None
+
+
+def test_concurrent_puts_of_same_key(cache, output, colab, monkeypatch):
+    save = colab.save_output_audio
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def slow_save(output_audio, dest_path):
+        barrier.wait(5)  # كل الـ threads تكتب ملفها المؤقت في نفس الوقت
+        return save(output_audio, dest_path)
+
+    def put(index):
+        try:
+            cache.put("same", output(f"same{index}", b"x" * 100), "ok", "voice")
+        except Exception as e:
+            errors.append(e)
+
+    monkeypatch.setattr(colab, "save_output_audio", slow_save)
+    threads = [threading.Thread(target=put, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert errors == []
+    assert cache.get("same")["size"] == 100
+    assert not [name for name in os.listdir(cache.root) if name.endswith(".tmp")]
+
+
+def test_index_is_reloaded_after_restart(colab, cache, output):
+    cache.put("a", output("a"), "ok", "voice")
+    reloaded = colab.ResultCache(cache.root, budget_bytes=250)
+    assert reloaded.get("a")["info"] == "ok"
+
+
+class FakeVC:
+    size_mb = 1
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+
+    def vc_single(self, *args):
+        return "ok", self.output_path
+
+
+class NoF0Cache:
+    def take_status(self):
+        return None
+
+
+def test_binary_hit_reads_a_file_inside_its_workspace(tmp_path, output, monkeypatch):
+    monkeypatch.setenv("WORKSPACE_ROOT", str(tmp_path / "workspaces"))
+    module = load_colab("colab_result_convert", ["Model Manager", "Download Cache", "Workspaces",
+                                                 "Result Cache", "Flask Endpoints"], str(tmp_path / "rvc"))
+    try:
+        module.f0_cache = NoF0Cache()
+        module.model_manager = module.ModelManager(lambda key: FakeVC(output("converted")), 1 << 20,
+                                                   size_fn=lambda model: 1)
+        data = {"input_audio0": output("input"), "file_index2": "voice.pth"}
+        assert module.run_convert(data)[0]["data"]["cache_status"] == "miss"
+
+        with module.workspaces.open("convert", discard=True) as ws:
+            body, status = module.run_convert(data, workspace=ws)
+            assert body["data"]["cache_status"] == "hit"
+            assert body["data"]["output_path"] == ws.file("output.wav")
+            module.result_cache.invalidate_voice("voice")  # مثل eviction بين run_convert و encode_output_audio
+            assert open(body["data"]["output_path"], "rb").read() == b"converted".ljust(100, b"\0")
+    finally:
+        sys.modules.pop("colab_result_convert", None)
+
+
+def test_hit_without_workspace_returns_a_file_outside_the_cache(tmp_path, output, monkeypatch):
+    monkeypatch.setenv("WORKSPACE_ROOT", str(tmp_path / "workspaces"))
+    module = load_colab("colab_result_convert", ["Model Manager", "Download Cache", "Workspaces",
+                                                 "Result Cache", "Flask Endpoints"], str(tmp_path / "rvc"))
+    try:
+        module.f0_cache = NoF0Cache()
+        module.model_manager = module.ModelManager(lambda key: FakeVC(output("converted")), 1 << 20,
+                                                   size_fn=lambda model: 1)
+        data = {"input_audio0": output("input"), "file_index2": "voice.pth", "user_id": "u1"}
+        discarded = module.workspaces.stats()["discarded"]
+        assert module.run_convert(data)[0]["data"]["cache_status"] == "miss"
+        assert module.workspaces.stats()["discarded"] == discarded + 1  # workspace الـ lookup الفارغ
+
+        body, status = module.run_convert(data)
+        assert body["data"]["cache_status"] == "hit"
+        assert body["data"]["output_path"].startswith(module.workspaces.root)
+        module.result_cache.invalidate_voice("voice")  # مثل eviction قبل أن يقرأ المستدعي الملف
+        assert open(body["data"]["output_path"], "rb").read() == b"converted".ljust(100, b"\0")
+    finally:
+        sys.modules.pop("colab_result_convert", None)
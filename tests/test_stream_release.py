@@ -0,0 +1,103 @@
+"""
+العميل يقطع الاتصال قبل أول chunk: الـ generator لا يبدأ أصلاً، لكن مكان القبول و الـ worker يتحرران
+"""
+import asyncio
+import json
+import time
+import uuid
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+
+def stream_payload():
+    return {"file_index2": "voice", "input_audio0": "http://audio/a.wav", "user_id": f"user_{uuid.uuid4().hex[:8]}"}
+
+
+def batch_payload():
+    return {"user_id": f"user_{uuid.uuid4().hex[:8]}", "defaults": {"file_index2": "voice"},
+            "items": [{"id": "clip-1", "input_audio0": "http://audio/a.wav"}]}
+
+
+def pool_worker(gateway, worker_id):
+    return next(w for w in gateway.worker_pool.snapshot() if w["worker_id"] == worker_id)
+
+
+def worker_idle(gateway, worker_id, timeout=5):
+    """مجموعات الـ batch تكمل في الخلفية بعد انقطاع العميل وتحرر الـ worker عند انتهائها"""
+    deadline = time.time() + timeout
+    while pool_worker(gateway, worker_id)["in_flight"] and time.time() < deadline:
+        time.sleep(0.02)
+    return pool_worker(gateway, worker_id)["in_flight"] == 0
+
+
+def disconnect_before_first_chunk(gateway, path, payload):
+    environ = EnvironBuilder(method='POST', path=path, json=payload).get_environ()
+    status = []
+    app_iter = gateway.app(environ, lambda s, headers, exc_info=None: status.append(s))
+    app_iter.close()  # الـ WSGI server يستدعي close() عند انقطاع الاتصال
+    return status[0]
+
+
+@pytest.mark.parametrize("path, payload", [
+    ('/api/convert/stream', stream_payload),
+    ('/api/convert/batch', batch_payload),
+])
+def test_flask_releases_slots_without_iterating(gateway, fake_worker, path, payload):
+    running = gateway.admission.stats()["running"]
+
+    assert disconnect_before_first_chunk(gateway, path, payload()).startswith("200")
+
+    assert gateway.admission.stats()["running"] == running
+    assert worker_idle(gateway, fake_worker.worker_id)
+
+
+def test_flask_stream_releases_worker_once(gateway, fake_worker):
+    client = gateway.app.test_client()
+    response = client.post('/api/convert/stream', json=stream_payload())
+    assert b"event: done" in response.get_data()
+    response.close()
+
+    worker = pool_worker(gateway, fake_worker.worker_id)
+    assert worker["in_flight"] == 0
+    assert worker["completed"] == 1 and worker["failed"] == 0
+
+
+@pytest.mark.parametrize("path, payload", [
+    ('/api/convert/stream', stream_payload),
+    ('/api/convert/batch', batch_payload),
+])
+def test_asgi_releases_slots_on_early_disconnect(gateway, fake_worker, path, payload):
+    asgi = pytest.importorskip("asgi")
+    running = gateway.admission.stats()["running"]
+    body = json.dumps(payload()).encode()
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if message["type"] == "http.response.start":
+            await asyncio.sleep(0.2)  # الانقطاع يصل قبل أن يبدأ الـ generator
+
+    async def run():
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "http",
+            "method": "POST", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+        }
+        try:
+            await asgi.app(scope, receive, send)
+        finally:
+            await asgi.async_colab.aclose()
+
+    asyncio.run(run())
+
+    assert sent[0]["status"] == 200
+    assert gateway.admission.stats()["running"] == running
+    assert worker_idle(gateway, fake_worker.worker_id)
@@ -0,0 +1,99 @@
+"""
+/convert/stream: المقاطع المتداخلة بعد الـ crossfade = نفس نتيجة التحويل الكامل (بدون GPU).
+المحوّل هنا identity (مع رفع معدل العيّنات بالتكرار) حتى تكون نتيجة المسار الكامل معروفة بدقة
+"""
+import sys
+
+import numpy as np
+import pytest
+
+from notebook import load_colab
+
+SR_IN = 16000  # RVC_INPUT_SR
+
+
+@pytest.fixture(scope="module")
+def stream(tmp_path_factory):
+    module = load_colab("colab_stream", ["Streaming Convert"], str(tmp_path_factory.mktemp("rvc")))
+    yield module
+    sys.modules.pop("colab_stream", None)
+
+
+def voice(seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SR_IN)) / SR_IN
+    audio = sum(np.sin(2 * np.pi * f * t + rng.uniform(0, np.pi)) for f in (140, 280, 420))
+    return (8000 * audio).astype(np.float32)
+
+
+def convert(audio, factor):
+    """محوّل identity بمعدل مخرج SR_IN * factor (مثل vc_single حين يختلف tgt_sr عن 16k)"""
+    return np.repeat(audio, factor)
+
+
+def stream_convert(stream, audio, factor, segment_seconds, overlap_seconds):
+    segments = stream.plan_segments(len(audio), SR_IN, segment_seconds, overlap_seconds)
+    stitcher = stream.make_stitcher(SR_IN * factor, segment_seconds, overlap_seconds)
+    parts = [stitcher.push(convert(audio[start:end], factor)) for start, end in segments]
+    parts.append(stitcher.flush())
+    return segments, np.concatenate(parts)
+
+
+@pytest.mark.parametrize("factor", [1, 2, 3])
+@pytest.mark.parametrize("seconds, segment_seconds, overlap_seconds", [
+    (20.0, 8, 0.3),
+    (20.3, 8, 0.3),     # المقطع الأخير قصير ويُدمج مع الذي قبله
+    (5.0, 1, 0.9),      # overlap أكبر من نصف المقطع: يُقصّ في الطرفين بنفس القيمة
+    (3.0, 8, 0.3),      # مقطع واحد
+    (12.0, 2.5, 0.0),
+])
+def test_stitched_stream_matches_full_conversion(stream, factor, seconds, segment_seconds, overlap_seconds):
+    audio = voice(seconds)
+    full = convert(audio, factor)
+
+    segments, stitched = stream_convert(stream, audio, factor, segment_seconds, overlap_seconds)
+
+    assert segments[0][0] == 0 and segments[-1][1] == len(audio)
+    assert len(stitched) == len(full)
+    np.testing.assert_allclose(stitched, full, atol=0.05)
+    # الاستمرارية: لا قفزات عند حدود المقاطع أكبر من أكبر فرق في الصوت نفسه
+    assert np.abs(np.diff(stitched)).max() <= np.abs(np.diff(full)).max() + 0.05
+
+
+def test_crossfade_hides_segment_seams(stream):
+    """مقاطع بمستوى مختلف قليلاً (مثل RVC): الانتقال تدريجي وليس قفزة"""
+    audio = np.ones(SR_IN * 4, dtype=np.float32) * 1000
+    segments = stream.plan_segments(len(audio), SR_IN, 1, 0.25)
+    stitcher = stream.make_stitcher(SR_IN, 1, 0.25)
+    parts = [stitcher.push(audio[start:end] * (1 + 0.1 * (seq % 2))) for seq, (start, end) in enumerate(segments)]
+    stitched = np.concatenate(parts + [stitcher.flush()])
+
+    assert len(stitched) == len(audio)
+    assert np.abs(np.diff(stitched)).max() < 1.0  # بدون crossfade القفزة = 100
+
+
+@pytest.mark.parametrize("options, error", [
+    ({"segment_seconds": 0.001}, "segment_seconds must be between"),
+    ({"segment_seconds": 600}, "segment_seconds must be between"),
+    ({"overlap_seconds": -1}, "overlap_seconds must be between"),
+    ({"overlap_seconds": 5}, "overlap_seconds must be between"),
+    ({"segment_seconds": "abc"}, "segment_seconds must be a number"),
+    ({"overlap_seconds": "nan"}, "overlap_seconds must be between"),
+])
+def test_worker_rejects_unbounded_segments(stream, options, error):
+    with pytest.raises(ValueError, match=error):
+        stream.parse_segment_options(options)
+
+
+@pytest.mark.parametrize("options", [
+    {"segment_seconds": 0.001},
+    {"segment_seconds": 10_000},
+    {"overlap_seconds": 3},
+    {"overlap_seconds": "x"},
+])
+def test_gateway_rejects_unbounded_segments(gateway, options):
+    client = gateway.app.test_client()
+    response = client.post('/api/convert/stream', json={"file_index2": "voice", "input_audio0": "http://x/a.wav",
+                                                        **options})
+    assert response.status_code == 400
+    assert response.get_json()["success"] is False
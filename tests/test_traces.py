@@ -0,0 +1,25 @@
+"""
+/api/traces/slowest: أبطأ الطلبات من سجل الـ traces، و ?limit عدد صحيح موجب
+"""
+import pytest
+
+
+@pytest.fixture
+def traces(gateway, monkeypatch, tmp_path):
+    sink = gateway.TraceSink(str(tmp_path / "traces.jsonl"))
+    for index, total_ms in enumerate((120, 40, 900, 300)):
+        sink.write({"trace_id": f"t{index}", "route": "/api/convert", "total_ms": total_ms})
+    monkeypatch.setattr(gateway, "trace_sink", sink)
+    return sink
+
+
+def test_slowest_traces_are_ordered_and_limited(gateway, traces):
+    body = gateway.app.test_client().get('/api/traces/slowest?limit=2').get_json()
+    assert [trace["trace_id"] for trace in body["traces"]] == ["t2", "t3"]
+
+
+@pytest.mark.parametrize("limit", ["abc", "-1", "0"])
+def test_slowest_traces_rejects_bad_limit(gateway, traces, limit):
+    response = gateway.app.test_client().get(f'/api/traces/slowest?limit={limit}')
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "limit must be a positive integer"
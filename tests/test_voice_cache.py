@@ -0,0 +1,124 @@
+"""
+voice_cache أمام lookup_voice_paths: عدادات hit / miss، TTL أقصر للأصوات غير الموجودة، حد LRU،
+والإبطال بعد التدريب. Firestore هنا هو FakeFirestore من bench.py
+"""
+import time
+import uuid
+
+import pytest
+
+from bench import FakeFirestore
+
+
+@pytest.fixture
+def cache():
+    from app import VoiceCache
+    return VoiceCache(maxsize=3, ttl=60, negative_ttl=0.1)
+
+
+@pytest.fixture
+def firestore_db(gateway, monkeypatch, tmp_path):
+    db = FakeFirestore()
+    queue = gateway.PersistQueue(str(tmp_path / "journal.db"))
+    queue.init()
+    monkeypatch.setattr(gateway, "db", db)
+    monkeypatch.setattr(gateway, "persist_queue", queue)
+    monkeypatch.setattr(gateway, "voice_cache", gateway.VoiceCache(maxsize=16, ttl=60, negative_ttl=60))
+    return db
+
+
+def test_hit_and_miss_counters(cache):
+    assert cache.get(("voice", "u1")) == (False, None)
+    cache.put(("voice", "u1"), ("a.pth", "a.index"))
+    cache.put(("ghost", "u1"), ("ghost.pth", ""), negative=True)
+
+    assert cache.get(("voice", "u1")) == (True, ("a.pth", "a.index"))
+    assert cache.get(("voice", "u1")) == (True, ("a.pth", "a.index"))
+    assert cache.get(("ghost", "u1")) == (True, ("ghost.pth", ""))
+    assert cache.get(("voice", "u2")) == (False, None)
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["negative_hits"], stats["misses"]) == (2, 1, 2)
+    assert stats["hit_rate"] == 0.6
+
+
+def test_negative_entries_expire_first(cache):
+    cache.put(("voice", "u1"), ("a.pth", ""))
+    cache.put(("ghost", "u1"), ("ghost.pth", ""), negative=True)
+    time.sleep(0.15)
+
+    assert cache.get(("ghost", "u1")) == (False, None)
+    assert cache.get(("voice", "u1")) == (True, ("a.pth", ""))
+    assert cache.stats()["expired"] == 1
+
+
+def test_lru_bound_evicts_least_recently_used(cache):
+    for name in ("a", "b", "c"):
+        cache.put((name, ""), (f"{name}.pth", ""))
+    cache.get(("a", ""))            # a أحدث استخدام الآن
+    cache.put(("d", ""), ("d.pth", ""))
+
+    assert cache.stats()["size"] == 3 and cache.stats()["evictions"] == 1
+    assert cache.get(("b", "")) == (False, None)
+    assert cache.get(("a", ""))[0] and cache.get(("c", ""))[0] and cache.get(("d", ""))[0]
+
+
+def test_invalidate_removes_voice_for_every_user(cache):
+    cache.put(("voice", "u1"), ("a.pth", ""))
+    cache.put(("voice", "u2"), ("a.pth", ""))
+    cache.put(("other", "u1"), ("b.pth", ""))
+
+    assert cache.invalidate("voice") == 2
+    assert cache.get(("voice", "u2")) == (False, None)
+    assert cache.get(("other", "u1"))[0]
+    assert cache.invalidate() == 1 and cache.stats()["invalidations"] == 3
+
+
+def test_resolve_voice_reads_firestore_once(gateway, firestore_db):
+    firestore_db.collection('training_voices').document().set(
+        {"voiceName": "shared", "modelPath": "/m/shared.pth", "indexPath": "/m/shared.index"})
+    firestore_db.collection('exp_dir').document('u1').collection('voices').document('mine').set(
+        {"exp_dir": "mine_v2"})
+
+    assert gateway.resolve_voice("shared", "u1") == ("/m/shared.pth", "/m/shared.index")
+    assert gateway.resolve_voice("mine", "u1") == gateway.default_voice_paths("mine_v2")
+    assert gateway.resolve_voice("ghost", "u1") == gateway.default_voice_paths("ghost")
+    calls = firestore_db.calls
+
+    for _ in range(3):
+        assert gateway.resolve_voice("shared", "u1") == ("/m/shared.pth", "/m/shared.index")
+        assert gateway.resolve_voice("mine", "u1") == gateway.default_voice_paths("mine_v2")
+        assert gateway.resolve_voice("ghost", "u1") == gateway.default_voice_paths("ghost")
+    assert firestore_db.calls == calls
+    stats = gateway.voice_cache.stats()
+    assert (stats["hits"], stats["negative_hits"], stats["misses"]) == (6, 3, 3)
+
+
+def test_firestore_errors_are_not_cached(gateway, firestore_db, monkeypatch):
+    def unavailable(name):
+        raise RuntimeError("deadline exceeded")
+
+    monkeypatch.setattr(firestore_db, "collection", unavailable)
+    assert gateway.resolve_voice("shared", "u1") == gateway.default_voice_paths("shared")
+    assert gateway.voice_cache.stats()["size"] == 0
+
+
+def test_training_invalidates_the_voice_after_commit(gateway, firestore_db, fake_worker):
+    user_id = f"user_{uuid.uuid4().hex[:8]}"
+    voice = f"voice_{uuid.uuid4().hex[:8]}"
+    assert gateway.resolve_voice(voice, user_id) == gateway.default_voice_paths(voice)  # negative
+    job_id = gateway.create_job('train', user_id, {})
+
+    gateway._run_train(job_id, {"exp_dir1": voice, "trainset_dir4": "http://audio/a.wav", "user_id": user_id})
+    assert fake_worker.calls['train'] == 1
+    assert gateway.voice_cache.stats()["size"] == 0
+
+    # قبل commit: resolve_voice يقرأ Firestore القديم ويعيد المسار القديم إلى الـ cache
+    gateway.resolve_voice(voice, user_id)
+    assert gateway.voice_cache.peek((voice, user_id))[2]
+
+    assert gateway.persist_queue.flush()
+    assert gateway.voice_cache.peek((voice, user_id)) == (False, None, False)
+    model_path, index_path = gateway.default_voice_paths(voice)
+    assert gateway.resolve_voice(voice, user_id) == (model_path, index_path)
+    assert not gateway.voice_cache.peek((voice, user_id))[2]  # الآن موجود في training_voices
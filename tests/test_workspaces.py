@@ -0,0 +1,98 @@
+"""
+WorkspaceManager: المجلدات النشطة تُحسب في الـ quota، الـ GC يحذف المنتهية فقط (حسب العمر ثم الـ quota)،
+و refcount يبقي المجلد حتى آخر release
+"""
+import os
+import sys
+import time
+
+import pytest
+
+from notebook import load_colab
+
+
+@pytest.fixture(scope="module")
+def colab(tmp_path_factory):
+    module = load_colab("colab_workspaces", ["Model Manager", "Download Cache", "Workspaces"],
+                        str(tmp_path_factory.mktemp("rvc")))
+    yield module
+    sys.modules.pop("colab_workspaces", None)
+
+
+@pytest.fixture
+def manager(colab, tmp_path):
+    return colab.WorkspaceManager(str(tmp_path / "workspaces"), quota_bytes=1000, max_age=3600)
+
+
+def fill(ws, size, name="data.bin"):
+    with open(ws.file(name), "wb") as f:
+        f.write(b"\0" * size)
+
+
+def test_active_workspaces_count_toward_the_quota(manager):
+    retained = manager.create("convert")
+    fill(retained, 600)
+    manager.release(retained)
+    active = manager.create("train")
+    fill(active, 600)
+
+    assert manager.used_bytes() == 1200
+    # المجموع فوق الـ quota: create يحذف المنتهي، والنشط لا يُلمس
+    third = manager.create("convert")
+    assert not os.path.exists(retained.path) and os.path.exists(active.path)
+    assert manager.stats()["collected"] == 1
+    assert manager.stats()["active"] == 2
+    manager.release(active)
+    manager.release(third)
+
+
+def test_gc_removes_released_workspaces_by_age(manager):
+    old = manager.create("convert")
+    manager.release(old)
+    old.released_at = time.time() - 7200
+    recent = manager.create("convert")
+    manager.release(recent)
+    running = manager.create("train")
+    running.created_at = time.time() - 7200
+
+    assert manager.gc() == 1
+    assert not os.path.exists(old.path)
+    assert os.path.exists(recent.path) and os.path.exists(running.path)
+    assert manager.stats()["retained"] == 1 and manager.stats()["active"] == 1
+    manager.release(running)
+
+
+def test_gc_over_quota_removes_oldest_released_first(manager):
+    released = []
+    for index in range(3):
+        ws = manager.create("convert")
+        fill(ws, 400)
+        manager.release(ws)
+        ws.released_at = time.time() - 30 + index
+        released.append(ws)
+
+    assert manager.gc() == 1
+    assert [os.path.exists(ws.path) for ws in released] == [False, True, True]
+    assert manager.stats()["collected_bytes"] == 400
+
+
+def test_refcount_keeps_the_workspace_until_last_release(manager):
+    ws = manager.create("stream")
+    manager.retain(ws)
+    manager.release(ws, discard=True)
+    ws.released_at = time.time() - 7200  # حتى لو بدا قديماً
+
+    assert manager.gc() == 0 and os.path.exists(ws.path)
+    manager.release(ws, discard=True)
+    assert not os.path.exists(ws.path)
+    assert manager.stats()["discarded"] == 1 and manager.stats()["active"] == 0
+
+
+def test_orphans_from_a_previous_run_are_removed(colab, tmp_path):
+    root = tmp_path / "workspaces"
+    (root / "convert-0123456789ab").mkdir(parents=True)
+    (root / "keep-me").mkdir()
+    manager = colab.WorkspaceManager(str(root), quota_bytes=1000, max_age=3600)
+
+    assert sorted(os.listdir(root)) == ["keep-me"]
+    assert manager.stats()["orphans"] == 1